@@ -0,0 +1,282 @@
+"""
+Offscreen rendering benchmark for VTKOverlayWindow.
+
+Sweeps video resolution, model count, triangles per model, model opacity,
+depth peeling and layer usage. Every configuration gets a fresh
+VTKOverlayWindow(offscreen=True) sized to the video, with synthetic sphere
+meshes in front of the camera, and is timed per frame for
+set_video_image, Render and the convert_scene_to_numpy_array readback,
+without the render it does by default.
+A GPU may finish drawing during the readback, so compare "frame" totals
+across machines rather than Render alone. Results are written as JSON,
+with the OpenGL renderer, so software and hardware runs are told apart.
+
+Runs without a display: Qt uses its offscreen platform and VTK renders
+through EGL, or OSMesa with an OSMesa build of VTK. The vtk 9.3.0 wheel
+of env.yml renders through X only, so without a display install VTK 9.4
+or later, whose wheels include EGL, or a vtk-osmesa wheel. On a machine
+without a GPU, Mesa's llvmpipe does the drawing, e.g.::
+
+    VTK_DEFAULT_OPENGL_WINDOW=vtkEGLRenderWindow \\
+        python -m benchmark.overlay_rendering --output rendering.json
+    python -m benchmark.overlay_rendering --resolutions 1920x1080 \\
+        --model-counts 1 10 --triangles 100000 1000000 --layers standard
+"""
+
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+
+from benchmark.results import summarise, write_results
+from benchmark.synthetic_tracking import _parse_resolution, camera_matrix_for
+
+DEFAULT_RESOLUTIONS = ((640, 480), (1920, 1080))
+DEFAULT_MODEL_COUNTS = (1, 8)
+DEFAULT_TRIANGLES = (20000, 200000)
+DEFAULT_OPACITIES = (1.0, 0.5)
+DEFAULT_DEPTH_PEELING = (True, False)
+
+# Layer usage, name: (video in layer 0, masked video in layer 2, model layers).
+# Models are spread over the model layers in turn.
+LAYER_SETUPS = {"standard": (True, False, (1,)),
+                "masked video": (True, True, (1, 3)),
+                "models only": (False, False, (1,))}
+DEFAULT_LAYERS = ("standard", "masked video")
+
+VIDEO_FRAMES = 4
+
+
+def _on_off(text):
+    if text.lower() in ("on", "true", "1"):
+        return True
+    if text.lower() in ("off", "false", "0"):
+        return False
+    raise argparse.ArgumentTypeError(f"Expected on or off, not {text}")
+
+
+def offscreen_support_error():
+    """
+    Returns why VTK cannot render here, or None if it can: with a display,
+    or without one through EGL or OSMesa.
+    """
+    import vtk  # pylint: disable=import-outside-toplevel
+
+    if os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"):
+        return None
+    if hasattr(vtk, "vtkEGLRenderWindow") or hasattr(vtk, "vtkOSMesaRenderWindow"):
+        return None
+    return (f"VTK {vtk.vtkVersion.GetVTKVersion()} renders through X only and there "
+            "is no display. Install VTK 9.4 or later (EGL) or vtk-osmesa, "
+            "or run with a display, e.g. under xvfb-run.")
+
+
+def make_mesh(triangles):
+    """
+    Returns a sphere polydata with about the given number of triangles.
+    """
+    import vtk  # pylint: disable=import-outside-toplevel
+
+    # A sphere of theta by phi resolution has 2 * theta * (phi - 2) triangles.
+    phi = max(4, int(round((triangles / 4.0) ** 0.5)))
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(20.0)
+    sphere.SetThetaResolution(2 * phi)
+    sphere.SetPhiResolution(phi)
+    sphere.Update()
+    return sphere.GetOutput()
+
+
+def make_video_frames(resolution, rng):
+    """
+    Returns VIDEO_FRAMES random BGR frames, so uploads are not of one
+    unchanged image.
+    """
+    width, height = resolution
+    return [rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            for _ in range(VIDEO_FRAMES)]
+
+
+def add_models(window, mesh, model_count, opacity, model_layers):
+    """
+    Adds model_count actors of mesh, each with its own mapper as loaded
+    models have, on a grid in front of the camera.
+    """
+    import vtk  # pylint: disable=import-outside-toplevel
+
+    columns = int(np.ceil(np.sqrt(model_count)))
+    for index in range(model_count):
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(mesh)
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        row, column = divmod(index, columns)
+        actor.SetPosition(50.0 * (column - (columns - 1) / 2.0),
+                          50.0 * (row - (columns - 1) / 2.0),
+                          400.0 + 10.0 * index)
+        actor.GetProperty().SetColor(1.0, 0.2 + 0.6 * (index % 2), 0.2)
+        actor.GetProperty().SetOpacity(opacity)
+        window.add_vtk_actor(actor, layer=model_layers[index % len(model_layers)])
+
+
+def run_configuration(resolution, model_count, triangles, opacity,
+                      depth_peeling, layers, frames=30, warmup=3, seed=0):
+    """
+    Renders one configuration offscreen and measures it.
+
+    :returns: dict of results for the configuration.
+    """
+    from lib.overlay_window import VTKOverlayWindow  # pylint: disable=import-outside-toplevel
+
+    video_in_layer_0, video_in_layer_2, model_layers = LAYER_SETUPS[layers]
+    width, height = resolution
+    window = VTKOverlayWindow(offscreen=True, init_widget=False,
+                              video_in_layer_0=video_in_layer_0,
+                              video_in_layer_2=video_in_layer_2,
+                              use_depth_peeling=depth_peeling,
+                              reset_camera=False)
+    render_window = window.GetRenderWindow()
+    # The widget is never shown, so size both it and its render window.
+    window.resize(width, height)
+    render_window.SetSize(width, height)
+
+    rng = np.random.default_rng(seed)
+    video_frames = make_video_frames(resolution, rng)
+    if video_in_layer_2:
+        mask = np.zeros((height, width, 1), dtype=np.uint8)
+        mask[height // 4:3 * height // 4, width // 4:3 * width // 4] = 255
+        window.set_video_mask(mask)
+    window.set_video_image(video_frames[0])
+    window.set_camera_matrix(camera_matrix_for(resolution).astype(float))
+    window.set_camera_pose(np.eye(4))
+
+    mesh = make_mesh(triangles)
+    add_models(window, mesh, model_count, opacity, model_layers)
+
+    times = {"set_video_image": [], "Render": [],
+             "convert_scene_to_numpy_array": [], "frame": []}
+    for index in range(warmup + frames):
+        frame_start = time.perf_counter()
+        window.set_video_image(video_frames[index % VIDEO_FRAMES])
+        uploaded = time.perf_counter()
+        render_window.Render()
+        rendered = time.perf_counter()
+        window.convert_scene_to_numpy_array(rerender=False)
+        read_back = time.perf_counter()
+        if index < warmup:
+            continue
+        times["set_video_image"].append(uploaded - frame_start)
+        times["Render"].append(rendered - uploaded)
+        times["convert_scene_to_numpy_array"].append(read_back - rendered)
+        times["frame"].append(read_back - frame_start)
+
+    multisamples = render_window.GetMultiSamples()
+    renderer = render_window.ReportCapabilities().split("OpenGL renderer string:")
+    opengl_renderer = renderer[1].splitlines()[0].strip() if len(renderer) > 1 else None
+    render_window.Finalize()
+    window.deleteLater()
+
+    frame_mean = float(np.mean(times["frame"])) if times["frame"] else 0.0
+    return {"resolution": [width, height],
+            "models": model_count,
+            "triangles per model": mesh.GetNumberOfPolys(),
+            "triangles": model_count * mesh.GetNumberOfPolys(),
+            "opacity": opacity,
+            "depth peeling": depth_peeling,
+            # Depth peeling turns multisampling off, without it the default stays.
+            "multisamples": multisamples,
+            "layers": layers,
+            "frames": frames,
+            "fps": 1.0 / frame_mean if frame_mean > 0 else None,
+            "latency ms": {name: summarise(samples, 1000.0)
+                           for name, samples in times.items()},
+            "opengl renderer": opengl_renderer}
+
+
+def run_benchmark(resolutions=DEFAULT_RESOLUTIONS, model_counts=DEFAULT_MODEL_COUNTS,
+                  triangles=DEFAULT_TRIANGLES, opacities=DEFAULT_OPACITIES,
+                  depth_peeling=DEFAULT_DEPTH_PEELING, layers=DEFAULT_LAYERS,
+                  frames=30, warmup=3, seed=0, output=None):
+    """
+    Runs every combination of the settings and writes JSON results.
+
+    :returns: the results as a dict.
+    """
+    import vtk  # pylint: disable=import-outside-toplevel
+    from PySide6.QtWidgets import QApplication  # pylint: disable=import-outside-toplevel
+
+    # Kept referenced while the windows exist.
+    _application = QApplication.instance() or QApplication([])
+
+    scenarios = []
+    for resolution, model_count, triangle_count, opacity, peeling, layer_setup \
+            in itertools.product(resolutions, model_counts, triangles, opacities,
+                                 depth_peeling, layers):
+        result = run_configuration(resolution, model_count, triangle_count, opacity,
+                                   peeling, layer_setup, frames, warmup, seed)
+        scenarios.append(result)
+        latency = result["latency ms"]
+        print(f"{resolution[0]}x{resolution[1]} {model_count:>3} x {triangle_count:>8} "
+              f"opacity {opacity:.2f} peeling {'on ' if peeling else 'off'} "
+              f"{layer_setup:>12}: {result['fps']:.1f} fps, "
+              f"upload {latency['set_video_image']['p50']:.2f} ms, "
+              f"render {latency['Render']['p50']:.2f} ms, "
+              f"readback {latency['convert_scene_to_numpy_array']['p50']:.2f} ms")
+
+    settings = {"resolutions": [list(resolution) for resolution in resolutions],
+                "model counts": list(model_counts),
+                "triangles": list(triangles),
+                "opacities": list(opacities),
+                "depth peeling": list(depth_peeling),
+                "layers": list(layers),
+                "frames": frames, "warmup": warmup, "seed": seed}
+    opengl_renderers = sorted({str(scenario["opengl renderer"]) for scenario in scenarios})
+    return write_results(output, "overlay rendering", settings, scenarios,
+                         {"vtk": vtk.vtkVersion.GetVTKVersion(),
+                          "opengl renderer": ", ".join(opengl_renderers),
+                          "qt platform": os.environ.get("QT_QPA_PLATFORM")})
+
+
+def main(args=None):
+    """
+    Entry point, see --help.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark offscreen rendering of VTKOverlayWindow.")
+    parser.add_argument("--resolutions", type=_parse_resolution, nargs="+",
+                        default=list(DEFAULT_RESOLUTIONS),
+                        help="video sizes, e.g. 640x480 1920x1080")
+    parser.add_argument("--model-counts", type=int, nargs="+",
+                        default=list(DEFAULT_MODEL_COUNTS))
+    parser.add_argument("--triangles", type=int, nargs="+",
+                        default=list(DEFAULT_TRIANGLES),
+                        help="approximate triangles per model")
+    parser.add_argument("--opacities", type=float, nargs="+",
+                        default=list(DEFAULT_OPACITIES))
+    parser.add_argument("--depth-peeling", type=_on_off, nargs="+",
+                        default=list(DEFAULT_DEPTH_PEELING), help="on, off or both")
+    parser.add_argument("--layers", nargs="+", choices=sorted(LAYER_SETUPS),
+                        default=list(DEFAULT_LAYERS), help="layer usage")
+    parser.add_argument("--frames", type=int, default=30,
+                        help="frames measured per configuration")
+    parser.add_argument("--warmup", type=int, default=3,
+                        help="frames rendered before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="rendering_benchmark.json",
+                        help="JSON results file")
+    parsed = parser.parse_args(args)
+
+    # No display is needed; Qt only provides the widget VTK renders for.
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    error = offscreen_support_error()
+    if error:
+        parser.exit(1, f"{error}\n")
+    run_benchmark(parsed.resolutions, parsed.model_counts, parsed.triangles,
+                  parsed.opacities, parsed.depth_peeling, parsed.layers,
+                  parsed.frames, parsed.warmup, parsed.seed, parsed.output)
+
+
+if __name__ == "__main__":
+    main()
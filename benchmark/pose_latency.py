@@ -0,0 +1,138 @@
+"""
+Subscriber test client for the pose publisher, measuring how long poses
+take to arrive.
+
+Connects to a PosePublisher, e.g. the overlay started with
+OVERLAY_POSE_ADDRESS=tcp://*:5556, and records for every message the
+delivery latency (send to receive) and the end to end latency (tracking
+timestamp to receive), plus message sizes and frames skipped: gaps in the
+frame numbers, from frames without tags or dropped by conflation. With
+--self-test it publishes synthetic poses itself at --rate, so the
+transport can be measured on its own. Results are written as JSON.
+
+Usage::
+
+    python -m benchmark.pose_latency tcp://127.0.0.1:5556 --duration 10
+    python -m benchmark.pose_latency --self-test --rate 120
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmark.results import summarise, write_results
+from lib.pose_publisher import PosePublisher, PoseSubscriber
+
+
+def publish_synthetic(publisher, rate, stop, tags=3):
+    """
+    Publishes tags random poses per frame at rate frames per second until
+    stop is set.
+    """
+    port_handles = [f"DICT_4X4_50:{tag}" for tag in range(tags)]
+    poses = np.tile(np.eye(4), (tags, 1, 1))
+    qualities = np.ones(tags)
+    frame_number = 0
+    next_frame = time.perf_counter()
+    while not stop.is_set():
+        poses[:, 0:3, 3] = np.random.uniform(-100.0, 100.0, (tags, 3))
+        publisher.write_frame(port_handles, time.time(), frame_number, poses,
+                              qualities)
+        frame_number += 1
+        next_frame += 1.0 / rate
+        stop.wait(max(0.0, next_frame - time.perf_counter()))
+
+
+def measure(subscriber, duration, max_messages=None):
+    """
+    Receives messages for duration seconds and returns the measurements.
+    """
+    delivery = []
+    end_to_end = []
+    sizes = []
+    frames = 0
+    skipped = 0
+    last_frame = None
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if max_messages is not None and len(sizes) >= max_messages:
+            break
+        message = subscriber.receive(timeout=max(0.0, deadline - time.perf_counter()))
+        if message is None:
+            break
+        received = time.time()
+        sent_time, records = message
+        delivery.append(received - sent_time)
+        end_to_end.extend(received - records["timestamp"])
+        sizes.append(records.nbytes)
+
+        frame_numbers = np.unique(records["frame_number"])
+        frames += len(frame_numbers)
+        if last_frame is not None and len(frame_numbers):
+            skipped += max(0, int(frame_numbers[0]) - last_frame - 1)
+        if len(frame_numbers):
+            last_frame = int(frame_numbers[-1])
+
+    return {"messages": len(sizes),
+            "frames": frames,
+            "frames skipped": skipped,
+            "delivery latency ms": summarise(delivery, 1000.0),
+            "end to end latency ms": summarise(end_to_end, 1000.0),
+            "record bytes per message": summarise(sizes)}
+
+
+def main(args=None):
+    """
+    Entry point, see --help.
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure pose delivery latency from a PosePublisher.")
+    parser.add_argument("address", nargs="?", default="tcp://127.0.0.1:5556",
+                        help="publisher address to connect to")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to measure for")
+    parser.add_argument("--no-conflate", action="store_true",
+                        help="receive every message instead of only the latest")
+    parser.add_argument("--self-test", action="store_true",
+                        help="publish synthetic poses from this process")
+    parser.add_argument("--rate", type=float, default=60.0,
+                        help="frames per second published by --self-test")
+    parser.add_argument("--batch-frames", type=int, default=1,
+                        help="frames per message published by --self-test")
+    parser.add_argument("--output", default="pose_latency.json",
+                        help="JSON results file")
+    parsed = parser.parse_args(args)
+    conflate = not parsed.no_conflate
+
+    publisher = None
+    stop = threading.Event()
+    if parsed.self_test:
+        publisher = PosePublisher(parsed.address, conflate=conflate,
+                                  batch_frames=parsed.batch_frames)
+        threading.Thread(target=publish_synthetic,
+                         args=(publisher, parsed.rate, stop), daemon=True).start()
+
+    with PoseSubscriber(parsed.address, conflate=conflate) as subscriber:
+        result = measure(subscriber, parsed.duration)
+    stop.set()
+    if publisher is not None:
+        result["publisher"] = publisher.stats()
+        publisher.close()
+
+    delivery = result["delivery latency ms"]
+    if delivery["count"]:
+        print(f"{result['messages']} messages, {result['frames skipped']} frames skipped, "
+              f"delivery p50 {delivery['p50']:.3f} ms, p99 {delivery['p99']:.3f} ms")
+    else:
+        print(f"No poses received from {parsed.address}")
+    settings = {"address": parsed.address, "duration": parsed.duration,
+                "conflate": conflate, "self test": parsed.self_test,
+                "rate": parsed.rate if parsed.self_test else None,
+                "batch frames": parsed.batch_frames if parsed.self_test else None}
+    write_results(parsed.output, "pose latency", settings, [result])
+
+
+if __name__ == "__main__":
+    main()
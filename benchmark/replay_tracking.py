@@ -0,0 +1,129 @@
+"""
+Tracking benchmark on a recorded video, replayed without decoding.
+
+The recording is converted once to a raw frame sequence (see
+lib.modified_video_source.convert_video_to_raw) and every run replays the
+same frames through ArUcoTracker.get_frame, so results are repeatable and
+not limited by video decoding. Throughput, per stage latency and the
+fraction of frames with a tag detected are written as JSON.
+
+Usage::
+
+    python -m benchmark.replay_tracking recording.avi --output replay.json
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from benchmark.results import summarise, write_results
+from benchmark.synthetic_tracking import camera_matrix_for
+from lib.arucotracker import ArUcoTracker
+from lib.modified_video_source import RawFrameSequenceSource, \
+    convert_video_to_raw, is_raw_sequence
+
+
+def prepare_sequence(recording, raw_file=None):
+    """
+    Returns a raw sequence for recording, converting it if it is a video
+    file and the raw sequence does not exist yet.
+    """
+    if is_raw_sequence(recording):
+        return recording
+    raw_file = raw_file or os.path.splitext(recording)[0] + ".npy"
+    if not os.path.isfile(raw_file):
+        frames = convert_video_to_raw(recording, raw_file)
+        print(f"Converted {frames} frames to {raw_file}")
+    return raw_file
+
+
+def run_replay(raw_file, marker_size=50.0, dictionary_name="DICT_4X4_50",
+               calibration=None, repeats=1, configuration=None):
+    """
+    Tracks every frame of a raw sequence, repeats times.
+
+    :param calibration: calibration text file for the camera, otherwise a
+        camera matrix is guessed from the frame size.
+    :returns: dict of results.
+    """
+    source = RawFrameSequenceSource(raw_file)
+    height, width = source.frames.shape[1:3]
+
+    ar_config = {"tracker type": "aruco",
+                 "video source": 'none',
+                 "debug": False,
+                 "aruco dictionary": dictionary_name,
+                 "marker size": marker_size,
+                 "camera projection": camera_matrix_for((width, height)),
+                 "camera distortion": np.zeros((1, 5), np.float32)}
+    ar_config.update(configuration or {})
+    tracker = ArUcoTracker(ar_config)
+    if calibration:
+        tracker.load_calibration(calibration)
+    tracker.start_tracking()
+
+    totals = []
+    stages = {}
+    tracked_frames = 0
+    started = time.perf_counter()
+    for _ in range(repeats):
+        source.seek(0)
+        while True:
+            ok, frame, _ = source.read()
+            if not ok:
+                break
+            frame_start = time.perf_counter()
+            port_handles, _, _, _, _ = tracker.get_frame(frame)
+            totals.append(time.perf_counter() - frame_start)
+            for stage, seconds in tracker.get_stage_times().items():
+                stages.setdefault(stage, []).append(seconds)
+            if port_handles:
+                tracked_frames += 1
+    elapsed = time.perf_counter() - started
+    tracker.close()
+    source.release()
+
+    latency = {stage: summarise(samples, 1000.0)
+               for stage, samples in stages.items()}
+    latency["total"] = summarise(totals, 1000.0)
+    return {"name": os.path.basename(raw_file),
+            "resolution": [int(width), int(height)],
+            "frames": len(totals),
+            "throughput fps": len(totals) / elapsed if elapsed > 0 else None,
+            "latency ms": latency,
+            "tracked fraction": tracked_frames / len(totals) if totals else None}
+
+
+def main(args=None):
+    """
+    Entry point, see --help.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark ArUcoTracker on a replayed recording.")
+    parser.add_argument("recording", help="video file or raw .npy sequence")
+    parser.add_argument("--raw-file",
+                        help="where to write the raw sequence for a video")
+    parser.add_argument("--calibration", help="camera calibration text file")
+    parser.add_argument("--marker-size", type=float, default=50.0,
+                        help="tag size in mm")
+    parser.add_argument("--dictionary", default="DICT_4X4_50")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", default="replay_benchmark.json",
+                        help="JSON results file")
+    parsed = parser.parse_args(args)
+
+    raw_file = prepare_sequence(parsed.recording, parsed.raw_file)
+    result = run_replay(raw_file, parsed.marker_size, parsed.dictionary,
+                        parsed.calibration, parsed.repeats)
+    print(f"{result['name']}: {result['throughput fps']:.1f} fps, "
+          f"tracked {result['tracked fraction']:.3f}")
+    settings = {"recording": parsed.recording, "marker size": parsed.marker_size,
+                "aruco dictionary": parsed.dictionary,
+                "calibration": parsed.calibration, "repeats": parsed.repeats}
+    write_results(parsed.output, "replay tracking", settings, [result])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Helpers shared by the benchmarks for summarising and saving results."""
+
+import json
+import platform
+import sys
+from datetime import datetime
+
+import numpy as np
+
+
+def summarise(samples, scale=1.0):
+    """
+    Summarises a list of samples as mean, p50, p99 and max.
+
+    :param samples: list of numbers, e.g. durations in seconds.
+    :param scale: multiplier applied to every statistic, e.g. 1000 for ms.
+    :returns: dict, with None values if there are no finite samples.
+    """
+    values = np.asarray(samples, dtype=float)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {"count": 0, "mean": None, "p50": None, "p99": None,
+                "max": None}
+    return {"count": int(values.size),
+            "mean": float(np.mean(values) * scale),
+            "p50": float(np.percentile(values, 50) * scale),
+            "p99": float(np.percentile(values, 99) * scale),
+            "max": float(np.max(values) * scale)}
+
+
+def environment():
+    """
+    Returns versions of the interpreter and libraries a result depends on.
+    """
+    import cv2  # pylint: disable=import-outside-toplevel
+
+    return {"python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__}
+
+
+def write_results(filename, benchmark, configuration, scenarios,
+                  extra_environment=None):
+    """
+    Writes benchmark results to a JSON file, so runs can be compared.
+
+    :param filename: output file, or None to only return the results.
+    :param benchmark: name of the benchmark.
+    :param configuration: dict of the settings the run used.
+    :param scenarios: list of dicts, one per measured configuration.
+    :param extra_environment: optional dict added to the environment block.
+    :returns: the results as a dict.
+    """
+    env = environment()
+    if extra_environment:
+        env.update(extra_environment)
+
+    results = {"benchmark": benchmark,
+               "created": datetime.now().isoformat(timespec="seconds"),
+               "environment": env,
+               "configuration": configuration,
+               "scenarios": scenarios}
+
+    if filename:
+        with open(filename, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
+    return results
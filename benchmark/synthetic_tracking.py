@@ -0,0 +1,283 @@
+"""
+Tracking benchmark on synthetic frames with known ground truth poses.
+
+ArUco tags from cv2.aruco.generateImageMarker are warped into frames at
+known 6-DoF poses, optionally with noise, blur and several tags per frame,
+and passed through ArUcoTracker.get_frame. Throughput, per stage latency,
+detection recall and pose error are written as JSON.
+
+Usage::
+
+    python -m benchmark.synthetic_tracking --frames 200 --output tracking.json
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+from cv2 import aruco
+
+from benchmark.results import summarise, write_results
+from lib.arucotracker import ArUcoTracker
+
+DEFAULT_RESOLUTIONS = ((640, 480), (1280, 720), (1920, 1080))
+
+# name, noise sigma (grey levels), blur sigma (pixels), tags per frame
+DEFAULT_CONDITIONS = (("clean", 0.0, 0.0, 1),
+                      ("noise", 8.0, 0.0, 1),
+                      ("blur", 0.0, 1.5, 1),
+                      ("multi tag", 4.0, 0.8, 3))
+
+
+def camera_matrix_for(resolution):
+    """
+    Returns a plausible 3x3 camera matrix for an image size.
+    """
+    width, height = resolution
+    focal = 0.9 * width
+    return np.array([[focal, 0.0, width / 2.0],
+                     [0.0, focal, height / 2.0],
+                     [0.0, 0.0, 1.0]], dtype=np.float32)
+
+
+def tag_corners(marker_size):
+    """
+    Returns the 3D corners of a tag, in the order and axes of
+    cv2.aruco.estimatePoseSingleMarkers, which ArUcoTracker uses for single
+    tags, so tag to camera poses compare directly.
+    """
+    half = marker_size / 2.0
+    return np.array([[-half, half, 0.0], [half, half, 0.0],
+                     [half, -half, 0.0], [-half, -half, 0.0]],
+                    dtype=np.float32)
+
+
+def random_pose(rng, camera_matrix, resolution, marker_size):
+    """
+    Returns a random tag to camera transform (4x4) with the tag in view.
+    """
+    width, height = resolution
+    distance = rng.uniform(6.0, 14.0) * marker_size
+    # Keep the tag centre inside the middle 60% of the image.
+    pixel = np.array([rng.uniform(0.2, 0.8) * width,
+                      rng.uniform(0.2, 0.8) * height, 1.0])
+    ray = np.linalg.inv(camera_matrix.astype(float)) @ pixel
+    translation = ray / ray[2] * distance
+
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    angle = np.radians(rng.uniform(0.0, 40.0))
+    rotation, _ = cv2.Rodrigues(axis * angle)
+    # Tag z points away from the camera, so start from a flip about x.
+    rotation = rotation @ np.diag([1.0, -1.0, -1.0])
+
+    pose = np.eye(4)
+    pose[0:3, 0:3] = rotation
+    pose[0:3, 3] = translation
+    return pose
+
+
+def render_frame(resolution, tags, camera_matrix, marker_size, dictionary,
+                 noise_sigma=0.0, blur_sigma=0.0, rng=None,
+                 marker_pixels=200):
+    """
+    Renders a BGR frame with each tag warped to its pose.
+
+    :param tags: list of (marker id, 4x4 tag to camera transform).
+    :returns: uint8 image, height x width x 3.
+    """
+    width, height = resolution
+    frame = np.full((height, width), 255, dtype=np.uint8)
+    distortion = np.zeros(5)
+
+    source = np.array([[-0.5, -0.5], [marker_pixels - 0.5, -0.5],
+                       [marker_pixels - 0.5, marker_pixels - 0.5],
+                       [-0.5, marker_pixels - 0.5]], dtype=np.float32)
+    for marker_id, pose in tags:
+        marker = aruco.generateImageMarker(dictionary, int(marker_id),
+                                           marker_pixels)
+        rvec, _ = cv2.Rodrigues(pose[0:3, 0:3])
+        projected, _ = cv2.projectPoints(tag_corners(marker_size), rvec,
+                                         pose[0:3, 3], camera_matrix,
+                                         distortion)
+        homography = cv2.getPerspectiveTransform(
+            source, projected.reshape(4, 2).astype(np.float32))
+        warped = cv2.warpPerspective(marker, homography, (width, height),
+                                     flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(np.full_like(marker, 255), homography,
+                                   (width, height), flags=cv2.INTER_LINEAR)
+        np.copyto(frame, warped, where=mask > 127)
+
+    if blur_sigma > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur_sigma)
+    if noise_sigma > 0:
+        rng = rng if rng is not None else np.random.default_rng()
+        noisy = frame + rng.normal(0.0, noise_sigma, frame.shape)
+        frame = np.clip(noisy, 0, 255).astype(np.uint8)
+
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def make_scenario(rng, resolution, tags_per_frame, frames, marker_size,
+                  dictionary_size):
+    """
+    Returns a list of frames, each a list of (marker id, pose).
+    Tags in a frame have distinct ids and may overlap.
+    """
+    camera_matrix = camera_matrix_for(resolution)
+    scenario = []
+    for _ in range(frames):
+        ids = rng.choice(dictionary_size, size=tags_per_frame, replace=False)
+        scenario.append([(int(marker_id),
+                          random_pose(rng, camera_matrix, resolution,
+                                      marker_size))
+                         for marker_id in ids])
+    return scenario
+
+
+def pose_errors(estimate, truth):
+    """
+    Returns translation error (mm) and rotation error (degrees).
+    """
+    translation = float(np.linalg.norm(estimate[0:3, 3] - truth[0:3, 3]))
+    relative = estimate[0:3, 0:3].T @ truth[0:3, 0:3]
+    cos_angle = np.clip((np.trace(relative) - 1.0) / 2.0, -1.0, 1.0)
+    return translation, float(np.degrees(np.arccos(cos_angle)))
+
+
+def run_scenario(name, resolution, noise_sigma, blur_sigma, tags_per_frame,
+                 frames=100, marker_size=50.0,
+                 dictionary_name="DICT_4X4_50", seed=0, configuration=None):
+    """
+    Renders one scenario and measures the tracker on it.
+
+    :param configuration: extra ArUcoTracker configuration, e.g.
+        detector parameters or a smoothing buffer.
+    :returns: dict of results for the scenario.
+    """
+    rng = np.random.default_rng(seed)
+    dictionary = aruco.getPredefinedDictionary(getattr(aruco, dictionary_name))
+    dictionary_size = dictionary.bytesList.shape[0]
+    camera_matrix = camera_matrix_for(resolution)
+
+    scenario = make_scenario(rng, resolution, tags_per_frame, frames,
+                             marker_size, dictionary_size)
+    images = [render_frame(resolution, tags, camera_matrix, marker_size,
+                           dictionary, noise_sigma, blur_sigma, rng)
+              for tags in scenario]
+
+    ar_config = {"tracker type": "aruco",
+                 "video source": 'none',
+                 "debug": False,
+                 "aruco dictionary": dictionary_name,
+                 "marker size": marker_size,
+                 "camera projection": camera_matrix,
+                 "camera distortion": np.zeros((1, 5), np.float32)}
+    ar_config.update(configuration or {})
+    tracker = ArUcoTracker(ar_config)
+    tracker.start_tracking()
+
+    totals = []
+    stages = {}
+    detected = 0
+    expected = 0
+    translation_errors = []
+    rotation_errors = []
+
+    started = time.perf_counter()
+    for tags, image in zip(scenario, images):
+        frame_start = time.perf_counter()
+        port_handles, _, _, tracking, _ = tracker.get_frame(image)
+        totals.append(time.perf_counter() - frame_start)
+        for stage, seconds in tracker.get_stage_times().items():
+            stages.setdefault(stage, []).append(seconds)
+
+        results = dict(zip(port_handles, tracking))
+        for marker_id, truth in tags:
+            expected += 1
+            estimate = results.get(f"{dictionary_name}:{marker_id}")
+            if estimate is None or not np.all(np.isfinite(estimate)):
+                continue
+            detected += 1
+            translation_error, rotation_error = pose_errors(estimate, truth)
+            translation_errors.append(translation_error)
+            rotation_errors.append(rotation_error)
+    elapsed = time.perf_counter() - started
+    tracker.close()
+
+    latency = {stage: summarise(samples, 1000.0)
+               for stage, samples in stages.items()}
+    latency["total"] = summarise(totals, 1000.0)
+
+    return {"name": name,
+            "resolution": list(resolution),
+            "noise sigma": noise_sigma,
+            "blur sigma": blur_sigma,
+            "tags per frame": tags_per_frame,
+            "frames": frames,
+            "throughput fps": frames / elapsed if elapsed > 0 else None,
+            "latency ms": latency,
+            "recall": detected / expected if expected else None,
+            "translation error mm": summarise(translation_errors),
+            "rotation error deg": summarise(rotation_errors)}
+
+
+def run_benchmark(resolutions=DEFAULT_RESOLUTIONS,
+                  conditions=DEFAULT_CONDITIONS, frames=100,
+                  marker_size=50.0, dictionary_name="DICT_4X4_50", seed=0,
+                  configuration=None, output=None):
+    """
+    Runs every condition at every resolution and writes JSON results.
+
+    :returns: the results as a dict.
+    """
+    scenarios = []
+    for resolution in resolutions:
+        for name, noise_sigma, blur_sigma, tags_per_frame in conditions:
+            result = run_scenario(name, resolution, noise_sigma, blur_sigma,
+                                  tags_per_frame, frames, marker_size,
+                                  dictionary_name, seed, configuration)
+            scenarios.append(result)
+            print(f"{name:>10} {resolution[0]}x{resolution[1]}: "
+                  f"{result['throughput fps']:.1f} fps, "
+                  f"recall {result['recall']:.3f}")
+
+    settings = {"frames": frames, "marker size": marker_size,
+                "aruco dictionary": dictionary_name, "seed": seed,
+                "tracker configuration": {key: str(value) for key, value
+                                          in (configuration or {}).items()}}
+    return write_results(output, "synthetic tracking", settings, scenarios)
+
+
+def _parse_resolution(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(args=None):
+    """
+    Entry point, see --help.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark ArUcoTracker on synthetic frames.")
+    parser.add_argument("--frames", type=int, default=100,
+                        help="frames per scenario")
+    parser.add_argument("--resolutions", type=_parse_resolution, nargs="+",
+                        default=list(DEFAULT_RESOLUTIONS),
+                        help="e.g. 640x480 1920x1080")
+    parser.add_argument("--marker-size", type=float, default=50.0,
+                        help="tag size in mm")
+    parser.add_argument("--dictionary", default="DICT_4X4_50")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="tracking_benchmark.json",
+                        help="JSON results file")
+    parsed = parser.parse_args(args)
+
+    run_benchmark(parsed.resolutions, DEFAULT_CONDITIONS, parsed.frames,
+                  parsed.marker_size, parsed.dictionary, parsed.seed,
+                  output=parsed.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Per frame allocation profiling of the live pipeline, to find memory creep
+in long sessions.
+
+Set OVERLAY_ALLOCATION_PROFILE=1 to start the overlay with tracemalloc on
+and print a report to stderr every OVERLAY_ALLOCATION_INTERVAL frames
+(600 by default), or set it to a file name to write the report there.
+Ctrl+Shift+M in the overlay switches profiling on and off while running.
+
+Each LatencyMonitor stage of update_view (get_frame, upload, ...), the
+capture thread's read and the render are measured as stages::
+
+    with allocation_profiler.stage("get_frame"):
+        result = tracker.get_frame(image)
+    ...
+    allocation_profiler.end_frame()
+
+A stage's "allocated" bytes are the traced memory peak above its start,
+its "retained" bytes what is still allocated at its end. Growth not
+retained by any stage, e.g. by Qt callbacks, is reported as "outside
+stages". Every report also fits the steady state growth in bytes per
+frame and lists the allocation sites that grew most since the last
+report. tracemalloc traces Python objects and numpy arrays, including
+those OpenCV returns, but not memory VTK or OpenCV allocate internally.
+
+Stages on other threads overlap with those of the GUI thread, so their
+bytes are approximate, and only GUI thread stages measure a peak. When
+profiling is off, stage() and end_frame() return at once.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+OUTSIDE_STAGES = "outside stages"
+
+# Left out of the allocation sites, including the profiler's own bookkeeping.
+_IGNORED_FILES = (__file__, tracemalloc.__file__, "<frozen importlib._bootstrap>",
+                  "<frozen importlib._bootstrap_external>", "<unknown>")
+
+
+class StageAllocations:
+    """
+    Running totals of one stage's allocations, in bytes.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.allocated = 0
+        self.retained = 0
+        self.max_allocated = 0
+
+    def add(self, allocated, retained):
+        self.calls += 1
+        self.allocated += allocated
+        self.retained += retained
+        self.max_allocated = max(self.max_allocated, allocated)
+
+
+class AllocationProfiler:
+    """
+    Attributes traced memory to pipeline stages per frame and reports
+    steady state growth and the allocation sites behind it.
+
+    :param report_interval: frames between reports, 0 for none until
+        disable().
+    :param top: allocation sites listed per report.
+    :param traceback_frames: frames stored per allocation; 1 is cheapest,
+        more tell callers apart.
+    :param warmup_frames: frames after enabling left out of the growth fit,
+        while caches and pools fill.
+    """
+    def __init__(self, enabled=False, report_file=None, report_interval=600,
+                 top=10, traceback_frames=1, warmup_frames=100):
+        self.enabled = False
+        self.report_file = report_file
+        self.report_interval = report_interval
+        self.top = top
+        self.traceback_frames = traceback_frames
+        self.warmup_frames = warmup_frames
+        self.stages = {}
+        self.frames = 0
+        self.reports = 0
+        self._frame_retained = 0
+        self._last_frame_memory = 0
+        self._growth_sums = None
+        self._snapshot = None
+        self._started = None
+        # True if enable() started tracemalloc, so disable() stops it.
+        self._started_tracing = False
+        # Held while enabling, disabling and measuring, so a stage ending on
+        # another thread never reads traced memory as tracing stops.
+        self._lock = threading.RLock()
+        if enabled:
+            self.enable()
+
+    @classmethod
+    def from_environment(cls, variable="OVERLAY_ALLOCATION_PROFILE",
+                         interval_variable="OVERLAY_ALLOCATION_INTERVAL"):
+        value = os.environ.get(variable, "")
+        report_interval = int(os.environ.get(interval_variable, 600))
+        if value in ("", "0"):
+            return cls(enabled=False, report_interval=report_interval)
+        return cls(enabled=True, report_file=None if value == "1" else value,
+                   report_interval=report_interval)
+
+    def enable(self):
+        """
+        Starts tracing and clears the statistics.
+        """
+        with self._lock:
+            if self.enabled:
+                return
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start(self.traceback_frames)
+            self.stages = {}
+            self.frames = 0
+            self._frame_retained = 0
+            self._last_frame_memory = tracemalloc.get_traced_memory()[0]
+            self._growth_sums = None
+            self._snapshot = self._take_snapshot()
+            self._started = time.perf_counter()
+            self.enabled = True
+
+    def disable(self):
+        """
+        Writes a final report, and stops tracing if enable() started it.
+        """
+        with self._lock:
+            if not self.enabled:
+                return
+            self.write_report()
+            self.enabled = False
+            self._snapshot = None
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def begin_stage(self):
+        """
+        Returns the token to pass to end_stage(), or None when off.
+        """
+        if not self.enabled:
+            return None
+        peak = threading.current_thread() is threading.main_thread()
+        with self._lock:
+            if not self.enabled:
+                return None
+            start = tracemalloc.get_traced_memory()[0]
+            if peak:
+                tracemalloc.reset_peak()
+        return start, peak
+
+    def end_stage(self, name, token):
+        """
+        Adds the allocations since begin_stage() returned token to stage name.
+        """
+        if token is None:
+            return
+        start, peak = token
+        with self._lock:
+            if not self.enabled:
+                return
+            current, peak_memory = tracemalloc.get_traced_memory()
+            retained = current - start
+            allocated = max(peak_memory - start, retained, 0) if peak else max(retained, 0)
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageAllocations()
+            stage.add(allocated, retained)
+            self._frame_retained += retained
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring the enclosed block as stage name.
+        """
+        token = self.begin_stage()
+        try:
+            yield
+        finally:
+            self.end_stage(name, token)
+
+    def end_frame(self):
+        """
+        Completes a frame, e.g. once it is rendered, and reports every
+        report_interval frames.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if not self.enabled:
+                return
+            current = tracemalloc.get_traced_memory()[0]
+            outside = current - self._last_frame_memory - self._frame_retained
+            stage = self.stages.get(OUTSIDE_STAGES)
+            if stage is None:
+                stage = self.stages[OUTSIDE_STAGES] = StageAllocations()
+            stage.add(max(outside, 0), outside)
+            self._frame_retained = 0
+            self._last_frame_memory = current
+            self.frames += 1
+            if self.frames > self.warmup_frames:
+                self._add_growth_sample(current)
+            if self.report_interval and self.frames % self.report_interval == 0:
+                self.write_report()
+
+    def _add_growth_sample(self, memory):
+        # Running sums for a least squares line, so long sessions do not
+        # keep a sample per frame. Relative to the first sample for precision.
+        if self._growth_sums is None:
+            self._growth_sums = [memory, 0, 0.0, 0.0, 0.0, 0.0]
+        sums = self._growth_sums
+        x, y = float(sums[1]), float(memory - sums[0])
+        sums[1] += 1
+        sums[2] += x
+        sums[3] += y
+        sums[4] += x * y
+        sums[5] += x * x
+
+    def growth_per_frame(self):
+        """
+        Returns the steady state growth of traced memory in bytes per
+        frame after warm up, a least squares fit, or None if too few frames.
+        """
+        if self._growth_sums is None or self._growth_sums[1] < 2:
+            return None
+        _, count, sum_x, sum_y, sum_xy, sum_xx = self._growth_sums
+        return (count * sum_xy - sum_x * sum_y) / (count * sum_xx - sum_x * sum_x)
+
+    def _take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([tracemalloc.Filter(False, filename)
+                                       for filename in _IGNORED_FILES])
+
+    def report(self):
+        """
+        Returns the report as text, and makes the snapshot the top growth
+        sites of the next report are compared to.
+        """
+        elapsed = time.perf_counter() - self._started
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Allocation profile after {self.frames} frames, {elapsed:.0f} s: "
+                 f"{current / 1e6:.1f} MB traced, peak {peak / 1e6:.1f} MB"]
+
+        growth = self.growth_per_frame()
+        if growth is None:
+            lines.append("Steady state growth: not enough frames after warm up")
+        else:
+            frame_rate = self.frames / elapsed if elapsed > 0 else 0.0
+            lines.append(f"Steady state growth: {growth / 1e3:.2f} kB per frame, "
+                         f"{growth * frame_rate * 3600.0 / 1e6:.1f} MB per hour "
+                         f"at {frame_rate:.1f} fps")
+
+        lines += ["", "Per stage (kB per call, allocated / retained, max allocated):"]
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1].allocated,
+                            reverse=True)
+        for name, stage in stages:
+            calls = max(stage.calls, 1)
+            lines.append(f"  {stage.allocated / calls / 1e3:10.1f} "
+                         f"{stage.retained / calls / 1e3:10.2f} "
+                         f"{stage.max_allocated / 1e3:10.1f}  {name} ({stage.calls} calls)")
+
+        snapshot = self._take_snapshot()
+        if self._snapshot is not None:
+            lines += ["", f"Largest growth since the last report (top {self.top}):"]
+            for statistic in snapshot.compare_to(self._snapshot, "lineno")[:self.top]:
+                lines.append(f"  {statistic.size_diff / 1e3:+10.1f} kB "
+                             f"{statistic.count_diff:+7d} blocks  "
+                             f"{_site(statistic.traceback)}")
+        lines += ["", f"Largest allocation sites (top {self.top}):"]
+        for statistic in snapshot.statistics("lineno")[:self.top]:
+            lines.append(f"  {statistic.size / 1e3:10.1f} kB {statistic.count:7d} blocks  "
+                         f"{_site(statistic.traceback)}")
+        self._snapshot = snapshot
+        return "\n".join(lines) + "\n"
+
+    def write_report(self):
+        """
+        Writes the report to report_file, replacing the last one, or to
+        stderr.
+        """
+        if not self.enabled:
+            return
+        self.reports += 1
+        report = self.report()
+        if self.report_file:
+            with open(self.report_file, "w", encoding="utf-8") as report_file:
+                report_file.write(report)
+        else:
+            sys.stderr.write(report)
+
+
+def _site(traceback):
+    frame = traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
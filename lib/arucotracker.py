@@ -1,24 +1,74 @@
-from time import time
-from numpy import array, float32, loadtxt, ravel, float64
+import threading
+from time import time, perf_counter
+from numpy import array, float32, ravel, float64, zeros
 from cv2 import aruco
 import cv2
-from imshowtk.imshowtk import ImshowTk as Debugger
 
 from sksurgerycore.baseclasses.tracker import SKSBaseTracker
 from sksurgeryarucotracker.algorithms.rigid_bodies import ArUcoRigidBody, \
     configure_rigid_bodies
 
+from lib.motion_gate import MotionGate
+from lib.pose_history import PoseHistory, quaternions_to_rvecs
+from lib.undistortion import load_calibration
+
+
+def _make_detector_parameters(parameters):
+    detector_parameters = aruco.DetectorParameters()
+    for name, value in (parameters or {}).items():
+        if not hasattr(detector_parameters, name):
+            raise ValueError(f'Unknown ArUco detector parameter: {name}')
+        setattr(detector_parameters, name, value)
+    return detector_parameters
+
+
+class _NoDebugger:
+    # Stands in for imshowtk's ImshowTk when debugging is off, so tkinter
+    # is only imported when a debug window is wanted.
+    in_use = False
+
+    def imshow(self, _image):
+        pass
 
-def _load_calibration(textfile):
-    projection_matrix = loadtxt(textfile, dtype=float32, max_rows=3)
-    distortion = loadtxt(textfile, dtype=float32, skiprows=3, max_rows=1)
 
-    return projection_matrix, distortion
+def _make_debugger(in_use, subsample):
+    if not in_use:
+        return _NoDebugger()
+    from imshowtk.imshowtk import ImshowTk  # pylint: disable=import-outside-toplevel
+    return ImshowTk(in_use, subsample)
+
+
+def default_ar_config():
+    """
+    Returns the tracker configuration the overlay application starts with.
+    Shared with headless tracking, so both track the same way.
+    """
+    return {
+        "tracker type": "aruco",  # Specifies the type of tracker to use.
+        "video source": 'none',  # Frames are passed in to get_frame.
+        "debug": False,  # Debug mode is turned off.
+        "aruco dictionary": 'DICT_4X4_50',  # Specifies the dictionary of ArUco tags.
+        "marker size": 50,  # The size of the ArUco marker in mm.
+        "camera projection": array([[560.0, 0.0, 320.0],
+                                    [0.0, 560.0, 240.0],
+                                    [0.0, 0.0, 1.0]],
+                                   dtype=float32),  # Camera projection matrix.
+        "camera distortion": zeros((1, 4), float32)  # Camera distortion coefficients.
+    }
+
+
+def _load_calibration(textfile):
+    # Parsed once per file version, see lib.undistortion.load_calibration.
+    return load_calibration(textfile)
 
 
 class ArUcoTracker(SKSBaseTracker):
     def __init__(self, configuration):
 
+        # Guards everything get_frame reads, so the setters below can be
+        # called from another thread while tracking.
+        self._lock = threading.RLock()
+
         self._camera_projection_matrix = configuration.get("camera projection",
                                                            None)
         self._camera_distortion = configuration.get(
@@ -28,8 +78,11 @@ class ArUcoTracker(SKSBaseTracker):
 
         self._frame_number = 0
 
-        self._debug = Debugger(configuration.get("debug", False),
-                               configuration.get("debug subsample", 4))
+        # Seconds spent in each stage of the last get_frame call.
+        self._stage_times = {"detection": 0.0, "pose": 0.0, "smoothing": 0.0}
+
+        self._debug = _make_debugger(configuration.get("debug", False),
+                                     configuration.get("debug subsample", 4))
 
         video_source = configuration.get("video source", 0)
 
@@ -41,8 +94,25 @@ class ArUcoTracker(SKSBaseTracker):
         self._ar_dicts, self._ar_dict_names, self._rigid_bodies = \
             configure_rigid_bodies(configuration)
 
-        super().__init__(configuration, self._rigid_bodies)
+        # No tracked objects, so SKSBaseTracker makes no RollingMean buffers;
+        # its smoothing API is overridden below to use the pose history.
+        super().__init__(configuration, None)
+        # Smoothing history, used instead of SKSBaseTracker's buffers.
+        # Tags that are not part of a rigid body are forgotten after
+        # "history eviction frames" frames without being seen.
+        self._pose_history = PoseHistory(
+            self.buffer_size,
+            evict_after=configuration.get("history eviction frames", 30))
+        for rigid_body in self._rigid_bodies:
+            self._pose_history.add_handle(rigid_body.name, permanent=True)
         self._marker_size = configuration.get("marker size", 50)
+        self._detector_parameters = _make_detector_parameters(
+            configuration.get("detector parameters"))
+        # Optional "motion gate": detection is skipped, and the last poses
+        # reused, while the frame does not change. See lib.motion_gate.
+        self._motion_gate = MotionGate.from_config(
+            configuration.get("motion gate", False))
+        self._last_detection = None
 
         if "calibration" in configuration:
             self._camera_projection_matrix, self._camera_distortion = \
@@ -94,6 +164,16 @@ class ArUcoTracker(SKSBaseTracker):
         if frame is None:
             raise ValueError('End of video')
 
+        with self._lock:
+            return self._track_frame(frame)
+
+    def _track_frame(self, frame):
+        stage_start = perf_counter()
+        if self._motion_gate is not None:
+            moved = self._motion_gate.has_moved(frame)
+            if not moved and self._last_detection is not None:
+                return self._repeat_detection(stage_start)
+
         port_handles = []
         time_stamps = []
         frame_numbers = []
@@ -103,11 +183,15 @@ class ArUcoTracker(SKSBaseTracker):
         self._reset_rigid_bodies()
 
         timestamp = time()
+        checked = perf_counter()
 
         temporary_rigid_bodies = []
+        all_marker_corners = []
         for dict_index, ar_dict in enumerate(self._ar_dicts):
             marker_corners, marker_ids, _ = \
-                aruco.detectMarkers(frame, ar_dict)
+                aruco.detectMarkers(frame, ar_dict,
+                                    parameters=self._detector_parameters)
+            all_marker_corners.extend(marker_corners)
             if not marker_corners:
                 self._debug.imshow(frame)
                 continue
@@ -134,6 +218,7 @@ class ArUcoTracker(SKSBaseTracker):
                                                   marker_id)
                     temporary_rigid_bodies.append(temp_rigid_body)
 
+        detected = perf_counter()
         for rigid_body in self._rigid_bodies + temporary_rigid_bodies:
             rb_rot, rb_trans, rbquality = rigid_body.get_pose(
                 self._camera_projection_matrix,
@@ -145,13 +230,195 @@ class ArUcoTracker(SKSBaseTracker):
             tracking_trans.append(rb_trans)
             quality.append(rbquality)
 
-        self.add_frame_to_buffer(port_handles, time_stamps,
-                                 frame_numbers,
-                                 tracking_rots, tracking_trans, quality,
-                                 rot_is_quaternion=False)
+        posed = perf_counter()
+        if self._motion_gate is not None:
+            self._motion_gate.set_reference(all_marker_corners)
+            self._last_detection = (port_handles, tracking_rots,
+                                    tracking_trans, quality)
+        self._pose_history.add_frame(port_handles, time_stamps,
+                                     frame_numbers, tracking_rots,
+                                     tracking_trans, quality,
+                                     self._frame_number)
+
+        self._frame_number += 1
+        smooth_frame = self._pose_history.smooth(port_handles,
+                                                 self.use_quaternions)
+
+        self._stage_times = {"detection": detected - checked,
+                             "pose": posed - detected,
+                             "smoothing": perf_counter() - posed}
+        if self._motion_gate is not None:
+            self._stage_times["motion check"] = checked - stage_start
+        return smooth_frame
+
+    def _repeat_detection(self, stage_start):
+        # Nothing moved since the last detection, so its poses are added
+        # again and smoothing and eviction carry on as if they were found.
+        port_handles, tracking_rots, tracking_trans, quality = \
+            self._last_detection
+        timestamp = time()
+        checked = perf_counter()
+        self._pose_history.add_frame(port_handles,
+                                     [timestamp] * len(port_handles),
+                                     [self._frame_number] * len(port_handles),
+                                     tracking_rots, tracking_trans, quality,
+                                     self._frame_number)
 
         self._frame_number += 1
-        return self.get_smooth_frame(port_handles)
+        smooth_frame = self._pose_history.smooth(port_handles,
+                                                 self.use_quaternions)
+
+        self._stage_times = {"detection": 0.0, "pose": 0.0,
+                             "smoothing": perf_counter() - checked,
+                             "motion check": checked - stage_start}
+        return smooth_frame
+
+    def add_frame_to_buffer(self, port_handles, time_stamps, frame_numbers,
+                            tracking_rot, tracking_trans, quality,
+                            rot_is_quaternion=False):
+        """
+        Adds poses to the smoothing history, as SKSBaseTracker does to its
+        buffers. Rotations are OpenCV rvecs, or (w, x, y, z) quaternions if
+        rot_is_quaternion. Handles are evicted relative to the frame count
+        of get_frame, which this does not advance.
+        """
+        if rot_is_quaternion:
+            tracking_rot = quaternions_to_rvecs(tracking_rot)
+        with self._lock:
+            self._pose_history.add_frame(port_handles, time_stamps,
+                                         frame_numbers, tracking_rot,
+                                         tracking_trans, quality,
+                                         self._frame_number)
+
+    def get_smooth_frame(self, port_handles):
+        """
+        Returns the smoothed poses of port_handles from the smoothing
+        history, as the five lists of SKSBaseTracker.get_smooth_frame.
+
+        :raises: ValueError if a port handle has no history.
+        """
+        with self._lock:
+            missing = [handle for handle in port_handles
+                       if handle not in self._pose_history]
+            if missing:
+                raise ValueError(f"{missing[0]} not found in tracking buffers, "
+                                 "did you call add_frame_to_buffer first?")
+            return tuple(self._pose_history.smooth(port_handles,
+                                                   self.use_quaternions))
+
+    def get_stage_times(self):
+        """
+        Returns a dict of seconds spent in detection, pose estimation
+        and smoothing during the last call to get_frame, and in the motion
+        check if motion gating is on.
+        """
+        return dict(self._stage_times)
+
+    def set_motion_gate(self, config):
+        """
+        Turns motion gating on or off, with config as the "motion gate"
+        setting: False, True for the defaults, or a dict of MotionGate
+        parameters, e.g. {"refresh_interval": 30}.
+        """
+        motion_gate = MotionGate.from_config(config)
+        with self._lock:
+            self._motion_gate = motion_gate
+            self._last_detection = None
+
+    def get_motion_gate_stats(self):
+        """
+        Returns a dict with the frames checked and skipped by the motion
+        gate, or None if motion gating is off.
+        """
+        motion_gate = self._motion_gate
+        if motion_gate is None:
+            return None
+        return {"frames": motion_gate.frames,
+                "skipped": motion_gate.skipped,
+                "skip rate": motion_gate.skip_rate()}
+
+    def _invalidate_motion_gate(self):
+        # The last poses no longer hold after a setting changed.
+        if self._motion_gate is not None:
+            self._motion_gate.invalidate()
+
+    def set_marker_size(self, marker_size):
+        """
+        Sets the size in mm of tags not belonging to a rigid body.
+        Takes effect from the next frame, tracking state is kept.
+        """
+        if marker_size <= 0:
+            raise ValueError('Marker size must be > 0')
+        with self._lock:
+            self._marker_size = marker_size
+            self._invalidate_motion_gate()
+
+    def set_dictionary(self, dictionary_name):
+        """
+        Changes the default ArUco dictionary. Rigid bodies, smoothing
+        buffers and frame numbering are kept.
+        """
+        try:
+            ar_dict = aruco.getPredefinedDictionary(
+                getattr(aruco, dictionary_name))
+        except AttributeError:
+            raise ImportError((f'Failed when trying to import {dictionary_name}'
+                               'from cv2.aruco. Check dictionary exists.')) \
+                from AttributeError
+
+        with self._lock:
+            # The default dictionary is always first, followed by every
+            # dictionary a configured rigid body uses, which may include
+            # the previous default.
+            known = dict(zip(self._ar_dict_names, self._ar_dicts))
+            ar_dicts = [ar_dict]
+            ar_dict_names = [dictionary_name]
+            for rigid_body in self._rigid_bodies:
+                name = rigid_body.get_dictionary_name()
+                if name in ar_dict_names:
+                    continue
+                other_dict = known.get(name)
+                if other_dict is None:
+                    other_dict = aruco.getPredefinedDictionary(getattr(aruco, name))
+                ar_dicts.append(other_dict)
+                ar_dict_names.append(name)
+            self._ar_dicts = ar_dicts
+            self._ar_dict_names = ar_dict_names
+            self._invalidate_motion_gate()
+
+    def set_calibration(self, projection_matrix, distortion=None):
+        """
+        Sets the camera projection matrix (3x3) and distortion coefficients.
+        """
+        if distortion is None:
+            distortion = array([0.0, 0.0, 0.0, 0.0, 0.0], dtype=float32)
+        with self._lock:
+            previous = (self._camera_projection_matrix, self._camera_distortion)
+            self._camera_projection_matrix = projection_matrix
+            self._camera_distortion = distortion
+            try:
+                self._check_pose_estimation_ok()
+            except ValueError:
+                self._camera_projection_matrix, self._camera_distortion = \
+                    previous
+                raise
+            self._invalidate_motion_gate()
+
+    def load_calibration(self, textfile):
+        """
+        Loads projection matrix and distortion from a calibration file.
+        """
+        self.set_calibration(*_load_calibration(textfile))
+
+    def set_detector_parameters(self, parameters):
+        """
+        Sets ArUco detector parameters from a dict of attribute names
+        to values, e.g. {"adaptiveThreshWinSizeMax": 15}.
+        """
+        detector_parameters = _make_detector_parameters(parameters)
+        with self._lock:
+            self._detector_parameters = detector_parameters
+            self._invalidate_motion_gate()
 
     def get_tool_descriptions(self):
         return "No tools defined"
@@ -162,6 +429,24 @@ class ArUcoTracker(SKSBaseTracker):
         else:
             raise ValueError('Attempted to start tracking, when not ready')
 
+    def is_tracking(self):
+        return self._state == "tracking"
+
+    def stream(self, video_source, **kwargs):
+        """
+        Returns a TrackingStream of this tracker's results for video_source,
+        a video source or a camera number or file name, for use with
+        asyncio::
+
+            async with tracker.stream(0, backpressure="latest") as stream:
+                async for item in stream:
+                    ...
+
+        Keyword arguments are passed to lib.async_tracking.TrackingStream.
+        """
+        from lib.async_tracking import TrackingStream  # pylint: disable=import-outside-toplevel
+        return TrackingStream(self, video_source, **kwargs)
+
     def stop_tracking(self):
         if self._state == "tracking":
             self._state = "ready"
@@ -0,0 +1,295 @@
+"""
+Asyncio interface to tracking: capture and detection run in executor
+threads while the event loop serves any number of consumers::
+
+    async with tracker.stream(0) as stream:
+        async for item in stream:
+            send_to_clients(item.result)
+
+One TrackingStream reads and tracks each frame once, capture of the next
+frame overlapping detection of the current one, and hands every result to
+each subscription. Consumers such as a network server, a recorder and a UI
+bridge each subscribe() with their own queue and backpressure:
+
+    "block"     the pipeline waits for the consumer when its queue is full,
+                so nothing is lost, e.g. for recorders of video files.
+                Every other subscription waits too, so one slow "block"
+                consumer slows the whole stream.
+    "latest"    the oldest queued result is dropped instead, so a slow
+                consumer always gets the newest pose, e.g. for live cameras.
+
+The stream's own backpressure also decides whether capture waits for
+detection ("block") or keeps reading and drops frames detection has not
+started on ("latest"). Only a "block" stream passes every frame to its
+"block" subscriptions.
+"""
+
+import asyncio
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.modified_video_source import open_video_source
+
+LOGGER = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ("block", "latest")
+
+# One tracked frame. frame, and pooled if the source uses a FramePool, are
+# only set if the stream includes frames; pooled must then be released
+# once the frame is no longer needed.
+StreamedResult = collections.namedtuple(
+    'StreamedResult',
+    ['result', 'frame', 'frame_id', 'timestamp', 'capture_time', 'pooled'])
+
+_END = object()
+
+
+def _release(item):
+    pooled = getattr(item, "pooled", None)
+    if pooled is not None:
+        pooled.release()
+
+
+def _check_backpressure(backpressure):
+    if backpressure not in BACKPRESSURE_POLICIES:
+        raise ValueError(f"Backpressure must be one of {BACKPRESSURE_POLICIES}, "
+                         f"not {backpressure}")
+
+
+async def _put(queue, item, backpressure):
+    # Returns the number of items dropped to make room.
+    if backpressure == "block":
+        await queue.put(item)
+        return 0
+    dropped = 0
+    while queue.full():
+        _release(queue.get_nowait())
+        dropped += 1
+    queue.put_nowait(item)
+    return dropped
+
+
+class StreamSubscription:
+    """
+    One consumer's view of a TrackingStream, iterated with async for. Ends
+    when the stream stops, raising the error that stopped it if any.
+    """
+    def __init__(self, stream, max_queue, backpressure):
+        _check_backpressure(backpressure)
+        self.stream = stream
+        self.backpressure = backpressure
+        self.dropped = 0
+        self._queue = asyncio.Queue(max_queue)
+        self._ended = False
+
+    async def _put(self, item):
+        self.dropped += await _put(self._queue, item, self.backpressure)
+
+    def _end(self):
+        # Never waits, as the consumer may have gone. Queued results are
+        # still delivered; the end marker only wakes a consumer waiting on
+        # an empty queue, so it is queued only if there is room.
+        if self._ended:
+            return
+        self._ended = True
+        if not self._queue.full():
+            self._queue.put_nowait(_END)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = _END
+        if not (self._ended and self._queue.empty()):
+            item = await self._queue.get()
+        if item is _END:
+            if self.stream.error is not None:
+                raise self.stream.error
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        """
+        Stops receiving results, releasing any queued frames.
+        """
+        self.stream.unsubscribe(self)
+        while not self._queue.empty():
+            _release(self._queue.get_nowait())
+
+
+class TrackingStream:
+    """
+    Tracks frames from a video source in executor threads and streams the
+    results to subscriptions.
+
+    :param tracker: an ArUcoTracker, started if it is not tracking yet.
+    :param video_source: a video source with read(), or a camera number or
+        file name to open (and release when the stream stops).
+    :param max_queue: default queue size of subscriptions.
+    :param backpressure: default policy of subscriptions, and of frames
+        waiting for detection, "block" or "latest".
+    :param include_frames: also pass each frame to subscribers. Frames
+        from a FramePool stay out of the pool until released, so it needs
+        about as many buffers as all subscription queues hold.
+    """
+    def __init__(self, tracker, video_source, max_queue=4, backpressure="block",
+                 include_frames=False):
+        _check_backpressure(backpressure)
+        if max_queue < 1:
+            raise ValueError("max_queue must be >= 1")
+        self.tracker = tracker
+        self.owns_source = not hasattr(video_source, "read")
+        self.video_source = open_video_source(video_source) if self.owns_source \
+            else video_source
+        self.max_queue = max_queue
+        self.backpressure = backpressure
+        self.include_frames = include_frames
+        self.frames_read = 0
+        self.frames_tracked = 0
+        self.frames_dropped = 0
+        self.error = None
+        self._subscriptions = []
+        self._default_subscription = None
+        self._frames = None
+        self._tasks = []
+        self._executors = None
+        self._running = False
+
+    def subscribe(self, max_queue=None, backpressure=None):
+        """
+        Returns a new StreamSubscription receiving every result tracked from
+        now on, starting the stream if needed. Must be called from the
+        event loop.
+        """
+        subscription = StreamSubscription(
+            self, self.max_queue if max_queue is None else max_queue,
+            self.backpressure if backpressure is None else backpressure)
+        self._subscriptions.append(subscription)
+        if not self._running and not self._tasks:
+            self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def __aiter__(self):
+        # Iterating the stream itself uses one shared default subscription.
+        if self._default_subscription is None:
+            self._default_subscription = self.subscribe()
+        return self._default_subscription
+
+    def start(self):
+        """
+        Starts capture and tracking on the running event loop.
+        """
+        if self._running:
+            return
+        if not self.tracker.is_tracking():
+            self.tracker.start_tracking()
+        self._running = True
+        self._frames = asyncio.Queue(1)
+        # One thread each, so frames are read and tracked in order.
+        self._executors = (ThreadPoolExecutor(1, thread_name_prefix="stream-capture"),
+                           ThreadPoolExecutor(1, thread_name_prefix="stream-tracking"))
+        self._tasks = [asyncio.ensure_future(self._capture()),
+                       asyncio.ensure_future(self._track())]
+
+    async def stop(self):
+        """
+        Stops capture and tracking and ends every subscription.
+        """
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._frames is not None:
+            while not self._frames.empty():
+                _release(self._frames.get_nowait())
+        self._end_subscriptions()
+        if self._executors is not None:
+            for executor in self._executors:
+                executor.shutdown(wait=False)
+            self._executors = None
+        if self.owns_source:
+            self.video_source.release()
+
+    def _end_subscriptions(self):
+        for subscription in list(self._subscriptions):
+            subscription._end()  # pylint: disable=protected-access
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def _capture(self):
+        loop = asyncio.get_running_loop()
+        video_source = self.video_source
+        borrow_frame = getattr(video_source, "borrow_frame", None)
+        try:
+            while self._running:
+                ok, frame, timestamp = await loop.run_in_executor(
+                    self._executors[0], video_source.read)
+                if not ok:
+                    break
+                self.frames_read += 1
+                # Keep pooled frames from being reused until tracked.
+                pooled = borrow_frame() if borrow_frame is not None else None
+                captured = StreamedResult(None, frame, video_source.frame_id, timestamp,
+                                          video_source.capture_time, pooled)
+                self.frames_dropped += await _put(self._frames, captured,
+                                                  self.backpressure)
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception("Capture failed")
+            self.error = error
+        # The source ended, let tracking finish what is queued.
+        await self._frames.put(_END)
+
+    async def _track(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            captured = await self._frames.get()
+            if captured is _END:
+                break
+            try:
+                result = await loop.run_in_executor(
+                    self._executors[1], self.tracker.get_frame, captured.frame)
+            except Exception as error:  # pylint: disable=broad-except
+                LOGGER.exception("Tracking failed")
+                self.error = error
+                _release(captured)
+                break
+            self.frames_tracked += 1
+            if self.include_frames:
+                streamed = captured._replace(result=result)
+            else:
+                _release(captured)
+                streamed = captured._replace(result=result, frame=None, pooled=None)
+            await self._publish(streamed)
+        self._running = False
+        self._end_subscriptions()
+
+    async def _publish(self, streamed):
+        for subscription in list(self._subscriptions):
+            item = streamed
+            if streamed.pooled is not None:
+                # Every subscriber holds, and releases, its own reference.
+                item = streamed._replace(pooled=streamed.pooled.retain())
+            await subscription._put(item)  # pylint: disable=protected-access
+        _release(streamed)
+
+    def stats(self):
+        """
+        Returns a dict of frames read, tracked and dropped before tracking,
+        and results dropped per subscription.
+        """
+        return {"frames read": self.frames_read,
+                "frames tracked": self.frames_tracked,
+                "frames dropped": self.frames_dropped,
+                "results dropped": [subscription.dropped
+                                    for subscription in self._subscriptions]}
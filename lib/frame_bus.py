@@ -0,0 +1,312 @@
+"""
+Shared memory frame transport between processes.
+
+A FrameRing is a ring of preallocated frame slots in one
+multiprocessing.shared_memory block. One process writes frames, any
+number of processes read them in place, without copying or pickling.
+Each slot carries a sequence number, the capture time and frame id.
+
+Protocol: frames are numbered 1, 2, 3... and frame n lives in slot
+(n - 1) % slots. The writer marks a slot as -n while writing and n once
+complete, then publishes n as the latest sequence. A reader takes a view
+of the slot holding n and, once finished with it, checks is_valid(n);
+if the writer has since lapped the ring the data may have been
+overwritten and should be discarded.
+"""
+
+import datetime
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+_MAGIC = 0x46524D42  # "FRMB"
+
+# Header: magic, slots, height, width, channels, latest sequence,
+# then the dtype string as 8 bytes.
+_HEADER_INTS = 6
+_HEADER_BYTES = _HEADER_INTS * 8 + 8
+_ALIGNMENT = 64
+
+# Serialises attaching, which swaps resource_tracker.register for the call.
+_REGISTER_LOCK = threading.Lock()
+
+
+def open_shared_memory(name):
+    """
+    Attaches to existing shared memory without registering it with this
+    process' resource tracker, so only the creator ever unlinks it.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Before Python 3.13 attaching always registers the memory. Child
+    # processes share the creator's resource tracker, so unregistering
+    # afterwards would drop the creator's entry; skip registering instead.
+    with _REGISTER_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _aligned(size):
+    return (size + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class FrameRing:
+    """
+    Single writer, many reader ring of frames in shared memory.
+    Use FrameRing.create() in the writing process and FrameRing.attach()
+    with the same name in readers.
+    """
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        self.header = np.ndarray((_HEADER_INTS,), dtype=np.int64,
+                                 buffer=memory.buf)
+        if self.header[0] != _MAGIC:
+            raise ValueError(f"Shared memory {memory.name} is not a FrameRing")
+
+        dtype_bytes = bytes(memory.buf[_HEADER_INTS * 8:_HEADER_BYTES])
+        self.dtype = np.dtype(dtype_bytes.rstrip(b"\0").decode("ascii"))
+        self.slots = int(self.header[1])
+        self.shape = (int(self.header[2]), int(self.header[3]),
+                      int(self.header[4]))
+
+        offset = _aligned(_HEADER_BYTES)
+        self.slot_sequences = np.ndarray((self.slots,), dtype=np.int64,
+                                         buffer=memory.buf, offset=offset)
+        offset = _aligned(offset + self.slots * 8)
+        # Per slot capture time (time.perf_counter()), wall clock time
+        # (time.time()) and frame id.
+        self.slot_times = np.ndarray((self.slots, 3), dtype=np.float64,
+                                     buffer=memory.buf, offset=offset)
+        offset = _aligned(offset + self.slots * 3 * 8)
+        self.frames = np.ndarray((self.slots,) + self.shape, dtype=self.dtype,
+                                 buffer=memory.buf, offset=offset)
+        self._writing = None
+
+    @staticmethod
+    def required_size(shape, dtype, slots):
+        """
+        Returns the number of bytes a ring needs.
+        """
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        size = _aligned(_HEADER_BYTES)
+        size = _aligned(size + slots * 8)
+        size = _aligned(size + slots * 3 * 8)
+        return size + slots * frame_bytes
+
+    @classmethod
+    def create(cls, shape, dtype=np.uint8, slots=4, name=None):
+        """
+        Creates a new ring for frames of shape (height, width, channels).
+        """
+        if len(shape) == 2:
+            shape = (shape[0], shape[1], 1)
+        if len(shape) != 3:
+            raise ValueError("Frame shape must be (height, width[, channels])")
+        if slots < 2:
+            raise ValueError("A FrameRing needs at least 2 slots")
+        dtype = np.dtype(dtype)
+        if len(dtype.str) > 8:
+            raise ValueError(f"Unsupported dtype {dtype}")
+
+        memory = shared_memory.SharedMemory(
+            create=True, size=cls.required_size(shape, dtype, slots), name=name)
+        header = np.ndarray((_HEADER_INTS,), dtype=np.int64, buffer=memory.buf)
+        header[:] = (_MAGIC, slots, shape[0], shape[1], shape[2], 0)
+        memory.buf[_HEADER_INTS * 8:_HEADER_BYTES] = \
+            dtype.str.encode("ascii").ljust(8, b"\0")
+        ring = cls(memory, owner=True)
+        ring.slot_sequences[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attaches to a ring created by another process.
+        """
+        return cls(open_shared_memory(name), owner=False)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def latest_sequence(self):
+        return int(self.header[5])
+
+    def begin_write(self):
+        """
+        Returns a writable view of the next slot, e.g. to decode into.
+        Call commit() when the frame is complete.
+        """
+        sequence = self.latest_sequence + 1
+        slot = (sequence - 1) % self.slots
+        self.slot_sequences[slot] = -sequence
+        self._writing = sequence
+        return self.frames[slot]
+
+    def commit(self, capture_time=None, frame_id=None, wall_time=None):
+        """
+        Publishes the slot returned by begin_write().
+
+        :returns: the sequence number of the frame.
+        """
+        if self._writing is None:
+            raise RuntimeError("commit() called without begin_write()")
+        sequence = self._writing
+        slot = (sequence - 1) % self.slots
+        self.slot_times[slot] = (
+            capture_time if capture_time is not None else time.perf_counter(),
+            wall_time if wall_time is not None else time.time(),
+            frame_id if frame_id is not None else sequence)
+        self.slot_sequences[slot] = sequence
+        self.header[5] = sequence
+        self._writing = None
+        return sequence
+
+    def abort(self):
+        """
+        Abandons the slot returned by begin_write(). Its previous frame
+        is treated as overwritten.
+        """
+        if self._writing is not None:
+            self.slot_sequences[(self._writing - 1) % self.slots] = 0
+            self._writing = None
+
+    def write(self, frame, capture_time=None, frame_id=None):
+        """
+        Copies a frame into the next slot and publishes it.
+
+        :returns: the sequence number of the frame.
+        """
+        view = self.begin_write()
+        np.copyto(view, frame.reshape(self.shape))
+        return self.commit(capture_time, frame_id)
+
+    def is_valid(self, sequence):
+        """
+        True if the slot still holds the given frame.
+        """
+        if sequence < 1:
+            return False
+        return int(self.slot_sequences[(sequence - 1) % self.slots]) == sequence
+
+    def read(self, sequence):
+        """
+        Returns (view, capture_time, wall_time, frame_id) for a frame still
+        in the ring, or None if it has been overwritten. The view is not a
+        copy, check is_valid(sequence) after using it.
+        """
+        if not self.is_valid(sequence):
+            return None
+        slot = (sequence - 1) % self.slots
+        capture_time, wall_time, frame_id = self.slot_times[slot]
+        if not self.is_valid(sequence):
+            return None
+        return self.frames[slot], float(capture_time), float(wall_time), \
+            int(frame_id)
+
+    def read_latest(self, after_sequence=0):
+        """
+        Returns (sequence, view, capture_time, wall_time, frame_id) for the
+        newest frame if it is newer than after_sequence, otherwise None.
+        """
+        sequence = self.latest_sequence
+        if sequence <= after_sequence:
+            return None
+        frame = self.read(sequence)
+        if frame is None:
+            return None
+        return (sequence,) + frame
+
+    def close(self):
+        """
+        Releases this process' mapping, and removes the ring if this
+        process created it.
+        """
+        self.header = None
+        self.slot_sequences = None
+        self.slot_times = None
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class FrameBusVideoSource:
+    """
+    Reads frames from a FrameRing with the same interface as
+    TimestampedVideoSource.read(), so a rendering or tracking process can
+    take its frames from a capture process.
+    """
+    def __init__(self, ring_name, timeout=1.0, poll_interval=0.001):
+        self.ring = FrameRing.attach(ring_name)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.sequence = 0
+        self.frame = None
+        self.ret = None
+        self.timestamp = None
+        self.frame_id = 0
+        self.capture_time = None
+        self.skipped_frames = 0
+
+    def read(self):
+        # Waits for a frame newer than the last one read. The returned frame
+        # is a view into shared memory, valid while is_frame_valid() is True.
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            latest = self.ring.read_latest(self.sequence)
+            if latest is not None:
+                break
+            if time.perf_counter() >= deadline:
+                self.ret, self.frame, self.timestamp = False, None, None
+                return self.ret, self.frame, self.timestamp
+            time.sleep(self.poll_interval)
+
+        sequence, self.frame, self.capture_time, wall_time, self.frame_id = latest
+        if self.sequence:
+            self.skipped_frames += sequence - self.sequence - 1
+        self.sequence = sequence
+        self.ret = True
+        self.timestamp = datetime.datetime.fromtimestamp(wall_time)
+        return self.ret, self.frame, self.timestamp
+
+    def is_frame_valid(self):
+        return self.ring.is_valid(self.sequence)
+
+    def isOpened(self):
+        return self.ring is not None
+
+    def release(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+def capture_to_bus(source_num_or_file, ring_name, stop_event, dims=None):
+    """
+    Process entry point that captures from a camera or file into an
+    existing FrameRing until stop_event is set or the source ends.
+    """
+    # Imported here so reader processes don't need the capture dependencies.
+    from lib.modified_video_source import TimestampedVideoSource  # pylint: disable=import-outside-toplevel
+
+    source = TimestampedVideoSource(source_num_or_file, dims)
+    ring = FrameRing.attach(ring_name)
+    source.attach_frame_bus(ring)
+    try:
+        while not stop_event.is_set():
+            ret, _, _ = source.read()
+            if not ret:
+                break
+    finally:
+        source.release()
+        ring.close()
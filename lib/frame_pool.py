@@ -0,0 +1,131 @@
+"""
+Reference counted pool of preallocated frame buffers.
+
+Frames are decoded into pooled buffers instead of a new array per frame.
+Each stage that needs a frame beyond the current call borrows it with
+retain() and hands it back with release(); once nobody holds a buffer it
+returns to the pool and is reused for a later frame.
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PooledFrame:
+    """
+    One buffer from a FramePool. array is the frame data, valid while at
+    least one reference is held.
+
+    Usage::
+
+        with video_source.borrow_frame() as image:
+            tracker.get_frame(image)
+    """
+    def __init__(self, pool, array, pooled=True):
+        self.pool = pool
+        self.array = array
+        self.pooled = pooled
+        self.references = 0
+
+    def retain(self):
+        """
+        Takes another reference to the frame.
+
+        :returns: the frame itself, for chaining.
+        """
+        with self.pool.lock:
+            if self.references < 1:
+                raise RuntimeError("Cannot retain a frame that was released")
+            self.references += 1
+        return self
+
+    def release(self):
+        """
+        Gives a reference back. The last release returns the buffer to the
+        pool.
+        """
+        self.pool.release(self)
+
+    def __enter__(self):
+        return self.array
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class FramePool:
+    """
+    Buffers of one frame shape and dtype, allocated on demand up to
+    max_buffers and then reused.
+
+    If every buffer is in use a temporary one is allocated, which is not
+    kept when released, and counted in overflow_allocations. That usually
+    means a stage is not releasing its frames.
+    """
+    def __init__(self, shape, dtype=np.uint8, max_buffers=4):
+        if max_buffers < 1:
+            raise ValueError("A frame pool needs at least one buffer")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max_buffers = max_buffers
+        self.lock = threading.Lock()
+        self.free = []
+        self.allocated = 0
+        self.in_use = 0
+        self.high_water_mark = 0
+        self.overflow_allocations = 0
+
+    def acquire(self):
+        """
+        Returns a PooledFrame holding one reference. Its contents are
+        whatever the previous user left in it.
+        """
+        with self.lock:
+            if self.free:
+                frame = self.free.pop()
+            else:
+                pooled = self.allocated < self.max_buffers
+                if pooled:
+                    self.allocated += 1
+                else:
+                    if self.overflow_allocations == 0:
+                        LOGGER.warning("Frame pool of %d buffers exhausted, "
+                                       "frames are probably not being released",
+                                       self.max_buffers)
+                    self.overflow_allocations += 1
+                frame = PooledFrame(self, np.empty(self.shape, dtype=self.dtype),
+                                    pooled)
+            frame.references = 1
+            self.in_use += 1
+            self.high_water_mark = max(self.high_water_mark, self.in_use)
+        return frame
+
+    def release(self, frame):
+        """
+        Drops one reference to frame, see PooledFrame.release().
+        """
+        with self.lock:
+            if frame.references < 1:
+                raise RuntimeError("Frame released more often than retained")
+            frame.references -= 1
+            if frame.references:
+                return
+            self.in_use -= 1
+            # Temporary overflow buffers are left to the garbage collector.
+            if frame.pooled:
+                self.free.append(frame)
+
+    def stats(self):
+        """
+        Returns a dict with the buffer counts and high-water mark.
+        """
+        with self.lock:
+            return {"buffers": self.allocated,
+                    "max buffers": self.max_buffers,
+                    "in use": self.in_use,
+                    "high water mark": self.high_water_mark,
+                    "overflow allocations": self.overflow_allocations}
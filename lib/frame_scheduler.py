@@ -0,0 +1,234 @@
+"""
+Frame arrival driven scheduling of view updates.
+
+A capture thread reads the video source as frames arrive and keeps only
+the newest one, so a slow update skips stale frames rather than falling
+further behind. Updates are paced to a target display rate, separate from
+the camera rate, and slowed down when the measured update time would not
+fit in the display interval.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# A frame handed from the capture thread to the update. pooled is the
+# PooledFrame holding the frame's buffer (or None), which the receiver
+# must release once it is finished with the frame.
+ScheduledFrame = collections.namedtuple(
+    'ScheduledFrame', ['frame', 'frame_id', 'capture_time', 'timestamp', 'pooled'])
+
+
+def _file_frame_rate(video_source):
+    # Files are read as fast as they decode, so are paced to their frame
+    # rate; cameras deliver frames at their own rate.
+    if not isinstance(getattr(video_source, "source_name", None), str):
+        return None
+    capture = getattr(video_source, "source", None)
+    fps = capture.get(cv2.CAP_PROP_FPS) if capture is not None else 0.0
+    return fps if fps > 0 else 30.0
+
+
+class FrameScheduler:
+    """
+    Captures frames on a background thread and decides when the view
+    should update.
+
+    Usage::
+
+        scheduler = FrameScheduler(video_source, target_rate=30.0,
+                                   on_frame=request_update)
+        scheduler.start()
+        # on the GUI thread, when scheduler.time_until_due() is 0:
+        scheduler.begin_update()
+        scheduled = scheduler.take_frame()
+        ...
+        scheduler.end_update()
+
+    on_frame is called from the capture thread for every new frame.
+
+    :param target_rate: display updates per second.
+    :param headroom: the update interval is kept at least this many times
+        the measured update time, so updates don't queue up under load.
+    :param source_rate: frames per second to read the source at, None to
+        read as fast as frames arrive (cameras) or at the frame rate of a
+        video file.
+    """
+    def __init__(self, video_source, target_rate=30.0, on_frame=None,
+                 headroom=1.2, source_rate=None, smoothing=0.1, window=120):
+        if target_rate <= 0:
+            raise ValueError("Target rate must be > 0")
+        self.video_source = video_source
+        self.target_rate = target_rate
+        self.on_frame = on_frame
+        self.headroom = headroom
+        self.source_rate = source_rate
+        self.smoothing = smoothing
+
+        self.lock = threading.Lock()
+        self.capture_thread = None
+        self.running = False
+        self.finished = False
+        self._latest = None
+
+        self.update_time = None
+        self.arrival_interval = None
+        self.next_due = 0.0
+        self.stale_frames = 0
+        self.overruns = 0
+        self.updates = 0
+        self._last_arrival = None
+        self._update_start = None
+        self._last_update_start = None
+        self._update_intervals = collections.deque(maxlen=window)
+        # An AllocationProfiler measuring reads as the "capture" stage, or None.
+        self.allocation_profiler = None
+        # A LatencyMonitor timing reads as the "capture" stage, or None.
+        self.latency_monitor = None
+
+    @property
+    def interval(self):
+        """
+        Seconds between updates: the target interval, or longer if
+        updates take too long to keep up with it.
+        """
+        interval = 1.0 / self.target_rate
+        if self.update_time is not None:
+            interval = max(interval, self.update_time * self.headroom)
+        return interval
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.finished = False
+        self.capture_thread = threading.Thread(target=self._capture_loop,
+                                               daemon=True)
+        self.capture_thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+            self.capture_thread = None
+        with self.lock:
+            latest, self._latest = self._latest, None
+        if latest is not None and latest.pooled is not None:
+            latest.pooled.release()
+
+    def _capture_loop(self):
+        source_rate = self.source_rate or _file_frame_rate(self.video_source)
+        next_read = time.perf_counter()
+        while self.running:
+            if source_rate:
+                delay = next_read - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_read = max(next_read + 1.0 / source_rate,
+                                time.perf_counter() - 1.0 / source_rate)
+
+            profiler = self.allocation_profiler
+            token = profiler.begin_stage() if profiler is not None else None
+            read_start = time.perf_counter()
+            ok, frame, timestamp = self.video_source.read()
+            if self.latency_monitor is not None:
+                self.latency_monitor.add_sample("capture", time.perf_counter() - read_start)
+            if token is not None:
+                profiler.end_stage("capture", token)
+            if not ok:
+                LOGGER.info("Video source ended after frame %s",
+                            self.video_source.frame_id)
+                self.finished = True
+                break
+            borrow = getattr(self.video_source, "borrow_frame", None)
+            scheduled = ScheduledFrame(frame, self.video_source.frame_id,
+                                       self.video_source.capture_time,
+                                       timestamp, borrow() if borrow else None)
+            self._store(scheduled)
+            if self.on_frame is not None:
+                self.on_frame()
+        self.running = False
+
+    def _store(self, scheduled):
+        now = time.perf_counter()
+        with self.lock:
+            stale, self._latest = self._latest, scheduled
+            if self._last_arrival is not None:
+                self.arrival_interval = self._average(self.arrival_interval,
+                                                      now - self._last_arrival)
+            self._last_arrival = now
+            if stale is not None:
+                self.stale_frames += 1
+        if stale is not None and stale.pooled is not None:
+            stale.pooled.release()
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def has_frame(self):
+        with self.lock:
+            return self._latest is not None
+
+    def take_frame(self):
+        """
+        Returns the newest ScheduledFrame, or None if no frame arrived since
+        the last call. Frames in between were skipped as stale.
+        """
+        with self.lock:
+            scheduled, self._latest = self._latest, None
+        return scheduled
+
+    def time_until_due(self, now=None):
+        """
+        Seconds until the next update should run, 0 if it is due.
+        """
+        now = time.perf_counter() if now is None else now
+        return max(0.0, self.next_due - now)
+
+    def begin_update(self):
+        now = time.perf_counter()
+        if self._last_update_start is not None:
+            self._update_intervals.append(now - self._last_update_start)
+        self._last_update_start = now
+        self._update_start = now
+
+    def end_update(self):
+        if self._update_start is None:
+            return
+        now = time.perf_counter()
+        elapsed = now - self._update_start
+        self.updates += 1
+        if elapsed > 1.0 / self.target_rate:
+            self.overruns += 1
+        self.update_time = self._average(self.update_time, elapsed)
+        # Measured from the start, so the rate doesn't drift by the update time.
+        self.next_due = max(self._update_start + self.interval, now)
+        self._update_start = None
+
+    def stats(self):
+        """
+        Returns camera and display rates, skipped frames, overruns and
+        jitter (standard deviation of the update interval).
+        """
+        intervals = np.asarray(self._update_intervals)
+        mean_interval = float(np.mean(intervals)) if intervals.size else None
+        return {"camera fps": 1.0 / self.arrival_interval
+                if self.arrival_interval else None,
+                "display fps": 1.0 / mean_interval if mean_interval else None,
+                "target fps": self.target_rate,
+                "interval ms": 1000.0 * self.interval,
+                "update ms": 1000.0 * self.update_time
+                if self.update_time is not None else None,
+                "jitter ms": 1000.0 * float(np.std(intervals))
+                if intervals.size > 1 else None,
+                "stale frames": self.stale_frames,
+                "overruns": self.overruns,
+                "updates": self.updates}
@@ -0,0 +1,258 @@
+"""Per-stage latency measurement for the capture to render pipeline."""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Bucket upper bounds in seconds, for histogram export.
+DEFAULT_BUCKETS = (0.001, 0.002, 0.005, 0.010, 0.020, 0.033, 0.050, 0.100,
+                   0.250, 0.500, 1.0)
+
+END_TO_END = "end to end"
+
+
+class RollingHistogram:
+    """
+    Keeps the most recent samples of one stage in a fixed size ring buffer,
+    plus running totals since creation.
+    """
+    def __init__(self, window=300):
+        if window < 1:
+            raise ValueError("Window must be >= 1")
+        self.samples = np.zeros(window, dtype=np.float64)
+        self.size = 0
+        self.position = 0
+        self.total_count = 0
+        self.total_sum = 0.0
+        self.last = None
+
+    def add(self, seconds):
+        """
+        Adds one sample, overwriting the oldest once the window is full.
+        """
+        self.samples[self.position] = seconds
+        self.position = (self.position + 1) % self.samples.shape[0]
+        self.size = min(self.size + 1, self.samples.shape[0])
+        self.total_count += 1
+        self.total_sum += seconds
+        self.last = seconds
+
+    def values(self):
+        """
+        Returns the samples currently in the window.
+        """
+        return self.samples[:self.size]
+
+    def percentiles(self, quantiles=(50, 90, 99)):
+        """
+        Returns a dict of percentile to seconds over the window.
+        """
+        if self.size == 0:
+            return {quantile: None for quantile in quantiles}
+        values = np.percentile(self.values(), quantiles)
+        return dict(zip(quantiles, (float(value) for value in values)))
+
+    def histogram(self, buckets=DEFAULT_BUCKETS):
+        """
+        Returns cumulative counts of window samples <= each bucket bound.
+        """
+        values = np.sort(self.values())
+        return [int(np.searchsorted(values, bound, side="right"))
+                for bound in buckets]
+
+
+class LatencyMonitor:
+    """
+    Collects stage durations for each frame into rolling histograms,
+    tracks end to end latency by frame id and exports the results.
+
+    Usage::
+
+        monitor = LatencyMonitor()
+        monitor.begin_frame()
+        with monitor.stage("capture"):
+            ok, image, _ = video_source.read()
+        monitor.tag_frame(video_source.frame_id, video_source.capture_time)
+        ...
+        # Called when the frame has actually been rendered.
+        monitor.end_frame(render_seconds)
+
+    Times are time.perf_counter() seconds.
+    """
+    def __init__(self, window=300, buckets=DEFAULT_BUCKETS,
+                 export_file=None, export_interval=5.0):
+        self.window = window
+        self.buckets = buckets
+        self.histograms = {}
+        self.export_file = export_file
+        self.export_interval = export_interval
+        self.frame_id = None
+        self.capture_time = None
+        self.pending_frame = None
+        self.rendered_frame_id = None
+        self.coalesced_frames = 0
+        # An AllocationProfiler also measuring every stage, or None.
+        self.allocation_profiler = None
+        self._last_export = time.perf_counter()
+
+    def add_sample(self, name, seconds):
+        """
+        Adds a duration in seconds to the named stage.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = RollingHistogram(self.window)
+            # Replaced rather than changed, so a stage added from another
+            # thread, e.g. the capture thread, never changes a dict being
+            # iterated.
+            self.histograms = {**self.histograms, name: histogram}
+        histogram.add(seconds)
+
+    def add_samples(self, stage_times, prefix=""):
+        """
+        Adds a dict of stage name to seconds, e.g. from
+        ArUcoTracker.get_stage_times().
+        """
+        for name, seconds in stage_times.items():
+            self.add_sample(prefix + name, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing the enclosed block as the named stage.
+        """
+        profiler = self.allocation_profiler
+        token = profiler.begin_stage() if profiler is not None else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_sample(name, time.perf_counter() - start)
+            if token is not None:
+                profiler.end_stage(name, token)
+
+    def begin_frame(self):
+        """
+        Starts a new frame, before capture.
+        """
+        self.frame_id = None
+        self.capture_time = None
+
+    def tag_frame(self, frame_id, capture_time):
+        """
+        Records the id and capture time of the frame being processed.
+        """
+        self.frame_id = frame_id
+        self.capture_time = capture_time
+
+    def submit_frame(self):
+        """
+        Marks the current frame as handed to the renderer. If a previous
+        frame had not been rendered yet it was coalesced by the GUI.
+        """
+        if self.pending_frame is not None:
+            self.coalesced_frames += 1
+        self.pending_frame = (self.frame_id, self.capture_time)
+
+    def end_frame(self, render_seconds=None):
+        """
+        Completes the submitted frame once it has been rendered and records
+        end to end latency from capture.
+        """
+        if render_seconds is not None:
+            self.add_sample("render", render_seconds)
+        if self.pending_frame is None:
+            return
+        frame_id, capture_time = self.pending_frame
+        self.pending_frame = None
+        if capture_time is not None:
+            self.add_sample(END_TO_END, time.perf_counter() - capture_time)
+        self.rendered_frame_id = frame_id
+        self.maybe_export()
+
+    def summary(self):
+        """
+        Returns a dict of stage name to statistics in milliseconds,
+        with histogram counts per bucket.
+        """
+        stages = {}
+        for name, histogram in self.histograms.items():
+            percentiles = histogram.percentiles()
+            stages[name] = {
+                "count": histogram.total_count,
+                "last ms": _to_ms(histogram.last),
+                "p50 ms": _to_ms(percentiles[50]),
+                "p90 ms": _to_ms(percentiles[90]),
+                "p99 ms": _to_ms(percentiles[99]),
+                "buckets": dict(zip((str(bound) for bound in self.buckets),
+                                    histogram.histogram(self.buckets)))}
+        return {"frame id": self.rendered_frame_id,
+                "coalesced frames": self.coalesced_frames,
+                "stages": stages}
+
+    def hud_text(self):
+        """
+        Returns a short multi line text for an on screen display.
+        """
+        lines = [f"frame {self.rendered_frame_id}"]
+        for name, histogram in self.histograms.items():
+            percentiles = histogram.percentiles((50, 99))
+            if percentiles[50] is None:
+                continue
+            lines.append(f"{name:>20}: {1000.0 * percentiles[50]:6.1f} / "
+                         f"{1000.0 * percentiles[99]:6.1f} ms")
+        return "\n".join(lines)
+
+    def prometheus_text(self, prefix="overlay"):
+        """
+        Returns the statistics in Prometheus text exposition format.
+        Quantiles are over the rolling window, sum and count since start.
+        """
+        metric = f"{prefix}_stage_seconds"
+        lines = [f"# HELP {metric} Latency of each pipeline stage.",
+                 f"# TYPE {metric} summary"]
+        for name, histogram in self.histograms.items():
+            label = name.replace(" ", "_").replace('"', "")
+            for quantile, value in histogram.percentiles().items():
+                if value is not None:
+                    lines.append(f'{metric}{{stage="{label}",'
+                                 f'quantile="{quantile / 100.0}"}} {value:.6f}')
+            lines.append(f'{metric}_sum{{stage="{label}"}} '
+                         f'{histogram.total_sum:.6f}')
+            lines.append(f'{metric}_count{{stage="{label}"}} '
+                         f'{histogram.total_count}')
+        lines.append(f"# TYPE {prefix}_coalesced_frames_total counter")
+        lines.append(f"{prefix}_coalesced_frames_total {self.coalesced_frames}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename):
+        """
+        Writes statistics to filename, as Prometheus text if it ends in
+        .prom, otherwise as JSON. The file is replaced atomically.
+        """
+        if filename.endswith(".prom"):
+            text = self.prometheus_text()
+        else:
+            text = json.dumps(self.summary(), indent=2)
+        temporary = filename + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as export_file:
+            export_file.write(text)
+        os.replace(temporary, filename)
+
+    def maybe_export(self):
+        """
+        Exports to export_file if the export interval has passed.
+        """
+        if not self.export_file:
+            return
+        now = time.perf_counter()
+        if now - self._last_export >= self.export_interval:
+            self._last_export = now
+            self.export(self.export_file)
+
+
+def _to_ms(seconds):
+    return None if seconds is None else 1000.0 * seconds
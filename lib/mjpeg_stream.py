@@ -0,0 +1,259 @@
+"""
+MJPEG over HTTP streaming of the composited overlay, for watching a
+session on tablets or other browsers on the local network.
+
+The GUI thread hands over rendered frames, e.g. from
+VTKOverlayWindow.convert_scene_to_numpy_array(), with submit_frame(). It
+never waits: frames are JPEG encoded on a small worker pool, and a frame
+that arrives while every worker is busy replaces the one waiting, so only
+the latest is encoded. Each client is served from its own thread, always
+gets the newest JPEG, and is limited to its own frame rate, so a slow
+tablet only skips frames and never delays the others::
+
+    streamer = MjpegStreamer(port=8080)
+    ...
+    if streamer.wants_frame():
+        streamer.submit_frame(window.convert_scene_to_numpy_array())
+
+Endpoints: / (a page showing the stream), /stream.mjpg (the multipart
+stream, ?fps=5 for a lower rate) and /snapshot.jpg (the latest frame).
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+
+LOGGER = logging.getLogger(__name__)
+
+_BOUNDARY = "overlayframe"
+
+_INDEX_PAGE = (b"<!DOCTYPE html><html><head><title>Overlay</title>"
+               b"<meta name='viewport' content='width=device-width'></head>"
+               b"<body style='margin:0;background:#000'>"
+               b"<img src='stream.mjpg' style='width:100%;height:auto'>"
+               b"</body></html>")
+
+
+class MjpegStreamer:
+    """
+    Encodes submitted frames to JPEG and serves them over HTTP.
+
+    :param host: address to listen on, "" for every interface.
+    :param port: port to listen on, 0 for any free port (see self.port).
+    :param max_fps: highest frame rate any client is sent.
+    :param quality: JPEG quality, 0 to 100.
+    :param workers: JPEG encoding threads.
+    :param rgb: True if submitted frames are RGB, as rendered by VTK,
+        False if they are BGR, as captured by OpenCV.
+    """
+    def __init__(self, host="", port=8080, max_fps=15.0, quality=80,
+                 workers=2, rgb=True):
+        if max_fps <= 0:
+            raise ValueError("max_fps must be > 0")
+        self.max_fps = max_fps
+        self.quality = quality
+        self.rgb = rgb
+        self.frames_submitted = 0
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self.clients = 0
+
+        self._condition = threading.Condition()
+        # Newest JPEG and its sequence number, and the frame waiting for a
+        # free worker.
+        self._jpeg = None
+        self._jpeg_sequence = 0
+        self._pending = None
+        self._sequence = 0
+        self._busy_workers = 0
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="mjpeg-encode")
+        self._last_submit = 0.0
+        self.running = True
+
+        handler = type("StreamHandler", (_StreamHandler,), {"streamer": self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._server_thread = threading.Thread(target=self._server.serve_forever,
+                                               daemon=True)
+        self._server_thread.start()
+        LOGGER.info("Streaming the overlay on http://%s:%d/", host or "0.0.0.0", self.port)
+
+    def wants_frame(self):
+        """
+        Returns True if a client is connected and a frame is due at max_fps,
+        so the caller can skip reading back frames nobody will see.
+        """
+        return self.clients > 0 and \
+            time.perf_counter() - self._last_submit >= 1.0 / self.max_fps
+
+    def submit_frame(self, frame):
+        """
+        Queues frame (height, width, 3) for encoding, replacing any frame
+        still waiting for a worker. Never blocks; the streamer keeps frame,
+        so pass a new array each time.
+        """
+        self._last_submit = time.perf_counter()
+        with self._condition:
+            self.frames_submitted += 1
+            self._sequence += 1
+            if self._pending is not None:
+                self.frames_dropped += 1
+            self._pending = (self._sequence, frame)
+            if self._busy_workers < self._workers:
+                self._busy_workers += 1
+                self._executor.submit(self._encode_pending)
+
+    def _encode_pending(self):
+        try:
+            self._encode_until_idle()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Encoding failed")
+            # Free the worker, or no frame would be encoded again.
+            with self._condition:
+                self._busy_workers -= 1
+
+    def _encode_until_idle(self):
+        while True:
+            with self._condition:
+                # Checked and counted under one lock, so submit_frame()
+                # starts a worker for any frame queued after this.
+                if self._pending is None or not self.running:
+                    self._busy_workers -= 1
+                    return
+                sequence, frame = self._pending
+                self._pending = None
+            if self.rgb:
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            # imencode releases the GIL, so workers encode in parallel.
+            ok, jpeg = cv2.imencode(".jpg", frame,
+                                    [int(cv2.IMWRITE_JPEG_QUALITY), int(self.quality)])
+            if not ok:
+                LOGGER.warning("Failed to encode frame %d", sequence)
+                continue
+            with self._condition:
+                self.frames_encoded += 1
+                # Workers may finish out of order, keep the newest.
+                if sequence > self._jpeg_sequence:
+                    self._jpeg = jpeg.tobytes()
+                    self._jpeg_sequence = sequence
+                    self._condition.notify_all()
+
+    def latest_jpeg(self, after=0, timeout=None):
+        """
+        Returns (sequence, JPEG bytes) of the newest frame once it is newer
+        than sequence after, or None on timeout or close.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._jpeg_sequence > after or not self.running,
+                    timeout):
+                return None
+            if not self.running:
+                return None
+            return self._jpeg_sequence, self._jpeg
+
+    def stats(self):
+        """
+        Returns a dict of clients and frames submitted, encoded and dropped
+        before encoding.
+        """
+        return {"clients": self.clients,
+                "frames submitted": self.frames_submitted,
+                "frames encoded": self.frames_encoded,
+                "frames dropped": self.frames_dropped}
+
+    def add_client(self):
+        with self._condition:
+            self.clients += 1
+
+    def remove_client(self):
+        with self._condition:
+            self.clients -= 1
+
+    def close(self):
+        """
+        Disconnects every client and stops the server and workers.
+        """
+        with self._condition:
+            self.running = False
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._executor.shutdown(wait=False)
+
+
+class _StreamHandler(BaseHTTPRequestHandler):
+    streamer = None
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug("%s %s", self.address_string(), format % args)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path in ("/", "/index.html"):
+            self._send_body(_INDEX_PAGE, "text/html")
+        elif url.path == "/snapshot.jpg":
+            latest = self.streamer.latest_jpeg(timeout=2.0)
+            if latest is None:
+                self.send_error(503, "No frame yet")
+            else:
+                self._send_body(latest[1], "image/jpeg")
+        elif url.path == "/stream.mjpg":
+            self._stream(parse_qs(url.query))
+        else:
+            self.send_error(404)
+
+    def _send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, query):
+        streamer = self.streamer
+        try:
+            fps = min(float(query.get("fps", [streamer.max_fps])[0]), streamer.max_fps)
+        except ValueError:
+            fps = streamer.max_fps
+        interval = 1.0 / fps if fps > 0 else 1.0 / streamer.max_fps
+
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         f"multipart/x-mixed-replace; boundary={_BOUNDARY}")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        streamer.add_client()
+        sequence = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                latest = streamer.latest_jpeg(after=sequence, timeout=5.0)
+                if latest is None:
+                    if not streamer.running:
+                        return
+                    continue
+                sequence, jpeg = latest
+                self.wfile.write(f"--{_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                 f"Content-Length: {len(jpeg)}\r\n\r\n".encode("ascii"))
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+                self.wfile.flush()
+                # Per client rate limit; frames in between are skipped, so
+                # the next one sent is always the newest.
+                remaining = interval - (time.perf_counter() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            streamer.remove_client()
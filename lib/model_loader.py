@@ -1,16 +1,191 @@
 import os
 import csv
 import logging
-from vtk.util import colors
+import queue
+import threading
+import numpy as np
 import sksurgerycore.configuration.configuration_manager as cm
-import sksurgeryvtk.models.vtk_surface_model as sm
+
+from lib.model_picking import ModelLocator
+
+# vtk and sksurgeryvtk are imported where they are first used, so reading
+# bounds or importing this module does not pay for loading VTK.
 
 LOGGER = logging.getLogger(__name__)
 
+# File types VTKSurfaceModel can read.
+MODEL_EXTENSIONS = ('.vtk', '.stl', '.ply', '.vtp')
+
+# Colours of models without a colours.txt, as in vtk.util.colors: red,
+# blue, green, black, white, yellow, brown, grey, purple and pink. Listed
+# here as importing vtk.util.colors loads all of VTK.
+DEFAULT_COLOURS = ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.0, 1.0, 0.0),
+                   (0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 1.0, 0.0),
+                   (0.5, 0.1647, 0.1647), (0.7529, 0.7529, 0.7529),
+                   (0.6275, 0.1255, 0.9412), (1.0, 0.7529, 0.7961))
+
+# Default triangle fractions for levels of detail, finest first.
+DEFAULT_LOD_LEVELS = (1.0, 0.25, 0.05)
+
+
+# Reads the bounding box (xmin, xmax, ymin, ymax, zmin, zmax) of a model
+# file without building VTK geometry. Only binary STL and binary PLY vertex
+# blocks are supported, other formats return None.
+def read_model_bounds(filename):
+    try:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.stl':
+            points = _read_binary_stl_points(filename)
+        elif extension == '.ply':
+            points = _read_binary_ply_points(filename)
+        else:
+            points = None
+    except (OSError, ValueError):
+        points = None
+
+    if points is None or len(points) == 0:
+        return None
+
+    mins = points.min(axis=0)
+    maxs = points.max(axis=0)
+    return (float(mins[0]), float(maxs[0]), float(mins[1]),
+            float(maxs[1]), float(mins[2]), float(maxs[2]))
+
+
+def _read_binary_stl_points(filename):
+    with open(filename, 'rb') as stl_file:
+        header = stl_file.read(84)
+    if len(header) < 84:
+        return None
+    triangle_count = int(np.frombuffer(header, dtype='<u4', count=1, offset=80)[0])
+    if os.path.getsize(filename) != 84 + 50 * triangle_count:
+        # ASCII STL, or a truncated file.
+        return None
+    record = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (9,)),
+                       ('attributes', '<u2')])
+    triangles = np.memmap(filename, dtype=record, mode='r', offset=84,
+                          shape=(triangle_count,))
+    return np.asarray(triangles['vertices']).reshape(-1, 3)
+
+
+def _read_binary_ply_points(filename):
+    ply_types = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2',
+                 'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+                 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+                 'int32': 'i4', 'uint32': 'u4', 'float32': 'f4',
+                 'float64': 'f8'}
+    with open(filename, 'rb') as ply_file:
+        if ply_file.readline().strip() != b'ply':
+            return None
+        byte_order = None
+        vertex_count = None
+        properties = []
+        in_vertex = False
+        while True:
+            line = ply_file.readline()
+            if not line:
+                return None
+            words = line.decode('ascii', errors='replace').split()
+            if not words:
+                continue
+            if words[0] == 'format':
+                byte_order = {'binary_little_endian': '<',
+                              'binary_big_endian': '>'}.get(words[1])
+                if byte_order is None:
+                    # ASCII PLY has no fixed layout to map.
+                    return None
+            elif words[0] == 'element':
+                in_vertex = words[1] == 'vertex'
+                if in_vertex:
+                    vertex_count = int(words[2])
+                elif vertex_count is None:
+                    # Vertices must be the first element to locate them.
+                    return None
+            elif words[0] == 'property' and in_vertex:
+                if words[1] == 'list' or words[1] not in ply_types:
+                    return None
+                properties.append((words[2], byte_order + ply_types[words[1]]))
+            elif words[0] == 'end_header':
+                offset = ply_file.tell()
+                break
+
+    names = [name for name, _ in properties]
+    if byte_order is None or vertex_count is None \
+            or not {'x', 'y', 'z'}.issubset(names):
+        return None
+    vertices = np.memmap(filename, dtype=np.dtype(properties), mode='r',
+                         offset=offset, shape=(vertex_count,))
+    return np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1)
+
+
+# Returns the model files in a directory, sorted by name.
+def model_files(directory_name):
+    return sorted(filename for filename in os.listdir(directory_name)
+                  if filename.lower().endswith(MODEL_EXTENSIONS))
+
+
+# Builds one mapper per level of detail, finest first.
+# Level 0 reuses the model's own mapper when its fraction is 1.0, so the
+# full resolution pipeline (normals, model transform) is untouched.
+def build_lod_mappers(model, lod_levels=DEFAULT_LOD_LEVELS):
+    import vtk  # pylint: disable=import-outside-toplevel
+
+    mappers = []
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(model.source)
+    triangles.Update()
+
+    for fraction in lod_levels:
+        if fraction <= 0.0 or fraction > 1.0:
+            raise ValueError(f'LOD fraction must be in (0, 1]: {fraction}')
+
+        if fraction >= 1.0:
+            mappers.append(model.mapper)
+            continue
+
+        decimate = vtk.vtkQuadricDecimation()
+        decimate.SetInputConnection(triangles.GetOutputPort())
+        decimate.SetTargetReduction(1.0 - fraction)
+        decimate.VolumePreservationOn()
+        if model.source.GetPointData().GetTCoords() is not None:
+            # Without the attribute error metric texture coordinates are
+            # dropped. Normals are recomputed below, so left out of it.
+            decimate.AttributeErrorMetricOn()
+            decimate.NormalsAttributeOff()
+
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputConnection(decimate.GetOutputPort())
+        normals.SetAutoOrientNormals(True)
+        normals.SetFlipNormals(False)
+
+        # Share the model transform, so set_model_transform still applies.
+        transform_filter = vtk.vtkTransformPolyDataFilter()
+        transform_filter.SetInputConnection(normals.GetOutputPort())
+        transform_filter.SetTransform(model.transform)
+
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputConnection(transform_filter.GetOutputPort())
+        mapper.Update()
+        mappers.append(mapper)
+
+        LOGGER.info("Built LOD %.2f for %s with %d triangles",
+                    fraction, model.get_name(),
+                    mapper.GetInput().GetNumberOfPolys())
+
+    return mappers
+
 
 class ModelDirectoryLoader:
     # Initializes with directory name, optional RGB color, and configuration file.
-    def __init__(self, directory_name, rgb_color=None, defaults_file=None):
+    # If lod_levels is given, e.g. (1.0, 0.25, 0.05), decimated versions of
+    # every mesh are built and stored in self.lods, keyed by model name.
+    # If progressive is True, only bounds are read here (self.placeholders)
+    # and full models arrive later through get_loaded_models(), which also
+    # adds them to self.models, self.lods and self.locators.
+    # If locator_type is given, "static" or "obb", a ModelLocator for picking
+    # is made per model in self.locators and built on a background thread.
+    def __init__(self, directory_name, rgb_color=None, defaults_file=None,
+                 lod_levels=None, progressive=False, locator_type=None):
         # Check for valid input directory and permissions.
         if directory_name is None:
             raise ValueError('Directory name is None')
@@ -35,101 +210,206 @@ class ModelDirectoryLoader:
         if directory_name:
             self.get_model_colours(directory_name, rgb_color)
 
+        self.lod_levels = lod_levels
+        self.lods = {}
+        self.locator_type = locator_type
+        self.locators = {}
+        self.locator_thread = None
+
         # Load models from the specified directory.
         self.models = []
-        self.get_models(directory_name)
+        self.placeholders = []
+        self.failed_models = []
+        self.loaded_models = queue.Queue()
+        self.loading_thread = None
+        if progressive:
+            self.load_models_progressively(directory_name)
+        else:
+            self.get_models(directory_name)
+
+            # Optionally build levels of detail for each model.
+            if self.lod_levels:
+                self.build_lods(self.lod_levels)
+
+            if self.locator_type:
+                self.build_locators_in_background()
 
     # Loads and initializes models from the directory.
     def get_models(self, directory_name):
         LOGGER.info("Loading models from %s", directory_name)
 
-        files = []
         self.models = []
 
-        files = os.listdir(directory_name)
-        files.sort()
-        counter = 0
-
-        for filename in files:
-
-            full_path = os.path.join(directory_name, filename)
-
-            try:
-                model = sm.VTKSurfaceModel(full_path, (1.0, 1.0, 1.0))
-                model_name = os.path.splitext(model.get_name())[0]
-                model.set_name(model_name)
-
-                if self.configuration_data:
-                    if model_name in self.configuration_data.keys():
-                        model_defaults = self.configuration_data[model_name]
-
-                        if 'opacity' in model_defaults.keys():
-                            opacity = model_defaults['opacity']
-                            model.set_opacity(opacity)
-
-                        if 'visibility' in model_defaults.keys():
-                            visibility = model_defaults['visibility']
-                            model.set_visibility(visibility)
-
-                        if 'colour' in model_defaults.keys():
-                            colour = model_defaults['colour']
-                            colour_as_float = [colour[0] / 255.0,
-                                               colour[1] / 255.0,
-                                               colour[2] / 255.0
-                                               ]
-                            model.set_colour(colour_as_float)
-
-                        if 'pickable' in model_defaults.keys():
-                            pickable = model_defaults['pickable']
-                            model.set_pickable(pickable)
-
-                        if 'outline' in model_defaults.keys():
-                            outline = model_defaults['outline']
-                            model.set_outline(outline)
-
-                        if 'texture' in model_defaults.keys():
-                            texture_file = model_defaults['texture']
-                            texture_file_path = os.path.join(directory_name,
-                                                             texture_file)
-                            model.set_texture(texture_file_path)
-
-                        if 'no shading' in model_defaults.keys():
-                            no_shading = model_defaults['no shading']
-                            model.set_no_shading(no_shading)
-
-                else:
-
-                    if filename in self.colours:
-                        model_colour = self.colours[filename]
-                    else:
-                        LOGGER.info(
-                            "Filename %s not found in colours.txt", filename)
-                        model_colour = self.colours[str(counter)]
-                    model.set_colour(model_colour)
-
-                # Finally, add to list, increment counter.
+        for counter, filename in enumerate(model_files(directory_name)):
+            model = self._load_model(directory_name, filename, counter)
+            if model is not None:
                 self.models.append(model)
-                LOGGER.info("Loaded model from %s", full_path)
-                counter += 1
-
-            except ValueError:
-                # Presume wrong type of file.
-                LOGGER.info("Didn't load vtk_surface_model: %s", full_path)
 
         if not self.models:
             LOGGER.info("No valid model files in given directory")
 
         LOGGER.info("Loaded models from %s", directory_name)
 
+    # Reads bounds for every model file now, then loads the full geometry
+    # on a background thread, smallest file first. Models are only handed
+    # to the calling thread through self.loaded_models, as (model name,
+    # model or None if it failed to load, LOD mappers, locator).
+    def load_models_progressively(self, directory_name):
+        LOGGER.info("Progressively loading models from %s", directory_name)
+
+        files = model_files(directory_name)
+        counters = {filename: counter for counter, filename in enumerate(files)}
+
+        self.placeholders = []
+        for filename in files:
+            bounds = read_model_bounds(os.path.join(directory_name, filename))
+            if bounds is not None:
+                model_name = os.path.splitext(filename)[0]
+                self.placeholders.append((model_name, bounds))
+
+        by_size = sorted(files, key=lambda filename: os.path.getsize(
+            os.path.join(directory_name, filename)))
+
+        def _load_all():
+            for filename in by_size:
+                model = self._load_model(directory_name, filename,
+                                         counters[filename])
+                if model is None:
+                    self.loaded_models.put((os.path.splitext(filename)[0],
+                                            None, None, None))
+                    continue
+                mappers = None
+                if self.lod_levels:
+                    mappers = build_lod_mappers(model, self.lod_levels)
+                locator = None
+                if self.locator_type:
+                    locator = ModelLocator(model, self.locator_type)
+                    locator.build()
+                self.loaded_models.put((model.get_name(), model, mappers, locator))
+            LOGGER.info("Loaded models from %s", directory_name)
+
+        self.loading_thread = threading.Thread(target=_load_all, daemon=True)
+        self.loading_thread.start()
+
+    # Returns models finished since the last call, without blocking, and
+    # adds them to self.models. Names of files that failed to load are
+    # added to self.failed_models.
+    def get_loaded_models(self):
+        models = []
+        while True:
+            try:
+                name, model, mappers, locator = self.loaded_models.get_nowait()
+            except queue.Empty:
+                return models
+            if model is None:
+                self.failed_models.append(name)
+                continue
+            if mappers is not None:
+                self.lods[name] = mappers
+            if locator is not None:
+                self.locators[name] = locator
+            self.models.append(model)
+            models.append(model)
+
+    # True while a progressive load is still running.
+    def is_loading(self):
+        return self.loading_thread is not None and self.loading_thread.is_alive()
+
+    # Loads one model file and applies configuration or colours.
+    # Returns None if the file is not a model.
+    def _load_model(self, directory_name, filename, counter):
+        import sksurgeryvtk.models.vtk_surface_model as sm  # pylint: disable=import-outside-toplevel
+
+        full_path = os.path.join(directory_name, filename)
+
+        try:
+            model = sm.VTKSurfaceModel(full_path, (1.0, 1.0, 1.0))
+            model_name = os.path.splitext(model.get_name())[0]
+            model.set_name(model_name)
+
+            if self.configuration_data:
+                if model_name in self.configuration_data.keys():
+                    model_defaults = self.configuration_data[model_name]
+
+                    if 'opacity' in model_defaults.keys():
+                        opacity = model_defaults['opacity']
+                        model.set_opacity(opacity)
+
+                    if 'visibility' in model_defaults.keys():
+                        visibility = model_defaults['visibility']
+                        model.set_visibility(visibility)
+
+                    if 'colour' in model_defaults.keys():
+                        colour = model_defaults['colour']
+                        colour_as_float = [colour[0] / 255.0,
+                                           colour[1] / 255.0,
+                                           colour[2] / 255.0
+                                           ]
+                        model.set_colour(colour_as_float)
+
+                    if 'pickable' in model_defaults.keys():
+                        pickable = model_defaults['pickable']
+                        model.set_pickable(pickable)
+
+                    if 'outline' in model_defaults.keys():
+                        outline = model_defaults['outline']
+                        model.set_outline(outline)
+
+                    if 'texture' in model_defaults.keys():
+                        texture_file = model_defaults['texture']
+                        texture_file_path = os.path.join(directory_name,
+                                                         texture_file)
+                        model.set_texture(texture_file_path)
+
+                    if 'no shading' in model_defaults.keys():
+                        no_shading = model_defaults['no shading']
+                        model.set_no_shading(no_shading)
+
+            else:
+
+                if filename in self.colours:
+                    model_colour = self.colours[filename]
+                else:
+                    LOGGER.info(
+                        "Filename %s not found in colours.txt", filename)
+                    model_colour = self.colours[str(counter)]
+                model.set_colour(model_colour)
+
+            LOGGER.info("Loaded model from %s", full_path)
+            return model
+
+        except ValueError:
+            # Presume wrong type of file.
+            LOGGER.info("Didn't load vtk_surface_model: %s", full_path)
+            return None
+
+    # Builds decimated mappers for every loaded model.
+    def build_lods(self, lod_levels=DEFAULT_LOD_LEVELS):
+        self.lods = {}
+        for model in self.models:
+            self.lods[model.get_name()] = build_lod_mappers(model, lod_levels)
+        return self.lods
+
+    # Makes a locator for every loaded model and builds them on a background
+    # thread. A locator queried before it is built is built on first use.
+    def build_locators_in_background(self):
+        self.locators = {model.get_name(): ModelLocator(model, self.locator_type)
+                         for model in self.models}
+        locators = list(self.locators.values())
+
+        def _build_all():
+            for locator in locators:
+                locator.build()
+
+        self.locator_thread = threading.Thread(target=_build_all, daemon=True)
+        self.locator_thread.start()
+        return self.locators
+
     # Loads or sets model colors from a file or uses the provided RGB color.
     def get_model_colours(self, directory, rgb_color):
-
         self.colours = {}
 
-        default_colours = [colors.red, colors.blue, colors.green,
-                           colors.black, colors.white, colors.yellow,
-                           colors.brown, colors.grey, colors.purple,
-                           colors.pink]
+        default_colours = DEFAULT_COLOURS
 
         colour_file = directory + '/colours.txt'
 
@@ -0,0 +1,297 @@
+"""
+Fast picking on, and point to surface distances to, dense models.
+
+Testing a ray against every triangle of a million triangle vessel mesh
+takes hundreds of milliseconds. A ModelLocator keeps a spatial locator
+over a model's polydata instead, so a pick or a closest point query
+touches a handful of cells. Locators are built once, on the loader's
+background thread (ModelDirectoryLoader(locator_type=...)) or else on
+first use, and rebuilt only when the polydata changes, e.g. after
+set_model_transform()::
+
+    picker = ModelPicker()
+    picker.add_models(loader.models, loader.locators)
+    picked = picker.pick(x, y, window.get_foreground_renderer())
+    ...
+    closest = picker.closest_point(tool_tip)
+
+make_landmark_actor() marks a picked point on screen.
+
+Locators work in model coordinates. The actor matrix, e.g. set by a
+SceneGraph, is applied to the ray and the points instead, so moving a
+model never needs a rebuild. Picking always uses the full resolution
+polydata, whichever level of detail is drawn.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+# vtk is imported where it is first used, so the model loader can import
+# this module without loading VTK.
+
+LOGGER = logging.getLogger(__name__)
+
+# vtkStaticCellLocator builds fastest, in parallel, and answers both
+# queries; vtkOBBTree fits tightly around long thin vessels, but only
+# supports picking.
+LOCATOR_TYPES = ("static", "obb")
+
+# A picked surface point. position is in world coordinates, distance is
+# from the camera along the ray.
+PickedPoint = collections.namedtuple(
+    'PickedPoint', ['model_name', 'position', 'cell_id', 'distance'])
+
+# The closest surface point to a query point, in world coordinates.
+ClosestPoint = collections.namedtuple(
+    'ClosestPoint', ['model_name', 'position', 'cell_id', 'distance'])
+
+
+def _check_locator_type(locator_type):
+    if locator_type not in LOCATOR_TYPES:
+        raise ValueError(f"Locator type must be one of {LOCATOR_TYPES}, "
+                         f"not {locator_type}")
+
+
+def _actor_matrix(actor):
+    matrix = actor.GetMatrix()
+    return np.array([[matrix.GetElement(row, column) for column in range(4)]
+                     for row in range(4)])
+
+
+def _transform_point(matrix, point):
+    return matrix[0:3, 0:3] @ point + matrix[0:3, 3]
+
+
+class ModelLocator:
+    """
+    A lazily built, cached cell locator over one VTKSurfaceModel.
+
+    :param model: the model, located in its own coordinates, after its
+        model transform.
+    :param locator_type: one of LOCATOR_TYPES.
+    """
+    def __init__(self, model, locator_type="static"):
+        _check_locator_type(locator_type)
+        self.model = model
+        self.locator_type = locator_type
+        self.builds = 0
+        self.build_time = None
+        self._lock = threading.Lock()
+        self._locator = None
+        self._built_mtime = None
+
+    def _polydata(self):
+        # The full resolution polydata the model's own mapper draws.
+        return self.model.transform_filter.GetOutput()
+
+    def is_current(self):
+        """
+        Returns True if the locator is built and the polydata is unchanged.
+        """
+        return self._locator is not None \
+            and self._built_mtime == self._polydata().GetMTime()
+
+    def build(self):
+        """
+        Builds the locator unless it is current. Safe to call from a
+        background thread; a query meanwhile waits for the build.
+        """
+        import vtk  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            if self.is_current():
+                return
+            started = time.perf_counter()
+            # A copy, so the locator shares no VTK data with the renderer.
+            source = self._polydata()
+            mtime = source.GetMTime()
+            polydata = vtk.vtkPolyData()
+            polydata.DeepCopy(source)
+            if self.locator_type == "obb":
+                locator = vtk.vtkOBBTree()
+            else:
+                locator = vtk.vtkStaticCellLocator()
+            locator.SetDataSet(polydata)
+            locator.BuildLocator()
+            self.build_time = time.perf_counter() - started
+            self._locator = locator
+            self._built_mtime = mtime
+            self.builds += 1
+        LOGGER.info("Built %s locator for %s with %d cells in %.1f ms",
+                    self.locator_type, self.model.get_name(),
+                    polydata.GetNumberOfCells(), 1000.0 * self.build_time)
+
+    def get_locator(self):
+        """
+        Returns the VTK locator, building or rebuilding it first if needed.
+        """
+        if not self.is_current():
+            self.build()
+        return self._locator
+
+    def intersect(self, start, end):
+        """
+        Returns (t, point, cell id) of the first intersection of the line
+        segment start to end, in model coordinates, with t from 0 at start
+        to 1 at end, or None.
+        """
+        import vtk  # pylint: disable=import-outside-toplevel
+
+        locator = self.get_locator()
+        t = vtk.reference(0.0)
+        point = [0.0, 0.0, 0.0]
+        pcoords = [0.0, 0.0, 0.0]
+        sub_id = vtk.reference(0)
+        cell_id = vtk.reference(-1)
+        with self._lock:
+            hit = locator.IntersectWithLine(list(start), list(end), 0.0, t, point,
+                                            pcoords, sub_id, cell_id)
+        if not hit:
+            return None
+        return float(t), np.array(point), int(cell_id)
+
+    def find_closest_point(self, point):
+        """
+        Returns (closest point, cell id, distance) on the surface to point,
+        in model coordinates, or None for an empty model.
+
+        :raises: ValueError for an "obb" locator, which cannot answer it.
+        """
+        import vtk  # pylint: disable=import-outside-toplevel
+
+        if self.locator_type == "obb":
+            raise ValueError("An obb locator cannot find closest points, "
+                             "use a static locator")
+        locator = self.get_locator()
+        if locator.GetDataSet().GetNumberOfCells() == 0:
+            return None
+        closest = [0.0, 0.0, 0.0]
+        cell_id = vtk.reference(-1)
+        sub_id = vtk.reference(0)
+        distance2 = vtk.reference(0.0)
+        with self._lock:
+            locator.FindClosestPoint(list(point), closest, cell_id, sub_id, distance2)
+        return np.array(closest), int(cell_id), float(distance2) ** 0.5
+
+
+def make_landmark_actor(model, position, radius=2.0, colour=(1.0, 1.0, 0.0)):
+    """
+    Returns a sphere actor marking position, a picked point on model in
+    world coordinates, that moves with the model, e.g. with its tag.
+    """
+    import vtk  # pylint: disable=import-outside-toplevel
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputConnection(sphere.GetOutputPort())
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    actor.GetProperty().SetColor(colour)
+    actor.PickableOff()
+    # Shares the model's user matrix, as set by a SceneGraph.
+    user_matrix = model.actor.GetUserMatrix()
+    if user_matrix is not None:
+        to_user = np.linalg.inv(np.array([[user_matrix.GetElement(row, column)
+                                           for column in range(4)]
+                                          for row in range(4)]))
+        position = _transform_point(to_user, np.asarray(position, dtype=float))
+        actor.SetUserMatrix(user_matrix)
+    actor.SetPosition(*position)
+    return actor
+
+
+class ModelPicker:
+    """
+    Picks surface points of models and finds the closest surface point
+    to a given point, using one ModelLocator per model.
+
+    :param locator_type: type of the locators made for models added
+        without one.
+    """
+    def __init__(self, locator_type="static"):
+        _check_locator_type(locator_type)
+        self.locator_type = locator_type
+        self.locators = {}
+        self.last_query_time = None
+
+    def add_models(self, models, locators=None):
+        """
+        Makes models pickable here, with their locators from locators, a
+        dict of model name to ModelLocator such as ModelDirectoryLoader
+        builds, or new ones built on first use.
+        """
+        locators = locators or {}
+        for model in models:
+            name = model.get_name()
+            locator = locators.get(name)
+            if locator is None or locator.model is not model:
+                locator = ModelLocator(model, self.locator_type)
+            self.locators[name] = locator
+
+    def remove_model(self, model_name):
+        self.locators.pop(model_name, None)
+
+    def pick(self, x, y, renderer):
+        """
+        Returns the PickedPoint nearest the camera under display position
+        (x, y) of renderer, in pixels from the bottom left as VTK events
+        give them, or None. Only visible, pickable models are hit.
+        """
+        started = time.perf_counter()
+        ray = []
+        for depth in (0.0, 1.0):
+            renderer.SetDisplayPoint(x, y, depth)
+            renderer.DisplayToWorld()
+            world = np.array(renderer.GetWorldPoint())
+            ray.append(world[0:3] / world[3])
+        ray_length = float(np.linalg.norm(ray[1] - ray[0]))
+
+        nearest = None
+        for name, locator in self.locators.items():
+            actor = locator.model.actor
+            if not actor.GetVisibility() or not actor.GetPickable():
+                continue
+            to_world = _actor_matrix(actor)
+            to_model = np.linalg.inv(to_world)
+            hit = locator.intersect(_transform_point(to_model, ray[0]),
+                                    _transform_point(to_model, ray[1]))
+            if hit is None:
+                continue
+            t, point, cell_id = hit
+            if nearest is None or t < nearest[0]:
+                nearest = (t, name, _transform_point(to_world, point), cell_id)
+        self.last_query_time = time.perf_counter() - started
+
+        if nearest is None:
+            return None
+        t, name, position, cell_id = nearest
+        return PickedPoint(name, position, cell_id, t * ray_length)
+
+    def closest_point(self, point, model_names=None):
+        """
+        Returns the ClosestPoint on any of the models, or those named in
+        model_names, to point in world coordinates, or None.
+        """
+        started = time.perf_counter()
+        point = np.asarray(point, dtype=float)
+        closest = None
+        for name, locator in self.locators.items():
+            if model_names is not None and name not in model_names:
+                continue
+            to_world = _actor_matrix(locator.model.actor)
+            to_model = np.linalg.inv(to_world)
+            found = locator.find_closest_point(_transform_point(to_model, point))
+            if found is None:
+                continue
+            position = _transform_point(to_world, found[0])
+            # Measured in world coordinates, the actor matrix may scale.
+            distance = float(np.linalg.norm(position - point))
+            if closest is None or distance < closest.distance:
+                closest = ClosestPoint(name, position, found[1], distance)
+        self.last_query_time = time.perf_counter() - started
+        return closest
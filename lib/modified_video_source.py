@@ -1,18 +1,52 @@
+import collections
 import datetime
+import os
+import struct
+import threading
+import time
 import cv2
 import numpy as np
 import sksurgerycore.utilities.validate_file as vf
 import sksurgeryimage.utilities.camera_utilities as cu
+from lib.frame_pool import FramePool
+
+# Frames from several sources, paired by grab time.
+# frames, timestamps (datetime), grab_times (time.perf_counter()) and
+# frame_ids are lists with one entry per source. spread is the difference
+# in seconds between the earliest and latest grab, and synchronized is True
+# if it is within the requested tolerance.
+MultiViewFrameSet = collections.namedtuple(
+    'MultiViewFrameSet',
+    ['frames', 'timestamps', 'grab_times', 'frame_ids', 'spread', 'synchronized'])
+
+# Raw frame sequences are a .npy array of frames (count, height, width, 3)
+# with the capture times, in seconds since the epoch, in a .times.npy file
+# next to it. See convert_video_to_raw() and RawFrameSequenceSource.
+RAW_SEQUENCE_EXTENSION = ".npy"
+_NPY_HEADER_SIZE = 128
 
 class TimestampedVideoSource:
     def __init__(self, source_num_or_file, dims=None):
+        # Increments with every frame read, and the time.perf_counter() when
+        # it was read, so later stages can measure latency from capture.
+        # The id keeps counting across update_source().
+        self.frame_id = 0
+        self.capture_time = None
+        # See attach_frame_bus(), kept across update_source().
+        self.frame_bus = None
+        self._open(source_num_or_file, dims)
+
+    def _open(self, source_num_or_file, dims=None):
         self.source = cv2.VideoCapture(source_num_or_file)
         self.timestamp = None
+        self.grab_time = None
 
         if not self.source.isOpened():
             raise RuntimeError("Failed to open Video camera:" + str(source_num_or_file))
 
         self.source_name = source_num_or_file
+        # Cameras keep capturing between reads, files wait to be read.
+        self.is_live = isinstance(source_num_or_file, int)
 
         # Setting dimensions if provided
         if dims:
@@ -25,6 +59,10 @@ class TimestampedVideoSource:
 
         self.frame = np.empty((height, width, 3), dtype=np.uint8)
         self.ret = None
+        # See enable_frame_pool(). pooled_frame is this source's reference
+        # to the latest frame, released on the next read.
+        self.frame_pool = None
+        self.pooled_frame = None
 
     def validate_dimensions(self, width, height):
         if not isinstance(width, int) or not isinstance(height, int):
@@ -40,9 +78,99 @@ class TimestampedVideoSource:
         if set_w != width or set_h != height:
             raise ValueError(f"Requested resolution {width}x{height} not supported, set to {set_w}x{set_h}.")
 
+    def attach_frame_bus(self, frame_ring):
+        # Decode every frame straight into the next slot of a FrameRing
+        # (see lib/frame_bus.py), so other processes can read it without a
+        # copy. Frames returned by read() are then views of ring slots.
+        if frame_ring is not None and frame_ring.shape != self.frame.shape:
+            raise ValueError(f"Frame bus shape {frame_ring.shape} does not match "
+                             f"source shape {self.frame.shape}")
+        self.frame_bus = frame_ring
+
+    def enable_frame_pool(self, max_buffers=4):
+        # Decode every frame into a buffer from a FramePool (see
+        # lib/frame_pool.py) rather than a new array. Stages that keep a
+        # frame past the next read() must borrow_frame() and release it.
+        self.frame_pool = FramePool(self.frame.shape, self.frame.dtype, max_buffers)
+        return self.frame_pool
+
+    def borrow_frame(self):
+        # A new reference to the latest pooled frame, or None.
+        if self.pooled_frame is None:
+            return None
+        return self.pooled_frame.retain()
+
     def read(self):
+        if self.frame_bus is not None:
+            return self._read_into_frame_bus()
+        if self.frame_pool is not None:
+            return self._read_into_frame_pool()
         self.ret, self.frame = self.source.read()
         self.timestamp = datetime.datetime.now() if self.ret else None
+        if self.ret:
+            self.capture_time = time.perf_counter()
+            self.frame_id += 1
+        return self.ret, self.frame, self.timestamp
+
+    def _read_into_frame_bus(self):
+        slot = self.frame_bus.begin_write()
+        self.ret, frame = self.source.read(image=slot)
+        if self.ret and not np.shares_memory(frame, slot):
+            # The decoder could not write in place, e.g. a different size.
+            if frame.shape != slot.shape:
+                self.frame_bus.abort()
+                raise ValueError(f"Frame shape {frame.shape} does not match "
+                                 f"frame bus shape {slot.shape}")
+            np.copyto(slot, frame)
+        if not self.ret:
+            self.frame_bus.abort()
+            self.timestamp = None
+            return self.ret, None, self.timestamp
+
+        self.timestamp = datetime.datetime.now()
+        self.capture_time = time.perf_counter()
+        self.frame_id += 1
+        self.frame = slot
+        self.frame_bus.commit(self.capture_time, self.frame_id,
+                              self.timestamp.timestamp())
+        return self.ret, self.frame, self.timestamp
+
+    def _read_into_frame_pool(self):
+        pooled_frame = self.frame_pool.acquire()
+        self.ret, frame = self.source.read(image=pooled_frame.array)
+        if self.ret and not np.shares_memory(frame, pooled_frame.array):
+            if frame.shape != pooled_frame.array.shape:
+                pooled_frame.release()
+                raise ValueError(f"Frame shape {frame.shape} does not match "
+                                 f"frame pool shape {pooled_frame.array.shape}")
+            np.copyto(pooled_frame.array, frame)
+        if not self.ret:
+            pooled_frame.release()
+            self.timestamp = None
+            return self.ret, None, self.timestamp
+
+        if self.pooled_frame is not None:
+            self.pooled_frame.release()
+        self.pooled_frame = pooled_frame
+        self.timestamp = datetime.datetime.now()
+        self.capture_time = time.perf_counter()
+        self.frame_id += 1
+        self.frame = pooled_frame.array
+        return self.ret, self.frame, self.timestamp
+
+    def grab(self):
+        # Grabs the next frame without decoding it, see retrieve().
+        grabbed = self.source.grab()
+        self.grab_time = time.perf_counter() if grabbed else None
+        return grabbed
+
+    def retrieve(self):
+        # Decodes the frame from the last grab().
+        self.ret, self.frame = self.source.retrieve()
+        self.timestamp = datetime.datetime.now() if self.ret else None
+        if self.ret:
+            self.capture_time = self.grab_time
+            self.frame_id += 1
         return self.ret, self.frame, self.timestamp
 
     def isOpened(self):
@@ -53,11 +181,227 @@ class TimestampedVideoSource:
 
     def update_source(self, new_source):
         self.release()
-        self.__init__(new_source)
+        pool_size = self.frame_pool.max_buffers if self.frame_pool else None
+        if self.pooled_frame is not None:
+            self.pooled_frame.release()
+        self._open(new_source)
+        if pool_size:
+            # The new source may have a different frame size.
+            self.enable_frame_pool(pool_size)
+
+def raw_sequence_times_file(filename):
+    return os.path.splitext(filename)[0] + ".times" + RAW_SEQUENCE_EXTENSION
+
+
+def is_raw_sequence(source_num_or_file):
+    return isinstance(source_num_or_file, str) and \
+        source_num_or_file.lower().endswith(RAW_SEQUENCE_EXTENSION)
+
+
+def _npy_header(shape, dtype):
+    # A version 1.0 .npy header padded to a fixed size, so it can be
+    # rewritten with the final frame count once all frames are written.
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   'fortran_order': False,
+                   'shape': tuple(shape)})
+    header_length = _NPY_HEADER_SIZE - 10
+    if len(header) + 1 > header_length:
+        raise ValueError(f"Frame shape {shape} too large for the .npy header")
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", header_length) + \
+        header.ljust(header_length - 1).encode("latin1") + b"\n"
+
+
+def convert_video_to_raw(video_file, output_file, max_frames=None):
+    # Decodes a video file once into a raw frame sequence that
+    # RawFrameSequenceSource can replay without decoding. Frame times come
+    # from the video's timestamps; as recordings are written as they are
+    # captured, the file's modification time is taken as the end of the
+    # recording to turn them into wall clock times.
+    # Returns the number of frames written.
+    vf.validate_is_file(video_file)
+    if not output_file.lower().endswith(RAW_SEQUENCE_EXTENSION):
+        raise ValueError(f"Output file must end in {RAW_SEQUENCE_EXTENSION}")
+    source = cv2.VideoCapture(video_file)
+    if not source.isOpened():
+        raise RuntimeError("Failed to open video file:" + str(video_file))
+
+    positions = []
+    shape = None
+    try:
+        with open(output_file, "wb") as raw_file:
+            raw_file.write(_npy_header((0, 0, 0, 0), np.uint8))
+            while max_frames is None or len(positions) < max_frames:
+                ok, frame = source.read()
+                if not ok:
+                    break
+                if shape is None:
+                    shape = frame.shape
+                elif frame.shape != shape:
+                    raise ValueError(f"Frame size changed from {shape} to {frame.shape}")
+                raw_file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+                positions.append(source.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+            if shape is None:
+                raise ValueError("No frames could be read from:" + str(video_file))
+            raw_file.seek(0)
+            raw_file.write(_npy_header((len(positions),) + shape, np.uint8))
+        fps = source.get(cv2.CAP_PROP_FPS)
+    finally:
+        source.release()
+
+    positions = np.asarray(positions, dtype=np.float64)
+    if len(positions) > 1 and not np.all(np.diff(positions) > 0):
+        # Some backends don't report timestamps, assume a constant rate.
+        positions = np.arange(len(positions)) / (fps if fps > 0 else 30.0)
+    end_time = os.path.getmtime(video_file)
+    np.save(raw_sequence_times_file(output_file), end_time - positions[-1] + positions)
+    return len(positions)
+
+
+class RawFrameSequenceSource:
+    # Replays a raw frame sequence (see convert_video_to_raw()) through
+    # the same interface as TimestampedVideoSource. Frames are
+    # copy-on-write views of a memory map, so nothing is decoded and
+    # replay is limited by I/O only. The original capture times are
+    # returned as timestamps, and seek() moves to any frame.
+    # With realtime=True reads are paced to the original frame times,
+    # otherwise frames are returned as fast as they are read.
+    def __init__(self, filename, realtime=False, loop=False):
+        vf.validate_is_file(filename)
+        self.source_name = filename
+        self.frames = np.load(filename, mmap_mode='c')
+        if self.frames.ndim != 4 or self.frames.shape[3] != 3:
+            raise ValueError(f"Expected frames of shape (count, height, width, 3), "
+                             f"got {self.frames.shape}")
+
+        times_file = raw_sequence_times_file(filename)
+        if os.path.isfile(times_file):
+            self.frame_times = np.load(times_file)
+        else:
+            self.frame_times = np.arange(len(self.frames)) / 30.0
+        if self.frame_times.shape != (len(self.frames),):
+            raise ValueError(f"{times_file} has {len(self.frame_times)} times "
+                             f"for {len(self.frames)} frames")
+
+        self.realtime = realtime
+        self.loop = loop
+        self.is_live = False
+        self.position = 0
+        self.grabbed_index = None
+        self.frame = None
+        self.ret = None
+        self.timestamp = None
+        self.grab_time = None
+        self.frame_id = 0
+        self.capture_time = None
+        self._replay_start = None
+
+    @property
+    def frame_count(self):
+        # 0 once released.
+        return len(self.frames) if self.frames is not None else 0
+
+    def seek(self, index):
+        # Makes frame index the next one read.
+        if self.frames is None:
+            raise ValueError(f"Cannot seek {self.source_name}, it was released")
+        if not 0 <= index <= self.frame_count:
+            raise ValueError(f"Frame {index} out of range 0 to {self.frame_count}")
+        self.position = index
+        self._replay_start = None
+
+    def grab(self):
+        if self.frames is None:
+            return False
+        if self.position >= self.frame_count:
+            if not self.loop or self.frame_count == 0:
+                self.grab_time = None
+                return False
+            self.seek(0)
+        self.grabbed_index = self.position
+        self.position += 1
+        if self.realtime:
+            self._wait_for_frame_time(self.grabbed_index)
+        self.grab_time = time.perf_counter()
+        return True
+
+    def _wait_for_frame_time(self, index):
+        now = time.perf_counter()
+        if self._replay_start is None:
+            self._replay_start = (now, self.frame_times[index])
+            return
+        start, first_time = self._replay_start
+        delay = start + (self.frame_times[index] - first_time) - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def retrieve(self):
+        if self.grabbed_index is None:
+            self.ret, self.frame, self.timestamp = False, None, None
+            return self.ret, self.frame, self.timestamp
+        index = self.grabbed_index
+        self.grabbed_index = None
+        self.ret = True
+        self.frame = self.frames[index]
+        self.timestamp = datetime.datetime.fromtimestamp(float(self.frame_times[index]))
+        self.capture_time = self.grab_time
+        # Ids follow the position in the sequence, so replays are repeatable.
+        self.frame_id = index + 1
+        return self.ret, self.frame, self.timestamp
+
+    def read(self):
+        if not self.grab():
+            self.ret, self.frame, self.timestamp = False, None, None
+            return self.ret, self.frame, self.timestamp
+        return self.retrieve()
+
+    def isOpened(self):
+        return self.frames is not None
+
+    def release(self):
+        self.frames = None
+
+
+def file_frame_rate(video_source):
+    # Frames per second a file source was recorded at, so it can be read
+    # at that rate, or None for cameras and raw sequences replayed in
+    # real time, which are paced already.
+    if getattr(video_source, "is_live", False):
+        return None
+    if isinstance(video_source, RawFrameSequenceSource):
+        if video_source.realtime or video_source.frame_count < 2:
+            return None
+        intervals = np.diff(video_source.frame_times)
+        interval = float(np.median(intervals[intervals > 0])) if np.any(intervals > 0) else 0.0
+        return 1.0 / interval if interval > 0 else 30.0
+    fps = video_source.source.get(cv2.CAP_PROP_FPS)
+    return fps if fps > 0 else 30.0
+
+
+def open_video_source(camera_num_or_file, dims=None):
+    # A RawFrameSequenceSource for raw .npy sequences, otherwise a
+    # TimestampedVideoSource for the camera or video file.
+    if is_raw_sequence(camera_num_or_file):
+        video_source = RawFrameSequenceSource(camera_num_or_file)
+        if dims and tuple(dims) != video_source.frames.shape[2:0:-1]:
+            raise ValueError(f"Raw sequence {camera_num_or_file} is not {dims[0]}x{dims[1]}")
+        return video_source
+    return TimestampedVideoSource(camera_num_or_file, dims)
+
 
 class VideoSourceWrapper:
     def __init__(self):
         self.sources = []
+        # Per source history of (grab_time, frame, timestamp, frame_id),
+        # filled by capture threads, see start_capture_threads().
+        self.histories = []
+        self.capture_threads = []
+        self.history_lock = threading.Lock()
+        self.history_condition = threading.Condition(self.history_lock)
+        # Per source grab time of the last frame returned from the history,
+        # so no frame set is returned twice. Grab times rather than frame
+        # ids, as ids of looping raw sequences repeat.
+        self.last_grab_times = []
+        self.capturing = False
 
     def add_camera(self, camera_number, dims=None):
         cu.validate_camera_input(camera_number)
@@ -68,15 +412,141 @@ class VideoSourceWrapper:
         self.add_source(filename, dims)
 
     def add_source(self, camera_num_or_file, dims=None):
-        video_source = TimestampedVideoSource(camera_num_or_file, dims)
-        self.sources.append(video_source)
+        self.sources.append(open_video_source(camera_num_or_file, dims))
 
     def are_all_sources_open(self):
         return all(source.isOpened() for source in self.sources)
 
     def release_all_sources(self):
+        self.stop_capture_threads()
         for source in self.sources:
             source.release()
 
     def get_next_frames(self):
         return [source.read()[1] for source in self.sources if source.isOpened()]
+
+    def get_synchronized_frames(self, tolerance=0.010, max_regrabs=2, timeout=1.0):
+        # Returns a MultiViewFrameSet with one frame per open source, whose
+        # grab times lie within tolerance seconds where possible.
+        # With capture threads, waits up to timeout seconds for a new frame
+        # from every source; sources without one give None.
+        if self.capturing:
+            return self._pair_captured_frames(tolerance, timeout)
+
+        sources = [source for source in self.sources if source.isOpened()]
+
+        # Grab back to back, then decode, so the grabs are close in time.
+        grabbed = [source.grab() for source in sources]
+        for _ in range(max_regrabs):
+            grab_times = [source.grab_time for source, ok in zip(sources, grabbed) if ok]
+            if not grab_times or max(grab_times) - min(grab_times) <= tolerance:
+                break
+            # Cameras grabbed well before the latest one probably returned an
+            # older, buffered frame, so grab those again. Grabbing a file
+            # again would skip a frame, so files keep theirs.
+            latest = max(grab_times)
+            lagging = [index for index, source in enumerate(sources)
+                       if grabbed[index] and source.is_live
+                       and latest - source.grab_time > tolerance]
+            if not lagging:
+                break
+            for index in lagging:
+                grabbed[index] = sources[index].grab()
+
+        frames, timestamps, grab_times, frame_ids = [], [], [], []
+        for source, ok in zip(sources, grabbed):
+            if ok:
+                ok, frame, timestamp = source.retrieve()
+            if not ok:
+                frame, timestamp = None, None
+            frames.append(frame)
+            timestamps.append(timestamp)
+            grab_times.append(source.capture_time if ok else None)
+            frame_ids.append(source.frame_id if ok else None)
+
+        return self._make_frame_set(frames, timestamps, grab_times, frame_ids, tolerance)
+
+    def start_capture_threads(self, history=4):
+        # Captures every source continuously on its own thread, so cameras
+        # are read in parallel. get_synchronized_frames() then pairs frames
+        # from the recent history by grab time. Files are read at their
+        # frame rate, see file_frame_rate().
+        if self.capturing:
+            return
+        self.capturing = True
+        self.histories = [collections.deque(maxlen=history) for _ in self.sources]
+        self.last_grab_times = [None] * len(self.sources)
+        self.capture_threads = []
+        for source, source_history in zip(self.sources, self.histories):
+            thread = threading.Thread(target=self._capture_loop,
+                                      args=(source, source_history), daemon=True)
+            thread.start()
+            self.capture_threads.append(thread)
+
+    def stop_capture_threads(self):
+        self.capturing = False
+        with self.history_condition:
+            self.history_condition.notify_all()
+        for thread in self.capture_threads:
+            thread.join()
+        self.capture_threads = []
+
+    def _capture_loop(self, source, source_history):
+        # Files are read at their frame rate, so they keep pace with each
+        # other and with cameras rather than racing ahead.
+        frame_rate = file_frame_rate(source)
+        next_read = time.perf_counter()
+        while self.capturing and source.isOpened():
+            if frame_rate:
+                delay = next_read - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_read = max(next_read + 1.0 / frame_rate,
+                                time.perf_counter() - 1.0 / frame_rate)
+            if not source.grab():
+                break
+            ok, frame, timestamp = source.retrieve()
+            if ok:
+                with self.history_condition:
+                    source_history.append((source.capture_time, frame, timestamp, source.frame_id))
+                    self.history_condition.notify_all()
+
+    def _new_history_entries(self):
+        # Entries grabbed after the last frame returned, per source.
+        return [[entry for entry in source_history
+                 if last_grab_time is None or entry[0] > last_grab_time]
+                for source_history, last_grab_time
+                in zip(self.histories, self.last_grab_times)]
+
+    def _pair_captured_frames(self, tolerance, timeout):
+        with self.history_condition:
+            self.history_condition.wait_for(
+                lambda: not self.capturing or all(self._new_history_entries()),
+                timeout)
+            histories = self._new_history_entries()
+
+        available = [source_history for source_history in histories if source_history]
+        frames, timestamps, grab_times, frame_ids = [], [], [], []
+        # The newest time every source has a frame for.
+        reference = min((source_history[-1][0] for source_history in available),
+                        default=None)
+        for index, source_history in enumerate(histories):
+            if not source_history:
+                entry = (None, None, None, None)
+            else:
+                entry = min(source_history, key=lambda item: abs(item[0] - reference))
+                self.last_grab_times[index] = entry[0]
+            grab_times.append(entry[0])
+            frames.append(entry[1])
+            timestamps.append(entry[2])
+            frame_ids.append(entry[3])
+
+        return self._make_frame_set(frames, timestamps, grab_times, frame_ids, tolerance)
+
+    @staticmethod
+    def _make_frame_set(frames, timestamps, grab_times, frame_ids, tolerance):
+        valid_times = [grab_time for grab_time in grab_times if grab_time is not None]
+        spread = max(valid_times) - min(valid_times) if valid_times else None
+        synchronized = spread is not None and spread <= tolerance \
+            and len(valid_times) == len(grab_times)
+        return MultiViewFrameSet(frames, timestamps, grab_times, frame_ids, spread, synchronized)
@@ -0,0 +1,122 @@
+"""
+Cheap change detection, to skip marker detection on frames where nothing
+has moved.
+
+Each frame is shrunk to a small grey thumbnail and compared with the
+thumbnail of the last frame that was fully tracked. The frame counts as
+moved if enough thumbnail pixels changed anywhere, e.g. a marker came into
+view, or if any pixel changed inside the regions of the markers found last
+time, so small markers moving are not missed. A refresh interval forces
+full tracking every so many frames regardless, so slow drift below the
+thresholds cannot go unnoticed for long.
+"""
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Decides per frame whether detection needs to run.
+
+    :param scale: downsampling factor of the thumbnail.
+    :param pixel_threshold: grey level change of a thumbnail pixel that
+        counts as a change, well above camera noise once downsampled.
+    :param area_fraction: fraction of thumbnail pixels that must change,
+        anywhere in the thumbnail, for the frame to count as moved. Inside
+        the marker regions any changed pixel counts.
+    :param refresh_interval: frames after which detection runs anyway.
+    :param roi_margin: margin in pixels added around each marker region.
+    """
+    def __init__(self, scale=8, pixel_threshold=10, area_fraction=0.002,
+                 refresh_interval=15, roi_margin=8):
+        if scale < 1:
+            raise ValueError("Scale must be >= 1")
+        if refresh_interval < 1:
+            raise ValueError("Refresh interval must be >= 1")
+        self.scale = scale
+        self.pixel_threshold = pixel_threshold
+        self.area_fraction = area_fraction
+        self.refresh_interval = refresh_interval
+        self.roi_margin = roi_margin
+        self.frames = 0
+        self.skipped = 0
+        self._reference = None
+        self._roi_mask = None
+        self._since_refresh = 0
+        self._thumbnail = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns a gate for the tracker's "motion gate" setting: False or
+        None for none, True for the defaults, or a dict of parameters.
+        """
+        if not config:
+            return None
+        if config is True:
+            return cls()
+        return cls(**config)
+
+    def _make_thumbnail(self, frame):
+        height, width = frame.shape[0:2]
+        size = (max(1, width // self.scale), max(1, height // self.scale))
+        thumbnail = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        return thumbnail
+
+    def has_moved(self, frame):
+        """
+        Returns True if frame must be tracked in full, False if the last
+        result can be reused. If True, call set_reference() once the frame
+        is tracked.
+        """
+        self.frames += 1
+        self._thumbnail = self._make_thumbnail(frame)
+        reference = self._reference
+        if reference is None or reference.shape != self._thumbnail.shape \
+                or self._since_refresh >= self.refresh_interval:
+            return True
+
+        changed = cv2.absdiff(self._thumbnail, reference) > self.pixel_threshold
+        if np.count_nonzero(changed) > self.area_fraction * changed.size:
+            return True
+        if self._roi_mask is not None and np.any(changed & self._roi_mask):
+            return True
+
+        self._since_refresh += 1
+        self.skipped += 1
+        return False
+
+    def set_reference(self, marker_corners):
+        """
+        Makes the frame last passed to has_moved() the reference, with the
+        corners of the markers found in it, as returned by detectMarkers.
+        """
+        self._reference = self._thumbnail
+        self._since_refresh = 0
+        self._roi_mask = None
+        if not marker_corners:
+            return
+
+        mask = np.zeros(self._reference.shape, dtype=np.uint8)
+        margin = self.roi_margin
+        for corners in marker_corners:
+            points = np.reshape(corners, (-1, 2))
+            x_0, y_0 = np.floor((points.min(axis=0) - margin) / self.scale).astype(int)
+            x_1, y_1 = np.ceil((points.max(axis=0) + margin) / self.scale).astype(int)
+            mask[max(y_0, 0):max(y_1 + 1, 0), max(x_0, 0):max(x_1 + 1, 0)] = 1
+        self._roi_mask = mask.astype(bool)
+
+    def invalidate(self):
+        """
+        Forces full tracking of the next frame, e.g. after a setting changed.
+        """
+        self._reference = None
+
+    def skip_rate(self):
+        """
+        Returns the fraction of frames skipped so far.
+        """
+        return self.skipped / self.frames if self.frames else 0.0
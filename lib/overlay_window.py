@@ -1,4 +1,5 @@
 import logging
+import time
 import cv2
 import numpy as np
 import sksurgerycore.utilities.validate_matrix as vm
@@ -10,6 +11,8 @@ from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 import sksurgeryvtk.camera.vtk_camera_model as cm
 import sksurgeryvtk.utils.matrix_utils as mu
 
+from lib.transform_manager import TransformManager
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -35,6 +38,11 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         # Take and cache/store constructor arguments.
         if offscreen:
+            # Render into a window of its own rather than the widget's native
+            # window, so rendering works without a display, e.g. with EGL or
+            # OSMesa on a headless machine.
+            self._RenderWindow = vtk.vtkRenderWindow()
+            self._Iren.SetRenderWindow(self._RenderWindow)
             self.GetRenderWindow().SetOffScreenRendering(1)
         else:
             self.GetRenderWindow().SetOffScreenRendering(0)
@@ -63,6 +71,31 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
         self.vtk_array = None
         self.interactor = None
 
+        # Called with the duration in seconds after every render.
+        self.render_end_callbacks = []
+        self.overlay_text_actor = None
+
+        # Bounding box actors shown while models load, keyed by model name.
+        self.placeholder_actors = {}
+
+        # Level of detail switching, see add_model_lods().
+        self.lod_entries = []
+        self.lod_bias = 0
+        self.frame_budget = 1.0 / 30.0
+        self.lod_screen_thresholds = (0.25, 0.05)
+        self.lod_hold_frames = 15
+        self.render_time = None
+        self.last_render_time = None
+        self._render_start = None
+        self._frames_since_lod_change = 0
+
+        # Side-by-side stereo, see enable_stereo(). Eye poses relative to
+        # the tracked camera are kept as "lefteye2camera" and "righteye2camera".
+        self.stereo = False
+        self.eye_transforms = TransformManager()
+        self.right_eye_renderers = {}
+        self._stereo_props_mtimes = {}
+
         # Setup an image importer to import the RGB video image.
         # Until the image is set, we use the default one created above.
         self.rgb_image_extent = (
@@ -168,6 +201,10 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
         else:
             self.GetRenderWindow().AddRenderer(self.layer_1_renderer)
 
+        # Time every render, so levels of detail can follow the frame budget.
+        self.GetRenderWindow().AddObserver("StartEvent", self._on_render_start)
+        self.GetRenderWindow().AddObserver("EndEvent", self._on_render_end)
+
         # Set Qt Size Policy
         self.size_policy = QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.setSizePolicy(self.size_policy)
@@ -257,7 +294,11 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         if self.video_in_layer_0:
             self.rgb_input = input_image
-            self.rgb_frame = np.copy(self.rgb_input[:, :, ::-1])
+            # Reuse the RGB buffer while the frame size stays the same.
+            if self.rgb_frame is None or self.rgb_frame.shape != input_image.shape \
+                    or self.rgb_frame.dtype != input_image.dtype:
+                self.rgb_frame = np.empty_like(input_image)
+            np.copyto(self.rgb_frame, self.rgb_input[:, :, ::-1])
             self.rgb_image_importer.SetImportVoidPointer(self.rgb_frame.data)
             self.rgb_image_importer.SetDataExtent(self.rgb_image_extent)
             self.rgb_image_importer.SetWholeExtent(self.rgb_image_extent)
@@ -266,17 +307,18 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         if self.video_in_layer_2:
             self.rgb_input = input_image
-            self.rgba_frame = 255 * np.ones(
-                (
-                    input_image.shape[0],
-                    input_image.shape[1],
-                    input_image.shape[2] + 1,
-                ),
-                dtype=np.uint8,
+            rgba_shape = (
+                input_image.shape[0],
+                input_image.shape[1],
+                input_image.shape[2] + 1,
             )
+            if self.rgba_frame is None or self.rgba_frame.shape != rgba_shape:
+                self.rgba_frame = np.empty(rgba_shape, dtype=np.uint8)
             self.rgba_frame[:, :, 0:3] = self.rgb_input[:, :, ::-1]
             if self.mask_image is not None:
                 self.rgba_frame[:, :, 3:4] = self.mask_image
+            else:
+                self.rgba_frame[:, :, 3] = 255
             self.rgba_image_importer.SetImportVoidPointer(self.rgba_frame.data)
             self.rgba_image_importer.SetDataExtent(self.rgba_image_extent)
             self.rgba_image_importer.SetWholeExtent(self.rgba_image_extent)
@@ -297,13 +339,13 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
         i_h = (image_extent[3] - image_extent[2] + 1) * spacing[1]
 
         # Works out the ratio of required size to actual size.
-        w_r = i_w / self.width()
+        w_r = i_w / self._eye_width()
         h_r = i_h / self.height()
 
         # Then you adjust scale differently depending on whether the
         # screen is predominantly wider than your image, or taller.
         if w_r > h_r:
-            scale = 0.5 * i_w * (self.height() / self.width())
+            scale = 0.5 * i_w * (self.height() / self._eye_width())
         else:
             scale = 0.5 * i_h
 
@@ -325,7 +367,7 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
                 self.layer_2_renderer.GetActiveCamera(), self.rgba_image_extent
             )
 
-    def __update_projection_matrix(self, renderer, camera, input_image):
+    def __update_projection_matrix(self, renderer, camera, input_image, eye=0):
 
         opengl_mat = None
         vtk_mat = None
@@ -347,8 +389,9 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
                 self.clipping_range[1],
             )
 
+            eye_width = self._eye_width()
             vpx, vpy, vpw, vph = cm.compute_scissor(
-                self.width(),
+                eye_width,
                 self.height(),
                 input_image.shape[1],
                 input_image.shape[0],
@@ -356,8 +399,12 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
             )
 
             x_min, y_min, x_max, y_max = cm.compute_viewport(
-                self.width(), self.height(), vpx, vpy, vpw, vph
+                eye_width, self.height(), vpx, vpy, vpw, vph
             )
+            if self.stereo:
+                # Each eye is drawn in its own half of the window.
+                x_min, x_max = 0.5 * (eye + x_min), 0.5 * (eye + x_max)
+                vpx += eye * eye_width
 
             renderer.SetViewport(x_min, y_min, x_max, y_max)
 
@@ -383,6 +430,16 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
             self.rgb_input,
         )
 
+        if self.stereo:
+            for layer in (1, 3):
+                renderer = self.right_eye_renderers[layer]
+                self.__update_projection_matrix(
+                    renderer,
+                    renderer.GetActiveCamera(),
+                    self.rgb_input,
+                    eye=1,
+                )
+
         return opengl_mat, vtk_mat
 
     def resizeEvent(self, ev):
@@ -404,7 +461,19 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         vm.validate_rigid_matrix(camera_to_world)
         self.camera_to_world = camera_to_world
-        vtk_mat = mu.create_vtk_matrix_from_numpy(camera_to_world)
+        if self.stereo:
+            # Both eyes from the one tracked pose.
+            vtk_mat = mu.create_vtk_matrix_from_numpy(
+                camera_to_world @ self.eye_transforms.get("lefteye2camera"))
+            right_mat = mu.create_vtk_matrix_from_numpy(
+                camera_to_world @ self.eye_transforms.get("righteye2camera"))
+            for layer in (1, 3):
+                cm.set_camera_pose(
+                    self.right_eye_renderers[layer].GetActiveCamera(),
+                    right_mat, self.opencv_style
+                )
+        else:
+            vtk_mat = mu.create_vtk_matrix_from_numpy(camera_to_world)
         cm.set_camera_pose(
             self.layer_1_renderer.GetActiveCamera(), vtk_mat, self.opencv_style
         )
@@ -413,6 +482,121 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
         )
         self.Render()
 
+    def set_eye_offsets(self, left_eye_to_camera, right_eye_to_camera):
+        """
+        Sets the calibrated pose of each eye relative to the tracked camera,
+        as 4x4 transforms, used by stereo rendering.
+        """
+        self.eye_transforms.add("lefteye2camera", np.asarray(left_eye_to_camera, dtype=np.float64))
+        self.eye_transforms.add("righteye2camera", np.asarray(right_eye_to_camera, dtype=np.float64))
+        if self.stereo:
+            self.set_camera_pose(self.camera_to_world)
+
+    def load_eye_offsets(self, textfile):
+        """
+        Loads the eye offsets from a text file of 8 rows of 4 numbers, the
+        left eye to camera transform followed by the right one.
+        """
+        transforms = np.loadtxt(textfile)
+        if transforms.shape != (8, 4):
+            raise ValueError(f"{textfile} should hold two 4x4 transforms, "
+                             f"not {transforms.shape}")
+        self.set_eye_offsets(transforms[0:4], transforms[4:8])
+
+    def enable_stereo(self, eye_separation=63.0):
+        """
+        Renders both eyes side by side in one render: the left eye in the
+        left half of the window and the right eye in the right half.
+
+        Each layer gets a second renderer for the right eye holding the same
+        actors, so the video is uploaded once and model geometry and levels
+        of detail are shared; only the camera differs. Eye poses come from
+        set_eye_offsets(), or if none were set, from eye_separation in mm
+        along the camera's x axis.
+        """
+        if self.stereo:
+            return
+        if self.zbuffer:
+            raise ValueError("Stereo rendering needs the layered window, not zbuffer output.")
+        if not self.eye_transforms.exists("lefteye2camera"):
+            left_eye, right_eye = np.eye(4), np.eye(4)
+            left_eye[0, 3] = -0.5 * eye_separation
+            right_eye[0, 3] = 0.5 * eye_separation
+            self.set_eye_offsets(left_eye, right_eye)
+
+        render_window = self.GetRenderWindow()
+        for layer in (0, 1, 2, 3):
+            left = self.get_layer_renderer(layer)
+            right = vtk.vtkRenderer()
+            right.SetLayer(layer)
+            right.InteractiveOff()
+            right.SetLightFollowCamera(left.GetLightFollowCamera())
+            right.SetUseDepthPeeling(left.GetUseDepthPeeling())
+            right.SetMaximumNumberOfPeels(left.GetMaximumNumberOfPeels())
+            right.SetOcclusionRatio(left.GetOcclusionRatio())
+            if layer in (0, 2):
+                # The video looks the same to both eyes.
+                right.SetActiveCamera(left.GetActiveCamera())
+            else:
+                right.GetActiveCamera().DeepCopy(left.GetActiveCamera())
+            render_window.AddRenderer(right)
+            self.right_eye_renderers[layer] = right
+        self.stereo = True
+        self._stereo_props_mtimes = {}
+        self._sync_stereo_props()
+        self._update_stereo_viewports()
+        self.set_camera_pose(self.camera_to_world)
+
+    def disable_stereo(self):
+        """
+        Goes back to one view filling the window.
+        """
+        if not self.stereo:
+            return
+        render_window = self.GetRenderWindow()
+        for right in self.right_eye_renderers.values():
+            right.RemoveAllViewProps()
+            render_window.RemoveRenderer(right)
+        self.right_eye_renderers = {}
+        self.stereo = False
+        self._update_stereo_viewports()
+        self.set_camera_pose(self.camera_to_world)
+
+    def _eye_width(self):
+        # Width in pixels of the view of one eye.
+        return self.width() // 2 if self.stereo else self.width()
+
+    def _update_stereo_viewports(self):
+        for layer in (0, 2):
+            if self.stereo:
+                self.get_layer_renderer(layer).SetViewport(0.0, 0.0, 0.5, 1.0)
+                self.right_eye_renderers[layer].SetViewport(0.5, 0.0, 1.0, 1.0)
+            else:
+                self.get_layer_renderer(layer).SetViewport(0.0, 0.0, 1.0, 1.0)
+        if self.camera_matrix is None:
+            # Otherwise the projection update below sets these viewports.
+            for layer in (1, 3):
+                if self.stereo:
+                    self.get_layer_renderer(layer).SetViewport(0.0, 0.0, 0.5, 1.0)
+                    self.right_eye_renderers[layer].SetViewport(0.5, 0.0, 1.0, 1.0)
+                else:
+                    self.get_layer_renderer(layer).SetViewport(0.0, 0.0, 1.0, 1.0)
+        self.__update_video_image_cameras()
+        self.__update_projection_matrices()
+
+    def _sync_stereo_props(self):
+        # Gives each right eye renderer the props of its left eye renderer,
+        # whenever actors were added or removed since the last render.
+        for layer, right in self.right_eye_renderers.items():
+            props = self.get_layer_renderer(layer).GetViewProps()
+            if self._stereo_props_mtimes.get(layer) == props.GetMTime():
+                continue
+            self._stereo_props_mtimes[layer] = props.GetMTime()
+            right.RemoveAllViewProps()
+            props.InitTraversal()
+            for _ in range(props.GetNumberOfItems()):
+                right.AddViewProp(props.GetNextProp())
+
     def add_vtk_models(self, models, layer=1):
 
         renderer = self.get_foreground_renderer(layer=layer)
@@ -425,6 +609,160 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
         if self.reset_camera:
             renderer.ResetCamera()
 
+    def add_model_placeholders(self, placeholders, layer=1):
+        """
+        Shows a wireframe bounding box for each model that is still loading.
+
+        :param placeholders: list of (model name, bounds) tuples, where bounds
+            is (xmin, xmax, ymin, ymax, zmin, zmax).
+        """
+        renderer = self.get_foreground_renderer(layer=layer)
+
+        for name, bounds in placeholders:
+            outline = vtk.vtkOutlineSource()
+            outline.SetBounds(bounds)
+            mapper = vtk.vtkPolyDataMapper()
+            mapper.SetInputConnection(outline.GetOutputPort())
+            actor = vtk.vtkActor()
+            actor.SetMapper(mapper)
+            actor.PickableOff()
+            renderer.AddActor(actor)
+            self.placeholder_actors[name] = (actor, renderer)
+
+        if placeholders and self.reset_camera:
+            renderer.ResetCamera()
+
+    def swap_in_loaded_models(self, model_loader, layer=1):
+        """
+        Adds any models a progressive ModelDirectoryLoader has finished since
+        the last call, replacing their placeholders. Must be called from the
+        GUI thread, e.g. once per update.
+
+        :returns: list of the models added.
+        """
+        models = model_loader.get_loaded_models()
+
+        # Files that failed to load keep no placeholder.
+        for name in model_loader.failed_models:
+            placeholder = self.placeholder_actors.pop(name, None)
+            if placeholder is not None:
+                placeholder[1].RemoveActor(placeholder[0])
+
+        if not models:
+            return models
+
+        renderer = self.get_foreground_renderer(layer=layer)
+        for model in models:
+            placeholder = self.placeholder_actors.pop(model.get_name(), None)
+            if placeholder is not None:
+                placeholder[1].RemoveActor(placeholder[0])
+            renderer.AddActor(model.actor)
+            if model.get_outline():
+                renderer.AddActor(model.get_outline_actor(renderer.GetActiveCamera()))
+
+        if model_loader.lods:
+            self.add_model_lods(models, model_loader.lods, layer=layer)
+
+        # Without placeholders to frame the scene, frame the first arrivals.
+        if self.reset_camera and not self.placeholder_actors \
+                and len(models) == len(model_loader.models):
+            renderer.ResetCamera()
+
+        return models
+
+    def add_model_lods(self, models, lods, layer=1):
+        """
+        Registers levels of detail for models already added to the window.
+
+        :param models: list of VTKSurfaceModel.
+        :param lods: dict of model name to a list of mappers, finest first,
+            as built by ModelDirectoryLoader(lod_levels=...).
+        :param layer: foreground layer the models were added to.
+        """
+        renderer = self.get_foreground_renderer(layer=layer)
+        for model in models:
+            mappers = lods.get(model.get_name())
+            if not mappers:
+                continue
+            self.lod_entries.append({"actor": model.actor,
+                                     "mappers": mappers,
+                                     "renderer": renderer,
+                                     "level": 0})
+
+    def set_frame_budget(self, frame_budget):
+        """
+        Sets the target render time in seconds used to pick levels of detail.
+        """
+        if frame_budget <= 0:
+            raise ValueError("Frame budget must be > 0.")
+        self.frame_budget = frame_budget
+
+    def _on_render_start(self, _caller, _event):
+        self._render_start = time.perf_counter()
+        if self.stereo:
+            self._sync_stereo_props()
+
+    def _on_render_end(self, _caller, _event):
+        if self._render_start is None:
+            return
+        elapsed = time.perf_counter() - self._render_start
+        self.last_render_time = elapsed
+        for callback in self.render_end_callbacks:
+            callback(elapsed)
+        if self.render_time is None:
+            self.render_time = elapsed
+        else:
+            self.render_time = 0.9 * self.render_time + 0.1 * elapsed
+        if self.lod_entries:
+            self._update_lods()
+
+    def _update_lods(self):
+        # Global bias, coarser when over budget, finer with plenty headroom.
+        # Changes are held for a number of frames to avoid flicker.
+        max_level = max(len(entry["mappers"]) for entry in self.lod_entries) - 1
+        self._frames_since_lod_change += 1
+        if self._frames_since_lod_change >= self.lod_hold_frames:
+            if self.render_time > self.frame_budget and self.lod_bias < max_level:
+                self.lod_bias += 1
+                self._frames_since_lod_change = 0
+            elif self.render_time < 0.5 * self.frame_budget and self.lod_bias > 0:
+                self.lod_bias -= 1
+                self._frames_since_lod_change = 0
+
+        # Per model level, from the projected size of its bounding box.
+        for renderer in {id(entry["renderer"]): entry["renderer"]
+                         for entry in self.lod_entries}.values():
+            entries = [entry for entry in self.lod_entries
+                       if entry["renderer"] is renderer]
+            camera = renderer.GetActiveCamera()
+            vtk_mat = camera.GetCompositeProjectionTransformMatrix(
+                renderer.GetTiledAspectRatio(), -1, 1)
+            projection = np.array([[vtk_mat.GetElement(i, j) for j in range(4)]
+                                   for i in range(4)])
+
+            corners = np.ones((len(entries), 8, 4))
+            for index, entry in enumerate(entries):
+                x_0, x_1, y_0, y_1, z_0, z_1 = entry["actor"].GetBounds()
+                corners[index, :, 0:3] = [[x, y, z] for x in (x_0, x_1)
+                                          for y in (y_0, y_1)
+                                          for z in (z_0, z_1)]
+            projected = corners @ projection.T
+            in_front = np.all(projected[:, :, 3] > 0, axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ndc = projected[:, :, 0:2] / projected[:, :, 3:4]
+            extent = 0.5 * np.max(np.ptp(ndc, axis=1), axis=1)
+
+            for index, entry in enumerate(entries):
+                if not in_front[index] or not np.isfinite(extent[index]):
+                    size_level = len(self.lod_screen_thresholds)
+                else:
+                    size_level = sum(1 for threshold in self.lod_screen_thresholds
+                                     if extent[index] < threshold)
+                level = min(len(entry["mappers"]) - 1, size_level + self.lod_bias)
+                if level != entry["level"]:
+                    entry["actor"].SetMapper(entry["mappers"][level])
+                    entry["level"] = level
+
     def add_vtk_actor(self, actor, layer=1):
 
         renderer = self.get_foreground_renderer(layer=layer)
@@ -493,6 +831,40 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         return self.layer_4_renderer
 
+    def get_layer_renderer(self, layer):
+        """
+        Returns the renderer of any layer, 0 to 4; for the left eye in stereo.
+        """
+        renderers = (self.layer_0_renderer, self.layer_1_renderer, self.layer_2_renderer,
+                     self.layer_3_renderer, self.layer_4_renderer)
+        if not 0 <= layer < len(renderers):
+            raise ValueError(f"Invalid layer specification:{layer}")
+        return renderers[layer]
+
+    def set_overlay_text(self, text, position=(10, 10), font_size=14):
+        """
+        Shows text in the overlay layer (4), e.g. for diagnostics.
+        Pass None to hide it.
+        """
+        if text is None:
+            if self.overlay_text_actor is not None:
+                self.overlay_text_actor.VisibilityOff()
+            return
+
+        if self.overlay_text_actor is None:
+            self.overlay_text_actor = vtk.vtkTextActor()
+            text_property = self.overlay_text_actor.GetTextProperty()
+            text_property.SetFontFamilyToCourier()
+            text_property.SetColor(1.0, 1.0, 0.0)
+            text_property.SetBackgroundColor(0.0, 0.0, 0.0)
+            text_property.SetBackgroundOpacity(0.5)
+            self.get_overlay_renderer().AddActor2D(self.overlay_text_actor)
+
+        self.overlay_text_actor.GetTextProperty().SetFontSize(font_size)
+        self.overlay_text_actor.SetDisplayPosition(position[0], position[1])
+        self.overlay_text_actor.SetInput(text)
+        self.overlay_text_actor.VisibilityOn()
+
     def set_screen(self, screen):
 
         self.screen = screen
@@ -506,10 +878,16 @@ class VTKOverlayWindow(QVTKRenderWindowInteractor):
 
         self._RenderWindow.SetStereoTypeToRight()
 
-    def convert_scene_to_numpy_array(self):
+    def convert_scene_to_numpy_array(self, rerender=True):
+        """
+        Reads the rendered scene back as a numpy array.
 
+        :param rerender: render the window before reading it, False to read
+            what the last render drew, e.g. right after GetRenderWindow().Render().
+        """
         vtk_win_to_img_filter = vtk.vtkWindowToImageFilter()
         vtk_win_to_img_filter.SetInput(self.GetRenderWindow())
+        vtk_win_to_img_filter.SetShouldRerender(rerender)
 
         if not self.zbuffer:
             vtk_win_to_img_filter.SetInputBufferTypeToRGB()
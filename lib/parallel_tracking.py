@@ -0,0 +1,259 @@
+"""
+Runs one ArUcoTracker per video source in its own process.
+
+Frames are written into a shared memory FrameRing per source by the
+capturing process and only small messages (sequence number, frame id,
+capture time) go through the queues, so frames are never pickled.
+Results from all sources are merged into a single stream ordered by
+capture time.
+"""
+
+import collections
+import heapq
+import logging
+import multiprocessing
+import queue
+import time
+
+from lib.frame_bus import FrameRing
+
+LOGGER = logging.getLogger(__name__)
+
+# One tracking result. source_index is the position of the source in the
+# VideoSourceWrapper, capture_time is time.perf_counter() at capture,
+# tracking is the TrackingResult returned by ArUcoTracker.get_frame.
+TrackedFrame = collections.namedtuple(
+    'TrackedFrame', ['source_index', 'frame_id', 'capture_time', 'tracking'])
+
+
+def _sort_time(capture_time):
+    return capture_time if capture_time is not None else float("inf")
+
+
+def _tracking_worker(source_index, ar_config, tasks, results):
+    """
+    Process entry point. Tracks frames named by tasks until it gets None.
+    """
+    # Imported here so only worker processes pay for it.
+    from lib.arucotracker import ArUcoTracker  # pylint: disable=import-outside-toplevel
+
+    config = dict(ar_config)
+    config["video source"] = 'none'
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    results.put((source_index, None, None, None, None))
+
+    ring = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        ring_name, sequence, frame_id, capture_time = task
+        if ring is None or ring.name != ring_name:
+            if ring is not None:
+                ring.close()
+            ring = FrameRing.attach(ring_name)
+        # The engine never overwrites a slot that is in flight.
+        frame = ring.read(sequence)
+        tracking = None
+        if frame is None:
+            LOGGER.warning("Source %d frame %d was overwritten",
+                           source_index, frame_id)
+        else:
+            try:
+                tracking = tracker.get_frame(frame[0])
+            except ValueError as error:
+                LOGGER.warning("Source %d frame %d not tracked: %s",
+                               source_index, frame_id, error)
+        results.put((source_index, sequence, frame_id, capture_time, tracking))
+
+    if ring is not None:
+        ring.close()
+    tracker.close()
+
+
+class _SourceChannel:
+    """
+    The frame ring and task queue of one worker process.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self.ring = None
+        self.in_flight = {}
+        self.ready = False
+        self.tasks = None
+        self.process = None
+
+    def allocate(self, frame):
+        # (Re)creates the ring when the first frame arrives or its size changes.
+        shape = frame.shape if frame.ndim == 3 else frame.shape + (1,)
+        if self.ring is not None and self.ring.shape == shape \
+                and self.ring.dtype == frame.dtype:
+            return
+        if self.in_flight:
+            raise RuntimeError("Frame size changed while frames are in flight")
+        self.release()
+        self.ring = FrameRing.create(shape, frame.dtype, self.slots)
+
+    def next_slot_free(self):
+        # The ring writes slots in order, so the next frame can only be
+        # written if the frame it would overwrite is not being tracked.
+        overwritten = self.ring.latest_sequence + 1 - self.slots
+        return overwritten not in self.in_flight
+
+    def release(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class ParallelTrackingEngine:
+    """
+    Tracks every source registered in a VideoSourceWrapper in parallel,
+    one ArUcoTracker per source, each in its own process.
+
+    Usage::
+
+        engine = ParallelTrackingEngine(wrapper, ar_config)
+        engine.start()
+        while running:
+            engine.submit_frames()
+            for result in engine.get_results():
+                ...
+        engine.stop()
+
+    If the slot a new frame would overwrite is still being tracked, the
+    frame is dropped and counted in dropped_frames.
+    """
+    def __init__(self, video_sources, ar_config, slots=3, start_method="spawn"):
+        if slots < 2:
+            raise ValueError("Need at least two frame slots per source")
+        self.video_sources = video_sources
+        self.ar_config = ar_config
+        self.slots = slots
+        self.context = multiprocessing.get_context(start_method)
+        self.channels = []
+        self.results = None
+        self.merged = []
+        self.dropped_frames = 0
+        self._sequence = 0
+
+    def start(self, timeout=30.0):
+        """
+        Starts one tracking process per source and waits up to timeout
+        seconds for them to be ready, so early frames are not dropped.
+        """
+        if self.channels:
+            return
+        self.results = self.context.Queue()
+        for index, _ in enumerate(self.video_sources.sources):
+            channel = _SourceChannel(self.slots)
+            channel.tasks = self.context.Queue()
+            channel.process = self.context.Process(
+                target=_tracking_worker,
+                args=(index, self.ar_config, channel.tasks, self.results),
+                daemon=True)
+            channel.process.start()
+            self.channels.append(channel)
+
+        deadline = time.perf_counter() + timeout
+        while not all(channel.ready for channel in self.channels):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                LOGGER.warning("Tracking workers not ready after %.1f s", timeout)
+                break
+            self._collect(block=True, timeout=remaining)
+
+    def stop(self):
+        """
+        Stops the worker processes and frees the shared memory.
+        """
+        for channel in self.channels:
+            channel.tasks.put(None)
+        for channel in self.channels:
+            channel.process.join(timeout=5.0)
+            if channel.process.is_alive():
+                channel.process.terminate()
+            channel.release()
+        self.channels = []
+        self.merged = []
+
+    def submit_frames(self, synchronized=True, tolerance=0.010):
+        """
+        Reads the next frame from every source and hands it to its worker.
+
+        :returns: number of frames submitted.
+        """
+        if synchronized:
+            frame_set = self.video_sources.get_synchronized_frames(tolerance)
+            entries = zip(frame_set.frames, frame_set.frame_ids,
+                          frame_set.grab_times)
+        else:
+            entries = []
+            for source in self.video_sources.sources:
+                ok, frame, _ = source.read()
+                entries.append((frame if ok else None, source.frame_id,
+                                source.capture_time))
+
+        submitted = 0
+        for index, (frame, frame_id, capture_time) in enumerate(entries):
+            if frame is not None and self.submit(index, frame, frame_id,
+                                                 capture_time):
+                submitted += 1
+        return submitted
+
+    def submit(self, source_index, frame, frame_id, capture_time):
+        """
+        Copies one frame into the source's frame ring and queues it for
+        tracking.
+
+        :returns: False if the frame was dropped as no slot was free.
+        """
+        channel = self.channels[source_index]
+        self._collect(block=False)
+        channel.allocate(frame)
+        if not channel.next_slot_free():
+            self.dropped_frames += 1
+            return False
+        sequence = channel.ring.write(frame, capture_time, frame_id)
+        channel.in_flight[sequence] = capture_time
+        channel.tasks.put((channel.ring.name, sequence, frame_id, capture_time))
+        return True
+
+    def get_results(self, timeout=0.0):
+        """
+        Returns finished TrackedFrames ordered by capture time. A result is
+        only returned once no source has an earlier frame still in flight.
+
+        :param timeout: seconds to wait for the first result, 0 to poll.
+        """
+        self._collect(block=timeout > 0, timeout=timeout)
+
+        pending = [_sort_time(capture_time) for channel in self.channels
+                   for capture_time in channel.in_flight.values()]
+        watermark = min(pending) if pending else None
+
+        ready = []
+        while self.merged and (watermark is None or self.merged[0][0] < watermark):
+            ready.append(heapq.heappop(self.merged)[2])
+        return ready
+
+    def _collect(self, block=False, timeout=None):
+        while True:
+            try:
+                message = self.results.get(block=block, timeout=timeout)
+            except queue.Empty:
+                return
+            block = False
+            source_index, sequence, frame_id, capture_time, tracking = message
+            channel = self.channels[source_index]
+            if sequence is None:
+                channel.ready = True
+                continue
+            channel.in_flight.pop(sequence, None)
+            if tracking is None:
+                continue
+            self._sequence += 1
+            heapq.heappush(self.merged, (
+                _sort_time(capture_time), self._sequence,
+                TrackedFrame(source_index, frame_id, capture_time, tracking)))
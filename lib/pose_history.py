@@ -0,0 +1,230 @@
+"""
+Smoothing history of tracked poses, in fixed size NumPy ring buffers.
+
+Replaces the per port handle RollingMean objects of SKSBaseTracker: each
+port handle owns one row of a set of arrays holding its last window
+rotations (as quaternions), translations, qualities and timestamps, and
+smoothing averages many rows at once. Handles that are not permanent,
+such as the "DICT_4X4_50:17" handles made for unassigned tags, are evicted
+once they have not been seen for a number of frames, so the history does
+not grow with every tag ever seen.
+"""
+
+import warnings
+
+import numpy as np
+
+from lib.tracking_result import TrackingResult
+
+
+def rvecs_to_quaternions(rvecs):
+    """
+    Converts OpenCV rotation vectors (N, 3) to quaternions (N, 4), as
+    (w, x, y, z). NaN rotations give NaN quaternions.
+    """
+    rvecs = np.reshape(np.asarray(rvecs, dtype=np.float64), (-1, 3))
+    angles = np.linalg.norm(rvecs, axis=1)
+    quaternions = np.empty((len(rvecs), 4))
+    quaternions[:, 0] = np.cos(angles / 2.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = np.where(angles > 0.0, np.sin(angles / 2.0) / angles, 0.0)
+    quaternions[:, 1:4] = rvecs * scale[:, np.newaxis]
+    quaternions[np.isnan(angles)] = np.nan
+    return quaternions
+
+
+def quaternions_to_rvecs(quaternions):
+    """
+    Converts quaternions (N, 4), as (w, x, y, z), to OpenCV rotation
+    vectors (N, 3).
+    """
+    quaternions = np.reshape(np.asarray(quaternions, dtype=np.float64), (-1, 4))
+    # The sign of w picks the shorter of the two equal rotations.
+    quaternions = quaternions * np.where(quaternions[:, 0:1] < 0.0, -1.0, 1.0)
+    sines = np.linalg.norm(quaternions[:, 1:4], axis=1)
+    angles = 2.0 * np.arctan2(sines, quaternions[:, 0])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = np.where(sines > 0.0, angles / sines, 0.0)
+    return quaternions[:, 1:4] * scale[:, np.newaxis]
+
+
+def quaternions_to_matrices(quaternions):
+    """
+    Converts quaternions (N, 4), as (w, x, y, z), to rotation matrices
+    (N, 3, 3).
+    """
+    w, x, y, z = np.moveaxis(np.asarray(quaternions, dtype=np.float64), -1, 0)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], -1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], -1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], -1),
+    ], -2)
+
+
+def average_quaternions(quaternions, reference):
+    """
+    Averages windows of quaternions (N, window, 4), ignoring NaN samples,
+    as the eigenvector of the largest eigenvalue of the summed outer
+    products (Markley et al. 2007). Each average takes the sign of its
+    reference quaternion (N, 4), e.g. the newest sample; rows without any
+    sample are NaN.
+    """
+    valid = ~np.isnan(quaternions).any(axis=2)
+    samples = np.where(valid[:, :, np.newaxis], quaternions, 0.0)
+    outer = np.einsum("nwi,nwj->nij", samples, samples)
+    _, vectors = np.linalg.eigh(outer)
+    average = vectors[:, :, -1]
+
+    reference = np.nan_to_num(reference)
+    signs = np.sign(np.einsum("ni,ni->n", average, reference))
+    average *= np.where(signs == 0, 1.0, signs)[:, np.newaxis]
+    average[~valid.any(axis=1)] = np.nan
+    return average
+
+
+class PoseHistory:
+    """
+    Ring buffers of the last window samples of every port handle.
+
+    :param window: samples averaged per port handle (the smoothing buffer).
+    :param evict_after: frames after which a handle that is not permanent
+        is dropped if it has not been seen, None to keep every handle.
+    :param capacity: initial number of handles, grown as needed.
+    """
+    def __init__(self, window=1, evict_after=30, capacity=16):
+        if window < 1:
+            raise ValueError("Window must be at least 1")
+        self.window = window
+        self.evict_after = evict_after
+        self.index = {}
+        self.handles = []
+        self.free_rows = []
+        self.permanent = np.zeros(0, dtype=bool)
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old = len(self.handles)
+        self.handles.extend([None] * (capacity - old))
+        self.free_rows.extend(range(capacity - 1, old - 1, -1))
+
+        def grow(array, shape, fill, dtype=np.float64):
+            new = np.full((capacity,) + shape, fill, dtype=dtype)
+            if old:
+                new[:old] = array
+            return new
+
+        empty = np.empty(0)
+        self.quaternions = grow(getattr(self, "quaternions", empty), (self.window, 4), np.nan)
+        self.translations = grow(getattr(self, "translations", empty), (self.window, 3), np.nan)
+        self.qualities = grow(getattr(self, "qualities", empty), (self.window,), np.nan)
+        self.timestamps = grow(getattr(self, "timestamps", empty), (self.window,), np.nan)
+        self.frame_numbers = grow(getattr(self, "frame_numbers", empty), (), -1, np.int64)
+        # Window index of each handle's newest sample.
+        self.positions = grow(getattr(self, "positions", empty), (), 0, np.int64)
+        self.last_seen = grow(getattr(self, "last_seen", empty), (), -1, np.int64)
+        self.permanent = grow(self.permanent, (), False, bool)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, port_handle):
+        return port_handle in self.index
+
+    def add_handle(self, port_handle, permanent=False):
+        """
+        Returns the row of port_handle, adding it if it is new. Permanent
+        handles, e.g. configured rigid bodies, are never evicted.
+        """
+        row = self.index.get(port_handle)
+        if row is None:
+            if not self.free_rows:
+                self._allocate(2 * len(self.handles))
+            row = self.free_rows.pop()
+            self.index[port_handle] = row
+            self.handles[row] = port_handle
+        if permanent:
+            self.permanent[row] = True
+        return row
+
+    def add_frame(self, port_handles, timestamps, frame_numbers, rvecs, tvecs,
+                  qualities, frame_index):
+        """
+        Adds one sample per port handle, each rotation as an OpenCV rvec,
+        and evicts handles that have not been seen for evict_after frames.
+        """
+        rows = np.fromiter((self.add_handle(port_handle)
+                            for port_handle in port_handles),
+                           dtype=np.int64, count=len(port_handles))
+        if len(rows):
+            # The new sample overwrites the oldest in each ring.
+            positions = (self.positions[rows] + 1) % self.window
+            self.positions[rows] = positions
+            self.quaternions[rows, positions] = rvecs_to_quaternions(rvecs)
+            self.translations[rows, positions] = np.reshape(tvecs, (-1, 3))
+            self.qualities[rows, positions] = qualities
+            self.timestamps[rows, positions] = timestamps
+            self.frame_numbers[rows] = frame_numbers
+            # New handles count as seen, so they are evicted eventually.
+            seen = ~np.isnan(self.translations[rows, positions]).any(axis=1) \
+                | (self.last_seen[rows] < 0)
+            self.last_seen[rows[seen]] = frame_index
+        self.evict(frame_index)
+
+    def evict(self, frame_index):
+        """
+        Drops handles that are not permanent and were last seen more than
+        evict_after frames before frame_index.
+        """
+        if self.evict_after is None:
+            return
+        stale = np.flatnonzero(~self.permanent &
+                               (self.last_seen >= 0) &
+                               (frame_index - self.last_seen > self.evict_after))
+        for row in stale:
+            del self.index[self.handles[row]]
+            self._clear(row)
+
+    def _clear(self, row):
+        self.handles[row] = None
+        self.quaternions[row] = np.nan
+        self.translations[row] = np.nan
+        self.qualities[row] = np.nan
+        self.timestamps[row] = np.nan
+        self.frame_numbers[row] = -1
+        self.positions[row] = 0
+        self.last_seen[row] = -1
+        self.permanent[row] = False
+        self.free_rows.append(row)
+
+    def smooth(self, port_handles, use_quaternions=False):
+        """
+        Returns a TrackingResult with the average over the window of each
+        port handle, ignoring missing (NaN) samples. Poses are 4x4, or
+        quaternion and translation rows if use_quaternions.
+        """
+        rows = np.fromiter((self.index[port_handle] for port_handle in port_handles),
+                           dtype=np.int64, count=len(port_handles))
+        if self.window == 1:
+            quaternions = self.quaternions[rows, 0]
+            translations = self.translations[rows, 0]
+            qualities = self.qualities[rows, 0]
+            timestamps = self.timestamps[rows, 0]
+        else:
+            newest = self.quaternions[rows, self.positions[rows]]
+            quaternions = average_quaternions(self.quaternions[rows], newest)
+            with warnings.catch_warnings():
+                # All NaN windows average to NaN, which is what we want.
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                translations = np.nanmean(self.translations[rows], axis=1)
+                qualities = np.nanmean(self.qualities[rows], axis=1)
+                timestamps = np.nanmean(self.timestamps[rows], axis=1)
+
+        if use_quaternions:
+            poses = np.concatenate([quaternions, translations], axis=1)
+        else:
+            poses = np.zeros((len(rows), 4, 4))
+            poses[:, 0:3, 0:3] = quaternions_to_matrices(quaternions)
+            poses[:, 0:3, 3] = translations
+            poses[:, 3, 3] = 1.0
+        return TrackingResult(port_handles, timestamps, self.frame_numbers[rows],
+                              poses, qualities)
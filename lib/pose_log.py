@@ -0,0 +1,169 @@
+"""
+Writers for tracking results, one row per port handle per frame.
+
+Each row holds the port handle, timestamp, frame number, 4x4 pose and
+tracking quality; trackers set to "use quaternions" cannot be logged.
+open_pose_writer() picks the format from the file extension: .csv for
+spreadsheets, .npy for numpy, or .poselog, a compact binary log of fixed
+size records that read_pose_log() loads back.
+"""
+
+import csv
+import os
+
+import numpy as np
+
+POSE_RECORD = np.dtype([("port_handle", "S32"),
+                        ("timestamp", "<f8"),
+                        ("frame_number", "<i8"),
+                        ("pose", "<f8", (4, 4)),
+                        ("quality", "<f8")])
+
+_POSE_LOG_MAGIC = b"POSELOG1"
+_POSE_LOG_HEADER = len(_POSE_LOG_MAGIC) + 4
+
+
+def pose_records(port_handles, timestamp, frame_number, poses, qualities):
+    """
+    Returns the results of one frame as a POSE_RECORD array.
+
+    :raises: ValueError if the poses are not 4x4 matrices, e.g. from a
+        tracker set to "use quaternions".
+    """
+    poses = np.asarray(poses, dtype=np.float64)
+    if poses.size and poses.shape[-2:] != (4, 4):
+        raise ValueError(f"Poses must be 4x4 matrices, not {poses.shape[1:]}; "
+                         "pose logs do not store quaternions")
+    records = np.zeros(len(port_handles), dtype=POSE_RECORD)
+    records["port_handle"] = [str(port_handle).encode("utf-8")[:32]
+                              for port_handle in port_handles]
+    records["pose"] = np.reshape(poses, (-1, 4, 4))
+    records["quality"] = qualities
+    records["timestamp"] = timestamp
+    records["frame_number"] = frame_number
+    return records
+
+
+class _PoseWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = 0
+
+    def write_frame(self, port_handles, timestamp, frame_number, poses,
+                    qualities):
+        """
+        Writes the results of one ArUcoTracker.get_frame call.
+        """
+        if not port_handles:
+            return
+        records = pose_records(port_handles, timestamp, frame_number, poses,
+                               qualities)
+        self._write(records)
+        self.rows += len(records)
+
+    def _write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvPoseWriter(_PoseWriter):
+    """
+    One row per pose, with the matrix as columns m00 to m33.
+    """
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.file = open(filename, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["port_handle", "timestamp", "frame_number"] +
+                             [f"m{row}{column}" for row in range(4)
+                              for column in range(4)] + ["quality"])
+
+    def _write(self, records):
+        for record in records:
+            self.writer.writerow(
+                [record["port_handle"].decode("utf-8"),
+                 repr(float(record["timestamp"])), int(record["frame_number"])] +
+                [repr(float(value)) for value in record["pose"].ravel()] +
+                [repr(float(record["quality"]))])
+
+    def close(self):
+        self.file.close()
+
+
+class NpyPoseWriter(_PoseWriter):
+    """
+    Collects the records and saves them as one POSE_RECORD array on close.
+    """
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.chunks = []
+
+    def _write(self, records):
+        self.chunks.append(records)
+
+    def close(self):
+        records = np.concatenate(self.chunks) if self.chunks \
+            else np.zeros(0, dtype=POSE_RECORD)
+        np.save(self.filename, records)
+        self.chunks = []
+
+
+class BinaryPoseWriter(_PoseWriter):
+    """
+    Streams POSE_RECORD rows to a file after a short header, so nothing is
+    held in memory and a partly written log can still be read.
+    """
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.file = open(filename, "wb")
+        self.file.write(_POSE_LOG_MAGIC)
+        self.file.write(np.uint32(POSE_RECORD.itemsize).tobytes())
+
+    def _write(self, records):
+        self.file.write(records.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+_WRITERS = {".csv": CsvPoseWriter,
+            ".npy": NpyPoseWriter,
+            ".poselog": BinaryPoseWriter}
+
+
+def open_pose_writer(filename):
+    """
+    Returns a writer for filename, chosen by its extension.
+    """
+    for extension, writer in _WRITERS.items():
+        if filename.lower().endswith(extension):
+            return writer(filename)
+    raise ValueError(f"Unsupported pose file {filename}, use one of "
+                     f"{', '.join(_WRITERS)}")
+
+
+def read_pose_log(filename):
+    """
+    Loads a .poselog file as a POSE_RECORD array, memory mapped.
+    """
+    with open(filename, "rb") as log_file:
+        header = log_file.read(_POSE_LOG_HEADER)
+    if header[:len(_POSE_LOG_MAGIC)] != _POSE_LOG_MAGIC:
+        raise ValueError(f"{filename} is not a pose log")
+    record_size = int(np.frombuffer(header, dtype="<u4",
+                                    offset=len(_POSE_LOG_MAGIC))[0])
+    if record_size != POSE_RECORD.itemsize:
+        raise ValueError(f"{filename} has {record_size} byte records, "
+                         f"expected {POSE_RECORD.itemsize}")
+    if os.path.getsize(filename) == _POSE_LOG_HEADER:
+        return np.zeros(0, dtype=POSE_RECORD)
+    return np.memmap(filename, dtype=POSE_RECORD, mode="r",
+                     offset=_POSE_LOG_HEADER)
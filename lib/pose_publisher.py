@@ -0,0 +1,218 @@
+"""
+Streams tracking results to other processes, e.g. AR headset bridges,
+over ZeroMQ PUB/SUB.
+
+Every message is one ZeroMQ frame: an 8 byte magic, which subscribers
+filter on, the wall clock send time, the record count, then that many
+POSE_RECORD rows (port handle, timestamp, frame number, 4x4 pose and
+quality, see lib.pose_log), so a frame with two tags is under 400 bytes
+and decodes without copying::
+
+    publisher = PosePublisher("tcp://*:5556")
+    publisher.publish(tracker.get_frame(image), capture_time)
+    ...
+    subscriber = PoseSubscriber("tcp://127.0.0.1:5556")
+    sent_time, records = subscriber.receive()
+
+publish() only encodes the frame and queues it; a background thread owns
+the socket and sends. If the thread falls behind, the oldest queued frames
+are dropped, so tracking never waits on the network. With conflate, the
+default, only the newest frame is kept queued, both here and in ZeroMQ, so
+a slow subscriber always gets the latest pose rather than a backlog.
+Without it, up to batch_frames queued frames are sent per message.
+"""
+
+import collections
+import logging
+import struct
+import threading
+import time
+
+import numpy as np
+
+from lib.pose_log import POSE_RECORD, pose_records
+
+LOGGER = logging.getLogger(__name__)
+
+POSE_MESSAGE_MAGIC = b"POSEPUB1"
+_HEADER = struct.Struct("<8sdI")
+
+
+def encode_poses(records, sent_time=None):
+    """
+    Returns a message for POSE_RECORD rows, sent_time defaulting to now.
+    """
+    sent_time = time.time() if sent_time is None else sent_time
+    return _HEADER.pack(POSE_MESSAGE_MAGIC, sent_time, len(records)) + records.tobytes()
+
+
+def decode_poses(message):
+    """
+    Returns (sent time, POSE_RECORD array) from a message.
+
+    :raises: ValueError if the message is not a pose message.
+    """
+    if len(message) < _HEADER.size:
+        raise ValueError("Pose message is too short")
+    magic, sent_time, count = _HEADER.unpack_from(message)
+    if magic != POSE_MESSAGE_MAGIC:
+        raise ValueError("Not a pose message")
+    if len(message) != _HEADER.size + count * POSE_RECORD.itemsize:
+        raise ValueError(f"Pose message of {len(message)} bytes does not "
+                         f"hold {count} records")
+    records = np.frombuffer(message, dtype=POSE_RECORD, count=count,
+                            offset=_HEADER.size)
+    return sent_time, records
+
+
+class PosePublisher:
+    """
+    Publishes tracking results on a ZeroMQ PUB socket from a background
+    thread.
+
+    :param address: address to bind, e.g. "tcp://*:5556" or "ipc:///tmp/poses".
+    :param conflate: keep only the newest frame for slow subscribers.
+    :param batch_frames: most frames sent in one message, without conflate.
+    :param queue_size: frames queued before the oldest are dropped.
+    """
+    def __init__(self, address="tcp://*:5556", conflate=True, batch_frames=1,
+                 queue_size=64):
+        import zmq  # pylint: disable=import-outside-toplevel
+
+        if batch_frames < 1:
+            raise ValueError("batch_frames must be >= 1")
+        self.address = address
+        self.conflate = conflate
+        self.batch_frames = batch_frames
+        self.published = 0
+        self.sent = 0
+        self.dropped = 0
+        self._queue = collections.deque(maxlen=1 if conflate else queue_size)
+        self._condition = threading.Condition()
+        self._running = True
+
+        self._context = zmq.Context.instance()
+        self._socket = self._context.socket(zmq.PUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.setsockopt(zmq.SNDHWM, 1 if conflate else queue_size)
+        if conflate:
+            self._socket.setsockopt(zmq.CONFLATE, 1)
+        self._socket.bind(address)
+        # The thread owns the socket from here on, ZeroMQ sockets are not
+        # thread safe.
+        self._thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+        LOGGER.info("Publishing poses on %s", address)
+
+    def write_frame(self, port_handles, timestamp, frame_number, poses,
+                    qualities):
+        """
+        Queues the results of one frame, as the pose_log writers take them.
+        Never blocks.
+        """
+        if not port_handles:
+            return
+        records = pose_records(port_handles, timestamp, frame_number,
+                               poses, qualities)
+        with self._condition:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(records)
+            self.published += 1
+            self._condition.notify()
+
+    def publish(self, result, timestamp=None, frame_number=None):
+        """
+        Queues a TrackingResult with 4x4 poses. timestamp, e.g. the capture
+        time, and frame_number default to those of the tracker.
+        """
+        if not result:
+            return
+        self.write_frame(result.port_handles,
+                         result.timestamps if timestamp is None else timestamp,
+                         result.frame_numbers if frame_number is None else frame_number,
+                         result.poses, result.qualities)
+
+    def _send_loop(self):
+        import zmq  # pylint: disable=import-outside-toplevel
+
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._running:
+                    break
+                frames = [self._queue.popleft()
+                          for _ in range(min(self.batch_frames, len(self._queue)))]
+            try:
+                self._socket.send(encode_poses(np.concatenate(frames)), zmq.NOBLOCK)
+                self.sent += len(frames)
+            except zmq.Again:
+                # Only reached without conflate, once every subscriber's
+                # queue is full; PUB sockets drop rather than block anyway.
+                self.dropped += len(frames)
+        self._socket.close()
+
+    def stats(self):
+        """
+        Returns a dict of frames published, sent and dropped.
+        """
+        return {"published": self.published, "sent": self.sent,
+                "dropped": self.dropped}
+
+    def close(self):
+        """
+        Stops the sending thread and closes the socket. Queued frames
+        that were not sent yet are discarded.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PoseSubscriber:
+    """
+    Receives pose messages from a PosePublisher.
+
+    :param address: address to connect to, e.g. "tcp://127.0.0.1:5556".
+    :param conflate: keep only the newest message if not received in time.
+    """
+    def __init__(self, address="tcp://127.0.0.1:5556", conflate=True):
+        import zmq  # pylint: disable=import-outside-toplevel
+
+        self.address = address
+        self._context = zmq.Context.instance()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        if conflate:
+            self._socket.setsockopt(zmq.CONFLATE, 1)
+        self._socket.setsockopt(zmq.SUBSCRIBE, POSE_MESSAGE_MAGIC)
+        self._socket.connect(address)
+        self._poller = zmq.Poller()
+        self._poller.register(self._socket, zmq.POLLIN)
+
+    def receive(self, timeout=None):
+        """
+        Returns (sent time, POSE_RECORD array) of the next message, or None
+        if none arrives within timeout seconds.
+        """
+        timeout_ms = None if timeout is None else int(1000 * timeout)
+        if not self._poller.poll(timeout_ms):
+            return None
+        return decode_poses(self._socket.recv(copy=True))
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
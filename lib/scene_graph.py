@@ -0,0 +1,202 @@
+"""
+Models anchored to their own ArUco tags, all moved in one batched update.
+
+Each anchor binds a group of models to one port handle, e.g. a catheter to
+"DICT_4X4_50:3", a phantom to "DICT_4X4_50:7" and a table to a configured
+rigid body. The offset of a group from its tag is kept in a
+TransformManager as "<name>2<name>tag", so it can be read and changed like
+any other transform::
+
+    scene = SceneGraph()
+    scene.add_anchor("catheter", "DICT_4X4_50:3", ["catheter", "catheter_tip"])
+    scene.add_anchor("phantom", "DICT_4X4_50:7", ["phantom"], offset=phantom2tag)
+    scene.add_models(model_loader.models)
+    ...
+    scene.update(tracker.get_frame(image))
+
+Per frame, update() looks up every anchor's tag in the TrackingResult and
+multiplies all tag2camera poses by their offsets in one batched matmul.
+The actors of a group share a single vtkMatrix4x4 as their user matrix, so
+there is one VTK call per tag rather than one per model, and no polydata is
+transformed on the CPU. Models are placed in camera coordinates, so the
+VTK camera stays at the origin.
+
+Anchors can also be read from a JSON file, see load_anchors().
+"""
+
+import json
+import logging
+
+import numpy as np
+
+from lib.transform_manager import TransformManager
+
+LOGGER = logging.getLogger(__name__)
+
+ANCHORS_FILE = "anchors.json"
+
+
+class SceneGraph:
+    """
+    Groups of models, each following the pose of its own tag.
+
+    :param hold_frames: frames a group stays visible at its last pose after
+        its tag is lost, before its actors are hidden.
+    """
+    def __init__(self, hold_frames=5):
+        self.hold_frames = hold_frames
+        self.transforms = TransformManager()
+        self.names = []
+        self.port_handles = []
+        self.model_names = []
+        self.actors = []
+        self.matrices = []
+        self._bound = set()
+        self._offsets = np.zeros((0, 4, 4))
+        self._missed = np.zeros(0, dtype=np.int64)
+        self._visible = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @staticmethod
+    def offset_name(name):
+        """
+        Returns the name of the offset of anchor name in the transforms.
+        """
+        return f"{name}2{name}tag"
+
+    def add_anchor(self, name, port_handle, model_names=(), offset=None):
+        """
+        Adds a group of models that follows port_handle.
+
+        :param name: group name, lowercase letters only, e.g. "phantom".
+        :param port_handle: tracked port handle, e.g. "DICT_4X4_50:7".
+        :param model_names: names of the models in the group, bound as they
+            are passed to add_models().
+        :param offset: 4x4 model to tag transform, identity if None.
+        :raises: ValueError if the name is in use or not valid.
+        """
+        from vtk import vtkMatrix4x4  # pylint: disable=import-outside-toplevel
+
+        if name in self.names:
+            raise ValueError(f"Anchor {name} already exists")
+        offset = np.eye(4) if offset is None else np.asarray(offset, dtype=np.float64)
+        self.transforms.add(self.offset_name(name), offset)
+
+        self.names.append(name)
+        self.port_handles.append(port_handle)
+        self.model_names.append(set(model_names))
+        self.actors.append([])
+        self.matrices.append(vtkMatrix4x4())
+        self._offsets = np.concatenate([self._offsets, offset[np.newaxis]])
+        # Hidden until the tag is first seen.
+        self._missed = np.append(self._missed, self.hold_frames + 1)
+        self._visible = np.append(self._visible, False)
+
+    def set_offset(self, name, offset):
+        """
+        Replaces the model to tag transform of anchor name.
+        """
+        index = self.names.index(name)
+        offset = np.asarray(offset, dtype=np.float64)
+        self.transforms.add(self.offset_name(name), offset)
+        self._offsets[index] = offset
+
+    def get_offset(self, name):
+        """
+        Returns the model to tag transform of anchor name.
+        """
+        return self.transforms.get(self.offset_name(name))
+
+    def add_actor(self, name, actor):
+        """
+        Moves actor with anchor name. Its user matrix is replaced.
+        """
+        index = self.names.index(name)
+        actor.SetUserMatrix(self.matrices[index])
+        actor.SetVisibility(bool(self._visible[index]))
+        self.actors[index].append(actor)
+        self._bound.add(id(actor))
+
+    def add_models(self, models):
+        """
+        Binds the actor of each model named by an anchor, skipping models
+        already bound, and returns the number bound.
+
+        :param models: list of VTKSurfaceModel, e.g. ModelDirectoryLoader.models.
+        """
+        bound = 0
+        for model in models:
+            if id(model.actor) in self._bound:
+                continue
+            for name, model_names in zip(self.names, self.model_names):
+                if model.get_name() in model_names:
+                    self.add_actor(name, model.actor)
+                    bound += 1
+                    break
+        return bound
+
+    def update(self, result):
+        """
+        Moves every group to the pose of its tag in result, a TrackingResult
+        with 4x4 poses, and returns the number of tags seen.
+        """
+        if not self.names:
+            return 0
+        if result.poses.ndim != 3:
+            raise ValueError("The scene graph needs 4x4 poses, "
+                             "not quaternions")
+
+        rows = result.rows(self.port_handles)
+        found = rows >= 0
+        tag2camera = result.poses[rows[found]]
+        seen = np.zeros(len(self.names), dtype=bool)
+        seen[found] = np.isfinite(tag2camera).all(axis=(1, 2))
+        model2camera = np.matmul(tag2camera[seen[found]], self._offsets[seen])
+
+        for index, elements in zip(np.flatnonzero(seen),
+                                   model2camera.reshape(-1, 16).tolist()):
+            self.matrices[index].DeepCopy(elements)
+
+        self._missed[seen] = 0
+        self._missed[~seen] += 1
+        visible = self._missed <= self.hold_frames
+        for index in np.flatnonzero(visible != self._visible):
+            for actor in self.actors[index]:
+                actor.SetVisibility(bool(visible[index]))
+        self._visible = visible
+        return int(np.count_nonzero(seen))
+
+
+def load_anchors(filename, dictionary="DICT_4X4_50", hold_frames=5):
+    """
+    Returns a SceneGraph with the anchors in a JSON file, e.g.::
+
+        {"catheter": {"tag": 3, "models": ["catheter", "catheter_tip"]},
+         "phantom": {"tag": "DICT_4X4_50:7", "models": ["phantom"],
+                     "offset": [[1, 0, 0, 0], [0, 1, 0, 0],
+                                [0, 0, 1, -25], [0, 0, 0, 1]]}}
+
+    A tag given as a number is a marker of dictionary, anything else is a
+    port handle, e.g. a rigid body name. The offset is the 4x4 model to
+    tag transform, identity if not given.
+
+    :raises: ValueError if an anchor has no tag.
+    """
+    with open(filename, encoding="utf-8") as anchors_file:
+        anchors = json.load(anchors_file)
+
+    scene = SceneGraph(hold_frames)
+    for name, anchor in anchors.items():
+        if "tag" not in anchor:
+            raise ValueError(f"Anchor {name} in {filename} has no tag")
+        tag = anchor["tag"]
+        port_handle = f"{dictionary}:{tag}" if isinstance(tag, int) else str(tag)
+        scene.add_anchor(name, port_handle, anchor.get("models", ()),
+                         anchor.get("offset"))
+    LOGGER.info("Loaded %d anchors from %s", len(scene), filename)
+    return scene
@@ -0,0 +1,126 @@
+"""
+Startup profiling: how long each module takes to import and each step of
+initialisation takes, up to the first frame.
+
+Set OVERLAY_STARTUP_PROFILE=1 to print the report to stderr once the
+first frame is processed, or to a file name to write it there. Import
+this module before any other so that every import is timed::
+
+    from lib.startup_profile import startup_profiler
+    ...
+    startup_profiler.mark("tracker created")
+    ...
+    startup_profiler.first_frame()
+
+When the variable is not set every call is a no-op.
+"""
+
+import builtins
+import os
+import sys
+import threading
+import time
+
+
+class StartupProfiler:
+    """
+    Times imports by wrapping builtins.__import__ on the main thread, and
+    initialisation steps by marks.
+
+    Import times are inclusive of the modules a module imports itself; the
+    self time excludes them.
+    """
+    def __init__(self, enabled=False, report_file=None):
+        self.enabled = enabled
+        self.report_file = report_file
+        self.start = time.perf_counter()
+        self.imports = {}
+        self.marks = []
+        self.finished = False
+        self._last_mark = self.start
+        self._stack = []
+        self._original_import = None
+        if enabled:
+            self.install()
+
+    @classmethod
+    def from_environment(cls, variable="OVERLAY_STARTUP_PROFILE"):
+        value = os.environ.get(variable, "")
+        if value in ("", "0"):
+            return cls(enabled=False)
+        return cls(enabled=True, report_file=None if value == "1" else value)
+
+    def install(self):
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):  # pylint: disable=redefined-builtin
+        original = self._original_import
+        if level or name in sys.modules \
+                or threading.current_thread() is not threading.main_thread():
+            return original(name, globals, locals, fromlist, level)
+
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if name in sys.modules and name not in self.imports:
+                self.imports[name] = (elapsed, elapsed - children)
+
+    def mark(self, name):
+        """
+        Records the time since the previous mark (or the profiler start)
+        as the step name.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.marks.append((name, now - self._last_mark))
+        self._last_mark = now
+
+    def first_frame(self):
+        """
+        Marks the first frame, stops profiling and writes the report.
+        """
+        if not self.enabled or self.finished:
+            return
+        self.mark("first frame")
+        self.finished = True
+        self.uninstall()
+        report = self.report()
+        if self.report_file:
+            with open(self.report_file, "w", encoding="utf-8") as report_file:
+                report_file.write(report)
+        else:
+            sys.stderr.write(report)
+
+    def report(self, top=25):
+        """
+        Returns the profile as text: steps in order, then the slowest
+        imports.
+        """
+        lines = [f"Startup profile, {1000.0 * (self._last_mark - self.start):.0f} ms "
+                 "from profiler start", "", "Steps (ms):"]
+        for name, seconds in self.marks:
+            lines.append(f"  {1000.0 * seconds:9.1f}  {name}")
+
+        lines += ["", f"Slowest imports of {len(self.imports)} (ms, inclusive / self):"]
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][0],
+                         reverse=True)[:top]
+        for name, (inclusive, own) in slowest:
+            lines.append(f"  {1000.0 * inclusive:9.1f} {1000.0 * own:9.1f}  {name}")
+        return "\n".join(lines) + "\n"
+
+
+startup_profiler = StartupProfiler.from_environment()
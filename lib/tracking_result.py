@@ -0,0 +1,100 @@
+"""Columnar result of one ArUcoTracker.get_frame call."""
+
+import numpy as np
+
+
+class TrackingResult:
+    """
+    Poses of every tracked port handle in one frame, stored as arrays.
+
+    poses is (N, 4, 4), or (N, 7) quaternion and translation rows if the
+    tracker uses quaternions; timestamps, frame_numbers and qualities are
+    (N,) arrays aligned with port_handles. Poses can be looked up by port
+    handle in O(1)::
+
+        result = tracker.get_frame(image)
+        if "DICT_4X4_50:0" in result:
+            tag2camera = result.pose("DICT_4X4_50:0")
+
+    Every frame gets a new result, never one refilled in place, as
+    stream subscribers and the motion gate keep results across frames.
+
+    For compatibility with the SKSBaseTracker interface a result unpacks
+    into the usual five lists::
+
+        port_handles, timestamps, frame_numbers, tracking, quality = result
+    """
+    __slots__ = ("port_handles", "timestamps", "frame_numbers", "poses",
+                 "qualities", "_index")
+
+    def __init__(self, port_handles, timestamps, frame_numbers, poses,
+                 qualities):
+        self.port_handles = list(port_handles)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        self.poses = np.asarray(poses, dtype=np.float64)
+        self.qualities = np.asarray(qualities, dtype=np.float64)
+        self._index = None
+
+    @property
+    def count(self):
+        return len(self.port_handles)
+
+    def __bool__(self):
+        return bool(self.port_handles)
+
+    def __iter__(self):
+        # Lists, as SKSBaseTracker.get_frame returns them.
+        return iter((list(self.port_handles), list(self.timestamps),
+                     list(self.frame_numbers), list(self.poses),
+                     list(self.qualities)))
+
+    def __contains__(self, port_handle):
+        return port_handle in self._lookup()
+
+    def __getstate__(self):
+        # The index is rebuilt on demand rather than pickled.
+        return (self.port_handles, self.timestamps, self.frame_numbers,
+                self.poses, self.qualities)
+
+    def __setstate__(self, state):
+        (self.port_handles, self.timestamps, self.frame_numbers, self.poses,
+         self.qualities) = state
+        self._index = None
+
+    def _lookup(self):
+        if self._index is None:
+            self._index = {port_handle: row for row, port_handle
+                           in enumerate(self.port_handles)}
+        return self._index
+
+    def index(self, port_handle):
+        """
+        Returns the row of port_handle, raises KeyError if not tracked.
+        """
+        return self._lookup()[port_handle]
+
+    def rows(self, port_handles):
+        """
+        Returns the rows of port_handles as an array, -1 where not tracked.
+        """
+        lookup = self._lookup()
+        return np.fromiter((lookup.get(port_handle, -1) for port_handle in port_handles),
+                           dtype=np.int64, count=len(port_handles))
+
+    def pose(self, port_handle, default=None):
+        """
+        Returns the pose of port_handle, or default if it is not tracked.
+        """
+        row = self._lookup().get(port_handle)
+        return default if row is None else self.poses[row]
+
+    def quality(self, port_handle, default=None):
+        """
+        Returns the tracking quality of port_handle, or default.
+        """
+        row = self._lookup().get(port_handle)
+        return default if row is None else float(self.qualities[row])
+
+    def __repr__(self):
+        return f"TrackingResult({self.port_handles})"
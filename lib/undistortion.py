@@ -0,0 +1,165 @@
+"""
+Calibration loading and lens undistortion of video frames.
+
+The undistortion maps from cv2.initUndistortRectifyMap are built once per
+calibration and resolution, kept in a binary cache next to the
+calibration file, and applied to each frame with cv2.remap. Undistorted
+frames go with the intrinsics in Undistorter.camera_matrix and zero
+distortion, for both the tracker and the overlay window.
+"""
+
+import hashlib
+import logging
+import os
+
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+_CALIBRATION_CACHE = {}
+
+
+def load_calibration(textfile):
+    """
+    Reads a calibration text file: three rows of the 3x3 projection
+    matrix, then one row of distortion coefficients. The file is parsed
+    once and then served from memory until it changes on disk.
+
+    :returns: projection matrix (3x3) and distortion, both float32 copies.
+    """
+    status = os.stat(textfile)
+    key = (os.path.abspath(textfile), status.st_mtime_ns, status.st_size)
+    cached = _CALIBRATION_CACHE.get(key)
+    if cached is None:
+        with open(textfile, encoding="utf-8") as calibration_file:
+            rows = [line.split() for line in calibration_file
+                    if line.strip() and not line.lstrip().startswith("#")]
+        if len(rows) < 4:
+            raise ValueError(f"{textfile} needs 3 projection rows and "
+                             "a distortion row")
+        projection_matrix = np.array(rows[0:3], dtype=np.float32)
+        distortion = np.array(rows[3], dtype=np.float32)
+        if projection_matrix.shape != (3, 3):
+            raise ValueError(f"{textfile} projection matrix is not 3x3")
+        cached = (projection_matrix, distortion)
+        _CALIBRATION_CACHE[key] = cached
+    return cached[0].copy(), cached[1].copy()
+
+
+def _maps_key(camera_matrix, distortion, resolution, alpha):
+    digest = hashlib.sha1()
+    digest.update(np.asarray(camera_matrix, dtype=np.float64).tobytes())
+    digest.update(np.asarray(distortion, dtype=np.float64).ravel().tobytes())
+    digest.update(np.asarray(resolution, dtype=np.int64).tobytes())
+    digest.update(np.float64(alpha).tobytes())
+    return digest.hexdigest()
+
+
+def undistortion_cache_file(textfile, resolution):
+    """
+    Returns the cache file for a calibration file at a resolution.
+    """
+    width, height = resolution
+    return f"{os.path.splitext(textfile)[0]}.undistort_{width}x{height}.npz"
+
+
+class Undistorter:
+    """
+    Removes lens distortion from frames of one resolution.
+
+    :param camera_matrix: 3x3 camera matrix of the distorted camera.
+    :param distortion: distortion coefficients.
+    :param resolution: (width, height) of the frames.
+    :param alpha: 0 crops to valid pixels only, 1 keeps every source pixel,
+        see cv2.getOptimalNewCameraMatrix.
+    :param cache_file: optional .npz file to load the maps from, or to
+        save them to if it is missing or for another calibration.
+    """
+    def __init__(self, camera_matrix, distortion, resolution, alpha=0.0,
+                 cache_file=None):
+        self.resolution = (int(resolution[0]), int(resolution[1]))
+        self.source_camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.source_distortion = np.asarray(distortion, dtype=np.float64)
+        self.alpha = alpha
+        self.cache_file = cache_file
+        self.key = _maps_key(self.source_camera_matrix, self.source_distortion,
+                             self.resolution, alpha)
+        self.buffer = None
+
+        if not self._load_maps():
+            self._build_maps()
+            if cache_file:
+                self._save_maps()
+
+    @classmethod
+    def from_calibration_file(cls, textfile, resolution, alpha=0.0):
+        """
+        Builds an Undistorter for a calibration file, with its maps cached
+        next to the file.
+        """
+        camera_matrix, distortion = load_calibration(textfile)
+        return cls(camera_matrix, distortion, resolution, alpha,
+                   undistortion_cache_file(textfile, resolution))
+
+    @property
+    def distortion(self):
+        """
+        Distortion coefficients of undistorted frames, i.e. zeros.
+        """
+        return np.zeros(5, dtype=np.float32)
+
+    def _build_maps(self):
+        self.camera_matrix, _ = cv2.getOptimalNewCameraMatrix(
+            self.source_camera_matrix, self.source_distortion,
+            self.resolution, self.alpha, self.resolution)
+        self.camera_matrix = self.camera_matrix.astype(np.float32)
+        # Fixed point maps make cv2.remap about twice as fast as float maps.
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(
+            self.source_camera_matrix, self.source_distortion, None,
+            self.camera_matrix, self.resolution, cv2.CV_16SC2)
+
+    def _load_maps(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return False
+        try:
+            with np.load(self.cache_file) as cached:
+                if str(cached["key"]) != self.key:
+                    return False
+                self.camera_matrix = cached["camera_matrix"]
+                self.map1 = cached["map1"]
+                self.map2 = cached["map2"]
+        except (OSError, KeyError, ValueError) as error:
+            LOGGER.warning("Ignoring undistortion cache %s: %s",
+                           self.cache_file, error)
+            return False
+        return True
+
+    def _save_maps(self):
+        temporary = self.cache_file + ".tmp"
+        try:
+            with open(temporary, "wb") as cache:
+                np.savez(cache, key=np.array(self.key),
+                         camera_matrix=self.camera_matrix,
+                         map1=self.map1, map2=self.map2)
+            os.replace(temporary, self.cache_file)
+        except OSError as error:
+            LOGGER.warning("Could not write undistortion cache %s: %s",
+                           self.cache_file, error)
+
+    def undistort(self, frame, output=None):
+        """
+        Returns the undistorted frame. Unless output is given it is written
+        to a buffer that is reused by the next call.
+        """
+        height, width = frame.shape[0:2]
+        if (width, height) != self.resolution:
+            raise ValueError(f"Frame is {width}x{height}, undistortion maps "
+                             f"are {self.resolution[0]}x{self.resolution[1]}")
+        if output is None:
+            if self.buffer is None or self.buffer.shape != frame.shape \
+                    or self.buffer.dtype != frame.dtype:
+                self.buffer = np.empty_like(frame)
+            output = self.buffer
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR,
+                         dst=output)
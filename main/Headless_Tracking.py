@@ -0,0 +1,124 @@
+"""
+Tracks ArUco markers in a video file, raw frame sequence or camera without
+any GUI, and writes every pose to a CSV, .npy or .poselog file.
+
+Frames are processed as fast as they can be read, with the same tracker
+configuration as Overlay_and_Tracking.py. Frame numbers are those of the
+video source, so poses line up with the recording. Timestamps are the
+original capture times for raw frame sequences, but for cameras and video
+files (.avi, .mp4, ...) the wall clock time each frame was read.
+
+Usage::
+
+    python -m main.Headless_Tracking recording.avi --output poses.csv
+"""
+
+# Imported first so OVERLAY_STARTUP_PROFILE=1 times every other import.
+from lib.startup_profile import startup_profiler
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from lib.arucotracker import ArUcoTracker, default_ar_config
+from lib.modified_video_source import open_video_source
+from lib.pose_log import open_pose_writer
+from lib.pose_publisher import PosePublisher
+
+
+def open_source(source):
+    # Camera numbers are given as digits, anything else is a file.
+    return open_video_source(int(source) if source.isdigit() else source)
+
+
+def track(video_source, ar_config, writer, max_frames=None, publisher=None):
+    # Runs the tracker over every frame and writes the poses, and publishes
+    # them too if a PosePublisher is given.
+    # Returns the number of frames processed.
+    tracker = ArUcoTracker(ar_config)
+    tracker.start_tracking()
+    startup_profiler.mark("tracker created")
+    frames = 0
+    try:
+        while max_frames is None or frames < max_frames:
+            ok, frame, timestamp = video_source.read()
+            if not ok:
+                break
+            port_handles, _, _, poses, qualities = tracker.get_frame(frame)
+            frame_time = timestamp.timestamp() if timestamp else time.time()
+            writer.write_frame(port_handles, frame_time, video_source.frame_id,
+                               poses, qualities)
+            if publisher is not None:
+                publisher.write_frame(port_handles, frame_time,
+                                      video_source.frame_id, poses, qualities)
+            frames += 1
+            if frames == 1:
+                startup_profiler.first_frame()
+    finally:
+        tracker.close()
+    return frames
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Track ArUco markers without a GUI and export the poses.")
+    parser.add_argument("source", help="camera number, video file or raw .npy sequence")
+    parser.add_argument("--output", required=True,
+                        help="pose file, .csv, .npy or .poselog")
+    parser.add_argument("--config", help="JSON file with tracker settings to override")
+    parser.add_argument("--calibration", help="camera calibration text file")
+    parser.add_argument("--marker-size", type=float, help="tag size in mm")
+    parser.add_argument("--dictionary", help="ArUco dictionary, e.g. DICT_4X4_50")
+    parser.add_argument("--max-frames", type=int)
+    parser.add_argument("--publish",
+                        help="also stream poses over ZeroMQ, e.g. tcp://*:5556")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="reuse the last poses on frames where nothing moved")
+    parsed = parser.parse_args(args)
+    startup_profiler.mark("imports")
+
+    ar_config = default_ar_config()
+    if parsed.config:
+        with open(parsed.config, encoding="utf-8") as config_file:
+            ar_config.update(json.load(config_file))
+        # JSON gives lists, OpenCV needs arrays.
+        for key in ("camera projection", "camera distortion"):
+            if key in ar_config:
+                ar_config[key] = np.asarray(ar_config[key], np.float32)
+    if parsed.calibration:
+        ar_config["calibration"] = parsed.calibration
+    if parsed.marker_size is not None:
+        ar_config["marker size"] = parsed.marker_size
+    if parsed.dictionary:
+        ar_config["aruco dictionary"] = parsed.dictionary
+    if parsed.motion_gate:
+        ar_config["motion gate"] = True
+    if ar_config.get("use quaternions"):
+        parser.error("pose files store 4x4 matrices, set \"use quaternions\" to false")
+    # Frames always come from the source opened here.
+    ar_config["video source"] = 'none'
+
+    video_source = open_source(parsed.source)
+    startup_profiler.mark("video source opened")
+    publisher = PosePublisher(parsed.publish) if parsed.publish else None
+    started = time.perf_counter()
+    try:
+        with open_pose_writer(parsed.output) as writer:
+            frames = track(video_source, ar_config, writer, parsed.max_frames,
+                           publisher)
+    finally:
+        video_source.release()
+        if publisher is not None:
+            publisher.close()
+    elapsed = time.perf_counter() - started
+
+    print(f"Tracked {frames} frames in {elapsed:.2f} s "
+          f"({frames / elapsed if elapsed > 0 else 0.0:.1f} fps), "
+          f"{writer.rows} poses written to {parsed.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,31 @@
+# Imported first so OVERLAY_STARTUP_PROFILE=1 times every other import.
+from lib.startup_profile import startup_profiler
+import os
 import platform
-from PySide6.QtCore import QTimer
+import time
+import numpy as np
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtGui import QKeySequence, QShortcut
 from PySide6.QtWidgets import QFileDialog, QPushButton, QComboBox, QApplication, QWidget, QColorDialog, \
     QVBoxLayout, QMessageBox, QLineEdit, QLabel
 from lib.modified_video_source import TimestampedVideoSource
 import sys
-import numpy
-from lib.arucotracker import ArUcoTracker
+from lib.allocation_profile import AllocationProfiler
+from lib.arucotracker import ArUcoTracker, default_ar_config
+from lib.frame_scheduler import FrameScheduler
+from lib.latency_monitor import LatencyMonitor
 from lib.model_loader import ModelDirectoryLoader
+from lib.model_picking import ModelPicker, make_landmark_actor
 from lib.overlay_window import VTKOverlayWindow
 from lib.transform_manager import TransformManager
+# Optional subsystems (streaming, pose publishing, anchors, undistortion)
+# are imported where they are turned on, so startup does not pay for them.
 
 
 class BaseWidget(QWidget):
+    # Emitted by the frame scheduler's capture thread when a frame arrives.
+    frame_arrived = Signal()
+
     def __init__(self, video_source, dims=None):
         super().__init__()
         # Setup the layout for the widget
@@ -24,36 +38,100 @@ class BaseWidget(QWidget):
         init_vtk_widget = platform.system() != 'Linux'
         self.vtk_overlay_window = VTKOverlayWindow(offscreen=False, init_widget=init_vtk_widget)
         self.layout.addWidget(self.vtk_overlay_window)
+        startup_profiler.mark("VTK overlay window created")
 
         # Initialize the video source
         self.video_source = TimestampedVideoSource(video_source, dims)
+        # Decode into a small pool of reused buffers instead of a new frame each time.
+        self.video_source.enable_frame_pool()
+        startup_profiler.mark("video source opened")
 
-        # Set up a timer to update the view periodically
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_view)
+        # Updates are driven by frame arrival and paced to update_rate, the
+        # target display rate, by the frame scheduler. The timer only delays
+        # an update until it is due.
         self.update_rate = 30
+        self.frame_scheduler = FrameScheduler(self.video_source, self.update_rate,
+                                              on_frame=self.frame_arrived.emit)
+        self.frame_arrived.connect(self.schedule_update)
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.run_update)
         self.model_dir = None
+        # Levels of detail for loaded models, e.g. (1.0, 0.25, 0.05), or None.
+        self.model_lod_levels = None
+        # If True, show bounding boxes at once and stream full models in the background.
+        self.progressive_model_loading = False
+        self.model_loader = None
+        # Locators for fast picking, built in the background as models load.
+        self.model_locator_type = "static"
+        self.model_locators = {}
         # Setup additional controls
         self.setup_upload_button()
         self.setup_video_source_controls()
         self.setup_color_change_button()
 
     def start(self):
-        # Start the timer with a frequency based on update_rate
-        self.timer.start(1000.0 / self.update_rate)
+        # Start capturing, each new frame schedules an update
+        self.frame_scheduler.target_rate = self.update_rate
+        self.frame_scheduler.start()
 
     def stop(self):
-        # Stop the timer
+        # Stop capturing and any pending update
+        self.frame_scheduler.stop()
         self.timer.stop()
 
+    def schedule_update(self):
+        # Run an update once it is due, unless one is already pending
+        if self.timer.isActive():
+            return
+        delay_ms = 1000.0 * self.frame_scheduler.time_until_due()
+        self.timer.start(int(delay_ms + 0.999))
+
+    def run_update(self):
+        # Update the view with the newest frame, skipping any stale ones
+        if not self.frame_scheduler.has_frame():
+            return
+        self.frame_scheduler.begin_update()
+        try:
+            self.update_view()
+        finally:
+            self.frame_scheduler.end_update()
+        if self.frame_scheduler.has_frame():
+            self.schedule_update()
+
     def terminate(self):
         # Properly terminate the VTK interactions
         self.vtk_overlay_window.terminate()
 
     def add_vtk_models_from_dir(self, directory):
         # Load and add VTK models from a directory
-        model_loader = ModelDirectoryLoader(directory)
+        model_loader = ModelDirectoryLoader(directory, lod_levels=self.model_lod_levels,
+                                            progressive=self.progressive_model_loading,
+                                            locator_type=self.model_locator_type)
+        self.model_locators = model_loader.locators
+        self.vtk_overlay_window.set_frame_budget(1.0 / self.update_rate)
+        if self.progressive_model_loading:
+            self.model_loader = model_loader
+            self.vtk_overlay_window.add_model_placeholders(model_loader.placeholders)
+            return
         self.vtk_overlay_window.add_vtk_models(model_loader.models)
+        if model_loader.lods:
+            self.vtk_overlay_window.add_model_lods(model_loader.models, model_loader.lods)
+        self.models_added(model_loader.models)
+
+    def swap_in_loaded_models(self):
+        # Add models finished by a progressive load since the last update
+        if self.model_loader is None:
+            return
+        models = self.vtk_overlay_window.swap_in_loaded_models(self.model_loader)
+        if models:
+            self.models_added(models)
+        if not self.model_loader.is_loading() and self.model_loader.loaded_models.empty():
+            self.model_loader = None
+
+    def models_added(self, models):
+        # Called with models once they are added to the overlay window
+        pass
 
     def update_view(self):
         # Abstract method to update the view, must be implemented in subclasses
@@ -126,6 +204,7 @@ class BaseWidget(QWidget):
             rgb_color = (color.red() / 255.0, color.green() / 255.0, color.blue() / 255.0)
             model_loader = ModelDirectoryLoader(self.model_dir, rgb_color)
             self.vtk_overlay_window.add_vtk_models(model_loader.models)
+            self.models_added(model_loader.models)
             self.vtk_overlay_window.Render()  # Re-render the window to update the color
 
     def set_window_title(self, title):
@@ -188,20 +267,82 @@ class OverlayBaseWidget(BaseWidget):
         super().__init__(image_source)
 
         # Configure the ArUco tracker with specific parameters for tracking.
-        self.ar_config = {
-            "tracker type": "aruco",  # Specifies the type of tracker to use.
-            "video source": 'none',  # Indicates that no separate video source will be used.
-            "debug": False,  # Debug mode is turned off.
-            "aruco dictionary": 'DICT_4X4_50',  # Specifies the dictionary of ArUco tags.
-            "marker size": 50,  # The size of the ArUco marker in mm.
-            "camera projection": numpy.array([[560.0, 0.0, 320.0],
-                                              [0.0, 560.0, 240.0],
-                                              [0.0, 0.0, 1.0]],
-                                             dtype=numpy.float32),  # Camera projection matrix.
-            "camera distortion": numpy.zeros((1, 4), numpy.float32)  # Camera distortion coefficients.
-        }
+        self.ar_config = default_ar_config()
+        # Optionally skip detection while nothing moves, reusing the last poses,
+        # with OVERLAY_MOTION_GATE=1. Every frame is tracked by default.
+        self.ar_config["motion gate"] = os.environ.get("OVERLAY_MOTION_GATE", "0") == "1"
         self.tracker = ArUcoTracker(self.ar_config)
         self.tracker.start_tracking()  # Start the ArUco tracker.
+        startup_profiler.mark("tracker created")
+
+        # Per-stage latency, optionally shown on screen and exported to a
+        # .json or .prom file, e.g. OVERLAY_METRICS_FILE=/tmp/overlay.prom
+        self.latency_monitor = LatencyMonitor(
+            export_file=os.environ.get("OVERLAY_METRICS_FILE"),
+            export_interval=float(os.environ.get("OVERLAY_METRICS_INTERVAL", 5.0)))
+        self.show_latency_hud = os.environ.get("OVERLAY_LATENCY_HUD", "0") == "1"
+        self.hud_interval = 0.25
+        self._last_hud_update = 0.0
+        self.vtk_overlay_window.render_end_callbacks.append(self.latency_monitor.end_frame)
+
+        # Bytes allocated per stage and frame, to track down memory creep, with
+        # OVERLAY_ALLOCATION_PROFILE=1 or toggled by Ctrl+Shift+M, see lib.allocation_profile.
+        self.allocation_profiler = AllocationProfiler.from_environment()
+        self.latency_monitor.allocation_profiler = self.allocation_profiler
+        self.frame_scheduler.allocation_profiler = self.allocation_profiler
+        self.frame_scheduler.latency_monitor = self.latency_monitor
+        self._render_allocations = None
+        render_window = self.vtk_overlay_window.GetRenderWindow()
+        render_window.AddObserver("StartEvent", self._begin_render_allocations)
+        render_window.AddObserver("EndEvent", self._end_render_allocations)
+        self.allocation_shortcut = QShortcut(QKeySequence("Ctrl+Shift+M"), self)
+        self.allocation_shortcut.activated.connect(self.allocation_profiler.toggle)
+
+        # Optional camera calibration, e.g. OVERLAY_CALIBRATION_FILE=calibration.txt,
+        # with OVERLAY_UNDISTORT=1 to undistort the video before tracking and display.
+        self.calibration_file = None
+        self.undistort_video = False
+        self.undistorter = None
+        calibration_file = os.environ.get("OVERLAY_CALIBRATION_FILE")
+        if calibration_file:
+            self.set_calibration(calibration_file,
+                                 undistort=os.environ.get("OVERLAY_UNDISTORT", "0") == "1")
+
+        # Stream every tracking result to AR headsets and other processes,
+        # e.g. OVERLAY_POSE_ADDRESS=tcp://*:5556, see lib.pose_publisher.
+        self.pose_publisher = None
+        pose_address = os.environ.get("OVERLAY_POSE_ADDRESS")
+        if pose_address:
+            from lib.pose_publisher import PosePublisher  # pylint: disable=import-outside-toplevel
+            self.pose_publisher = PosePublisher(pose_address)
+
+        # Serve the composited overlay as MJPEG over HTTP, for watching on
+        # tablets, e.g. OVERLAY_STREAM_PORT=8080 and OVERLAY_STREAM_FPS=10.
+        self.overlay_streamer = None
+        stream_port = os.environ.get("OVERLAY_STREAM_PORT")
+        if stream_port:
+            from lib.mjpeg_stream import MjpegStreamer  # pylint: disable=import-outside-toplevel
+            self.overlay_streamer = MjpegStreamer(
+                port=int(stream_port), max_fps=float(os.environ.get("OVERLAY_STREAM_FPS", 15.0)))
+            self.vtk_overlay_window.render_end_callbacks.append(self._stream_rendered_frame)
+
+        # Side-by-side stereo for headsets with OVERLAY_STEREO=1, using the
+        # calibrated eye offsets in OVERLAY_EYE_OFFSETS (two 4x4 transforms) if given.
+        if os.environ.get("OVERLAY_STEREO", "0") == "1":
+            eye_offsets_file = os.environ.get("OVERLAY_EYE_OFFSETS")
+            if eye_offsets_file:
+                self.vtk_overlay_window.load_eye_offsets(eye_offsets_file)
+            self.vtk_overlay_window.enable_stereo()
+
+        # Models anchored to their own tags, from an anchors.json next to the
+        # models. Without one the camera follows the first tag instead.
+        self.scene_graph = None
+
+        # Ctrl+click picks landmarks on the models, see lib.model_picking.
+        self.model_picker = ModelPicker()
+        self.landmarks = []
+        self.landmark_actors = []
+        self.vtk_overlay_window.AddObserver("LeftButtonPressEvent", self._pick_landmark)
 
         # UI to change marker size.
         self.setup_marker_size_ui()
@@ -227,8 +368,7 @@ class OverlayBaseWidget(BaseWidget):
         # Update the marker size based on user input.
         marker_size = float(self.marker_size_input.text())
         self.ar_config["marker size"] = marker_size
-        self.tracker = ArUcoTracker(self.ar_config)
-        self.tracker.start_tracking()  # Start the ArUco tracker.
+        self.tracker.set_marker_size(marker_size)  # Keeps the tracking state.
 
     def setup_dictionary_ui(self):
         # Label for dictionary selection
@@ -255,23 +395,178 @@ class OverlayBaseWidget(BaseWidget):
         # Update the ArUco dictionary based on user selection
         selected_dictionary = self.dictionary_selector.currentText()
         self.ar_config["aruco dictionary"] = selected_dictionary
-        self.tracker = ArUcoTracker(self.ar_config)
-        self.tracker.start_tracking()  # Restart the ArUco tracker
+        self.tracker.set_dictionary(selected_dictionary)  # Keeps the tracking state.
+
+    def set_calibration(self, calibration_file, undistort=False):
+        # Load the camera calibration for the tracker and the overlay. With
+        # undistort, frames are undistorted using maps cached next to the
+        # calibration file, and both use the undistorted intrinsics.
+        from lib.undistortion import Undistorter, load_calibration  # pylint: disable=import-outside-toplevel
+
+        projection, distortion = load_calibration(calibration_file)
+        self.calibration_file = calibration_file
+        self.undistort_video = undistort
+        self.undistorter = None
+        if undistort:
+            height, width = self.video_source.frame.shape[0:2]
+            self.undistorter = Undistorter.from_calibration_file(calibration_file, (width, height))
+            projection, distortion = self.undistorter.camera_matrix, self.undistorter.distortion
+        self.ar_config["camera projection"] = projection
+        self.ar_config["camera distortion"] = distortion
+        self.tracker.set_calibration(projection, distortion)
+        self.vtk_overlay_window.set_camera_matrix(projection)
+
+    def change_video_source(self, new_source):
+        super().change_video_source(new_source)
+        if self.undistorter is not None:
+            # The undistortion maps depend on the frame size.
+            self.set_calibration(self.calibration_file, undistort=True)
+
+    def add_vtk_models_from_dir(self, directory):
+        # Anchor the models to their own tags if the directory has an anchors file.
+        from lib.scene_graph import ANCHORS_FILE, load_anchors  # pylint: disable=import-outside-toplevel
+
+        anchors_file = os.path.join(directory, ANCHORS_FILE)
+        if os.path.exists(anchors_file):
+            self.set_scene_graph(load_anchors(anchors_file, self.ar_config["aruco dictionary"]))
+        super().add_vtk_models_from_dir(directory)
+
+    def set_scene_graph(self, scene_graph):
+        # Move models with their own tags, or None to move the camera with
+        # the first tag. Anchored models are placed in camera coordinates,
+        # so the camera stays at the origin.
+        self.scene_graph = scene_graph
+        if scene_graph is not None:
+            self.vtk_overlay_window.set_camera_pose(np.eye(4))
+
+    def models_added(self, models):
+        self.model_picker.add_models(models, self.model_locators)
+        if self.scene_graph is not None:
+            self.scene_graph.add_models(models)
+            # Adding models may have reset the camera.
+            self.vtk_overlay_window.set_camera_pose(np.eye(4))
 
     def update_view(self):
-        _, image, _ = self.video_source.read()
-        self._aruco_detect_and_follow(image)
-        self.vtk_overlay_window.set_video_image(image)
+        self.swap_in_loaded_models()
+        monitor = self.latency_monitor
+        monitor.begin_frame()
+        scheduled = self.frame_scheduler.take_frame()
+        if scheduled is None:
+            return
+        image = scheduled.frame
+        monitor.tag_frame(scheduled.frame_id, scheduled.capture_time)
+        # Time from capture until the frame is picked up.
+        monitor.add_sample("frame wait", time.perf_counter() - scheduled.capture_time)
+        try:
+            if self.undistorter is not None:
+                with monitor.stage("undistort"):
+                    image = self.undistorter.undistort(image)
+            result = self._aruco_detect_and_follow(image)
+            if self.pose_publisher is not None:
+                # Only queued here, sent from the publisher's thread.
+                self.pose_publisher.publish(
+                    result, scheduled.timestamp.timestamp() if scheduled.timestamp else None)
+            with monitor.stage("upload"):
+                self.vtk_overlay_window.set_video_image(image)
+        finally:
+            # Hand the pooled frame back once tracking and upload are done.
+            if scheduled.pooled is not None:
+                scheduled.pooled.release()
+        self._update_latency_hud()
+        # Rendering happens on the next paint, which calls monitor.end_frame.
+        monitor.submit_frame()
         self.vtk_overlay_window.Render()
         if not hasattr(self, 'initialized'):
             self.vtk_overlay_window.Initialize()
             self.initialized = True
+            startup_profiler.first_frame()
+
+    def _stream_rendered_frame(self, _render_time):
+        # Reads back what the render just drew, only when a client is
+        # watching; encoding is done on the streamer's workers.
+        if self.overlay_streamer.wants_frame():
+            self.overlay_streamer.submit_frame(
+                self.vtk_overlay_window.convert_scene_to_numpy_array(rerender=False))
+
+    def terminate(self):
+        self.allocation_profiler.disable()
+        if self.pose_publisher is not None:
+            self.pose_publisher.close()
+        if self.overlay_streamer is not None:
+            self.overlay_streamer.close()
+        super().terminate()
+
+    def _pick_landmark(self, interactor, _event):
+        # Ctrl+click adds the model surface point under the cursor as a landmark.
+        if not interactor.GetControlKey():
+            return
+        x, y = interactor.GetEventPosition()
+        renderer = self.vtk_overlay_window.get_foreground_renderer()
+        if self.vtk_overlay_window.stereo and x >= interactor.GetRenderWindow().GetSize()[0] // 2:
+            renderer = self.vtk_overlay_window.right_eye_renderers[1]
+        picked = self.model_picker.pick(x, y, renderer)
+        self.latency_monitor.add_sample("landmark pick", self.model_picker.last_query_time)
+        if picked is not None:
+            self.landmarks.append(picked)
+            # Marked on the model, moving with it. Stereo copies the
+            # foreground renderer's props to the right eye.
+            actor = make_landmark_actor(self.model_picker.locators[picked.model_name].model,
+                                        picked.position)
+            self.landmark_actors.append(actor)
+            self.vtk_overlay_window.get_foreground_renderer().AddActor(actor)
+            self.vtk_overlay_window.Render()
+
+    def get_landmarks(self):
+        # Picked landmarks as PickedPoint, oldest first.
+        return list(self.landmarks)
+
+    def clear_landmarks(self):
+        for actor in self.landmark_actors:
+            self.vtk_overlay_window.get_foreground_renderer().RemoveActor(actor)
+        self.landmarks = []
+        self.landmark_actors = []
+        self.vtk_overlay_window.Render()
+
+    def _begin_render_allocations(self, _caller, _event):
+        self._render_allocations = self.allocation_profiler.begin_stage()
+
+    def _end_render_allocations(self, _caller, _event):
+        # A frame ends once it is rendered.
+        self.allocation_profiler.end_stage("render", self._render_allocations)
+        self._render_allocations = None
+        self.allocation_profiler.end_frame()
+
+    def _update_latency_hud(self):
+        # Refresh the on-screen latency text a few times a second
+        if not self.show_latency_hud:
+            self.vtk_overlay_window.set_overlay_text(None)
+            return
+        now = time.perf_counter()
+        if now - self._last_hud_update >= self.hud_interval:
+            self._last_hud_update = now
+            stats = self.frame_scheduler.stats()
+            text = (self.latency_monitor.hud_text() +
+                    f"\ndisplay {stats['display fps'] or 0:.1f} / camera {stats['camera fps'] or 0:.1f} fps, "
+                    f"jitter {stats['jitter ms'] or 0:.1f} ms\n"
+                    f"stale frames {stats['stale frames']}, overruns {stats['overruns']}")
+            gate_stats = self.tracker.get_motion_gate_stats()
+            if gate_stats is not None:
+                text += f"\ndetection skipped {100.0 * gate_stats['skip rate']:.0f}%"
+            self.vtk_overlay_window.set_overlay_text(text)
 
     def _aruco_detect_and_follow(self, image):
         # Detect ArUco markers in the provided image and follow them.
-        _port_handles, _timestamps, _frame_numbers, tag2camera, _tracking_quality = self.tracker.get_frame(image)
-        if tag2camera:
-            self._move_camera(tag2camera[0])  # Adjust the camera based on the detected tag.
+        monitor = self.latency_monitor
+        with monitor.stage("get_frame"):
+            result = self.tracker.get_frame(image)
+        monitor.add_samples(self.tracker.get_stage_times(), prefix="get_frame ")
+        if self.scene_graph is not None:
+            with monitor.stage("scene update"):
+                self.scene_graph.update(result)  # Move every anchored group with its own tag.
+        elif result:
+            with monitor.stage("camera pose"):
+                self._move_camera(result.poses[0])  # Adjust the camera based on the first tracked tag.
+        return result
 
     def _move_camera(self, tag2camera):
         # Adjust the camera position based on the ArUco tag's camera transformation matrix.
@@ -286,8 +581,11 @@ class OverlayBaseWidget(BaseWidget):
 
 
 if __name__ == '__main__':
+    startup_profiler.mark("imports")
     app = QApplication(sys.argv)
+    startup_profiler.mark("QApplication created")
     overlay_widget = OverlayBaseWidget(0)
+    startup_profiler.mark("overlay widget created")
     overlay_widget.set_window_title("Overlay and Tracking")
     overlay_widget.show()
     overlay_widget.start()